@@ -1,11 +1,11 @@
 # Authentication 2.0.py
 
-import requests
 import webbrowser
 import secrets
-import json
 from urllib.parse import urlencode, urljoin
 from flask import Flask, request, redirect, session
+from token_manager import TokenManager, TokenError
+from token_store import FileTokenStore
 
 app = Flask(__name__)
 app.secret_key = '[Your_Own_Secret_Key]'  # This is just your own password to store your access tokens
@@ -40,31 +40,12 @@ authorization_request_url = urljoin(authorization_url, '?' + urlencode(authoriza
 # App URL
 app_url = 'http://127.0.0.1:5000'
 
-# Automatically open the web browser
-webbrowser.open(app_url)
 
+# Where the tokens are kept. Use SQLiteTokenStore('tokens.db') when several processes or realms share tokens
+token_store = FileTokenStore('tokens.json')
 
-# Store tokens in a file
-def store_tokens(access_token, refresh_token):
-    with open('tokens.json', 'w') as f:
-        tokens_data = {'access_token': access_token, 'refresh_token': refresh_token}
-        json.dump(tokens_data, f)
-
-
-# Retrieve stored tokens from a file
-def get_stored_tokens():
-    try:
-        with open('tokens.json', 'r') as f:
-            tokens_data = json.load(f)
-            return tokens_data.get('access_token'), tokens_data.get('refresh_token')
-    except FileNotFoundError:
-        return None, None
-
-
-# Update the stored access token in the file
-def update_stored_access_token(new_access_token):
-    access_token, refresh_token = get_stored_tokens()
-    store_tokens(new_access_token, refresh_token)
+# Tokens are cached in memory with their expiry time and saved in the token store
+token_manager = TokenManager(client_id, client_secret, redirect_uri, token_endpoint, store=token_store)
 
 
 # Open Authorization Request URL
@@ -85,33 +66,18 @@ def callback():
     session['realm_id'] = realm_id
 
     # Exchange the authorization code for an access token
-    token_params = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'code': auth_code,
-        'redirect_uri': redirect_uri,
-        'grant_type': 'authorization_code',
-    }
-
-    response = requests.post(token_endpoint, data=token_params)
-
-    if response.status_code == 200:
-        # Successfully obtained access token
-        access_token = response.json().get('access_token')
-        refresh_token = response.json().get('refresh_token')
-
-        # Print the values to the command line
-        # print(f'Authorization Code: {auth_code}, Realm ID: {realm_id}, Access Token: {access_token}, Refresh Token: {refresh_token}')
-
-        # Store tokens in a secure manner (e.g., a database)
-        store_tokens(access_token, refresh_token)
+    try:
+        access_token = token_manager.exchange_code(auth_code, realm_id)
+    except TokenError as err:
+        # Handle the error case
+        print(f"Error: {err}")
+        return f"Error: {err}"
 
-        return redirect(f'{app_url}/refresh?realm_id={realm_id}')
+    # Print the values to the command line
+    # print(f'Authorization Code: {auth_code}, Realm ID: {realm_id}, Access Token: {access_token}')
 
-    else:
-        # Handle the error case
-        print(f"Error: {response.text}")
-        return f"Error: {response.text}"
+    # The new access token is good for an hour, so there is no need to refresh it right away
+    return redirect(f'{app_url}/get_items?access_token={access_token}&realm_id={realm_id}')
 
 
 # Token refresh route
@@ -120,29 +86,20 @@ def refresh_token():
     # Retrieve Realm ID to Pass to API Call
     realm_id = request.args.get('realm_id')
 
-    # Retrieve stored tokens (access token and refresh token) from a secure storage
-    stored_access_token, stored_refresh_token = get_stored_tokens()
-
-    # Request a new access token using the refresh token
-    token_params = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'refresh_token': stored_refresh_token,
-        'grant_type': 'refresh_token',
-    }
-
-    response = requests.post(token_endpoint, data=token_params)
+    # Get the cached access token, it is only refreshed when it is about to expire
+    try:
+        new_access_token = token_manager.get_access_token()
+    except TokenError as err:
+        # Handle the error case
+        print(f"Error refreshing token: {err}")
+        return f"Error refreshing token: {err}"
 
-    if response.status_code == 200:
-        # Successfully obtained a new access token
-        new_access_token = response.json().get('access_token')
+    return redirect(f'{app_url}/get_items?access_token={new_access_token}&realm_id={realm_id}')
 
-        # Update the stored access token
-        update_stored_access_token(new_access_token)
 
-        return redirect(f'{app_url}/get_items?access_token={new_access_token}&realm_id={realm_id}')
+if __name__ == '__main__':
+    # Automatically open the web browser, only when run as a script so the module can be imported
+    webbrowser.open(app_url)
 
-    else:
-        # Handle the error case
-        print(f"Error refreshing token: {response.text}")
-        return f"Error refreshing token: {response.text}"
+    print('Starting the application...')
+    app.run(debug=False)
@@ -1,10 +1,10 @@
 # Authentication.py
 
-import requests
 import webbrowser
 import secrets
 from urllib.parse import urlparse, urlencode, urljoin
 from flask import Flask, request, redirect
+from qbo_http import get_session
 
 
 app = Flask(__name__)
@@ -37,9 +37,6 @@ authorization_request_url = urljoin (authorization_url, '?' + urlencode(authoriz
 # App URL
 app_url = 'http://127.0.0.1:5000'
 
-# Automatically open the web browser
-webbrowser.open(app_url)
-
 # Open Authorization Request URL
 @app.route('/')
 def login():
@@ -63,7 +60,7 @@ def callback():
         'grant_type': 'authorization_code',
     }
 
-    response = requests.post(token_endpoint, data=token_params)
+    response = get_session().post(token_endpoint, data=token_params)
 
     if response.status_code == 200:
         # Successfully obtained access token
@@ -79,5 +76,8 @@ def callback():
         return f"Error: {response.text}"
 
 if __name__ == '__main__':
+    # Automatically open the web browser, only when run as a script so the module can be imported
+    webbrowser.open(app_url)
+
     print('Starting the application...')
     app.run(debug=False)
\ No newline at end of file
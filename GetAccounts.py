@@ -5,8 +5,18 @@ import webbrowser
 import secrets
 import json
 import csv
+import threading
 from urllib.parse import urlencode, urljoin
 from flask import Flask, request, redirect, session
+from qbo_http import pool_stats
+from token_manager import TokenManager, TokenError
+from token_store import FileTokenStore
+from qbo_query import query_entities, max_page_size
+from qbo_cdc import incremental_sync
+from entity_mirror import EntityMirror
+from account_cache import AccountCache, account_index_fields
+from export_sinks import make_sink, export_path, export_fields
+from qbo_metrics import render_metrics, metrics_content_type, entities_exported
 
 app = Flask(__name__)
 app.secret_key = '[Your_Own_Secret_Key]'  # This is just your own password to store your access tokens
@@ -41,31 +51,12 @@ authorization_request_url = urljoin(authorization_url, '?' + urlencode(authoriza
 # App URL
 app_url = 'http://127.0.0.1:5000'
 
-# Automatically open the web browser
-webbrowser.open(app_url)
 
+# Where the tokens are kept. Use SQLiteTokenStore('tokens.db') when several processes or realms share tokens
+token_store = FileTokenStore('tokens.json')
 
-# Store tokens in a file
-def store_tokens(access_token, refresh_token):
-    with open('tokens.json', 'w') as f:
-        tokens_data = {'access_token': access_token, 'refresh_token': refresh_token}
-        json.dump(tokens_data, f)
-
-
-# Retrieve stored tokens from a file
-def get_stored_tokens():
-    try:
-        with open('tokens.json', 'r') as f:
-            tokens_data = json.load(f)
-            return tokens_data.get('access_token'), tokens_data.get('refresh_token')
-    except FileNotFoundError:
-        return None, None
-
-
-# Update the stored access token in the file
-def update_stored_access_token(new_access_token):
-    access_token, refresh_token = get_stored_tokens()
-    store_tokens(new_access_token, refresh_token)
+# Tokens are cached in memory with their expiry time and saved in the token store
+token_manager = TokenManager(client_id, client_secret, redirect_uri, token_endpoint, store=token_store)
 
 
 # Open Authorization Request URL
@@ -86,33 +77,18 @@ def callback():
     session['realm_id'] = realm_id
 
     # Exchange the authorization code for an access token
-    token_params = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'code': auth_code,
-        'redirect_uri': redirect_uri,
-        'grant_type': 'authorization_code',
-    }
-
-    response = requests.post(token_endpoint, data=token_params)
-
-    if response.status_code == 200:
-        # Successfully obtained access token
-        access_token = response.json().get('access_token')
-        refresh_token = response.json().get('refresh_token')
-
-        # Print the values to the command line
-        # print(f'Authorization Code: {auth_code}, Realm ID: {realm_id}, Access Token: {access_token}, Refresh Token: {refresh_token}')
-
-        # Store tokens in a secure manner (e.g., a database)
-        store_tokens(access_token, refresh_token)
+    try:
+        access_token = token_manager.exchange_code(auth_code, realm_id)
+    except TokenError as err:
+        # Handle the error case
+        print(f"Error: {err}")
+        return f"Error: {err}"
 
-        return redirect(f'{app_url}/refresh?realm_id={realm_id}')
+    # Print the values to the command line
+    # print(f'Authorization Code: {auth_code}, Realm ID: {realm_id}, Access Token: {access_token}')
 
-    else:
-        # Handle the error case
-        print(f"Error: {response.text}")
-        return f"Error: {response.text}"
+    # The new access token is good for an hour, so there is no need to refresh it right away
+    return redirect(f'{app_url}/get_accounts?access_token={access_token}&realm_id={realm_id}')
 
 
 # Token refresh route
@@ -121,32 +97,26 @@ def refresh_token():
     # Retrieve Realm ID to Pass to API Call
     realm_id = request.args.get('realm_id')
 
-    # Retrieve stored tokens (access token and refresh token) from a secure storage
-    stored_access_token, stored_refresh_token = get_stored_tokens()
+    # Get the cached access token, it is only refreshed when it is about to expire
+    try:
+        new_access_token = token_manager.get_access_token()
+    except TokenError as err:
+        # Handle the error case
+        print(f"Error refreshing token: {err}")
+        return f"Error refreshing token: {err}"
 
-    # Request a new access token using the refresh token
-    token_params = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'refresh_token': stored_refresh_token,
-        'grant_type': 'refresh_token',
-    }
+    return redirect(f'{app_url}/get_accounts?access_token={new_access_token}&realm_id={realm_id}')
 
-    response = requests.post(token_endpoint, data=token_params)
 
-    if response.status_code == 200:
-        # Successfully obtained a new access token
-        new_access_token = response.json().get('access_token')
+# Route for checking that connections are being reused
+@app.route('/pool_stats')
+def show_pool_stats():
+    return pool_stats()
 
-        # Update the stored access token
-        update_stored_access_token(new_access_token)
-
-        return redirect(f'{app_url}/get_accounts?access_token={new_access_token}&realm_id={realm_id}')
-
-    else:
-        # Handle the error case
-        print(f"Error refreshing token: {response.text}")
-        return f"Error refreshing token: {response.text}"
+# Route for Prometheus to scrape latency, status code, entity and byte counters
+@app.route('/metrics')
+def show_metrics():
+    return render_metrics(), 200, {'Content-Type': metrics_content_type}
 
 
 ##############################################################################################
@@ -162,98 +132,156 @@ def get_accounts():
     if not realm_id or not access_token:
         return 'Realm ID or Access Token not provided in the request parameters.', 400
 
+    # Page size for the query, QBO allows at most 1000 per page
+    max_results = request.args.get('max_results', default=max_page_size, type=int)
+
+    # With incremental=true only the accounts changed since the last run are downloaded
+    incremental = request.args.get('incremental', 'false').lower() == 'true'
+
+    if incremental:
+        api_response = sync_accounts(realm_id, access_token, max_results=max_results)
+
+        if 'error' in api_response:
+            return f"Error in API call: {api_response['error']['code']}, {api_response['error']['message']}", 500
+        elif api_response['mode'] == 'incremental':
+            return (f"Incremental sync completed in {api_response['seconds']:.2f}s: {api_response['updated']} updated, "
+                    f"{api_response['created']} created, {api_response['deleted']} deleted.")
+        else:
+            return (f"Full sync completed in {api_response['seconds']:.2f}s ({api_response['reason']}). "
+                    f"Exported {api_response['count']} accounts.")
+
+    # Export format, one of csv, csv.gz, ndjson, ndjson.gz or sqlite
+    export_format = request.args.get('format', 'csv')
+
     # Call the API function with the obtained tokens
-    api_response = make_api_request(realm_id, access_token)
+    api_response = make_api_request(realm_id, access_token, max_results=max_results, export_format=export_format)
 
     if api_response and 'error' in api_response:
         return f"Error in API call: {api_response['error']['code']}, {api_response['error']['message']}", 500
     else:
-        return 'API request completed.'
+        total_seconds = sum(page['seconds'] for page in api_response['pages'])
+        return (f"API request completed. Exported {api_response['count']} accounts to {api_response['export_path']} "
+                f"in {len(api_response['pages'])} pages ({total_seconds:.2f}s).")
+
+
+# File the accounts are exported to, without the extension that the export format adds
+accounts_export_name = 'accounts_data'
+
+# SQLite copy of the QBO entities, shared with the other scripts
+entity_mirror_path = 'qbo_mirror.db'
+entity_mirror = None
+entity_mirror_lock = threading.Lock()
+
+
+# Function to get the entity mirror, opening it the first time it is needed
+def get_entity_mirror():
+    global entity_mirror
+    if entity_mirror is None:
+        with entity_mirror_lock:
+            if entity_mirror is None:
+                entity_mirror = EntityMirror(entity_mirror_path)
+    return entity_mirror
+
+
+# Function to fetch every account of a realm for the account cache
+def fetch_accounts(realm_id, access_token):
+    return query_entities(base_url, realm_id, access_token, 'Account', minorversion, fields=account_index_fields)
+
+
+# Every export and sync of the accounts refreshes the account index the item updates resolve names with
+account_cache = AccountCache(fetch_accounts, ttl_seconds=3600, get_mirror=get_entity_mirror)
+
+# Specify the order of columns
+account_columns = [
+    'Name', 'SubAccount', 'FullyQualifiedName', 'AccountType', 'AccountSubType', 'Id',
+    'Classification'
+]
+
+
+# Function to turn an account into a CSV row in the order of account_columns
+def account_to_row(account):
+    return [
+        account.get('Name', ''), account.get('SubAccount', ''),
+        account.get('FullyQualifiedName', ''), account.get('AccountType', ''),
+        account.get('AccountSubType', ''), account.get('Id', ''),
+        account.get('Classification', ''),
+    ]
 
 
 # Function to make the API call
-def make_api_request(realm_id, access_token):
+# Accounts are streamed page by page straight into the export file, so memory stays flat for large charts of accounts
+# export_format picks the sink: csv, csv.gz, ndjson, ndjson.gz or sqlite
+# export_name is the file name without extension, fleet runs and incremental syncs give every realm its own
+def make_api_request(realm_id, access_token, max_results=max_page_size, export_format='csv',
+                     export_name=accounts_export_name):
     try:
-        # Set the headers for the request
-        query = "select * from Account"
-
-        # Construct the complete URL for the API call
-        api_url = f"{base_url}{realm_id}/query?query={query}&minorversion={minorversion}"
-
-        # Set the headers for the request
-        api_headers = {
-            'Accept': 'application/json',  # Specify that you want JSON responses
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {access_token}'
-        }
-
-        # Make the GET request
-        response = requests.get(api_url, headers=api_headers)
-        response.raise_for_status()  # Raise an HTTPError for bad responses (4xx and 5xx)
-
-        # Check if the response content is empty
-        if not response.content:
-            return {'error': {'code': 500, 'message': 'Empty response content'}}
-
-        try:
-            # Attempt to parse the response as JSON
-            data = response.json()
-            print("API Response:", data)
-
-            # Check if the 'QueryResponse' key is present in the JSON data
-            if 'QueryResponse' in data:
-                accounts = data['QueryResponse'].get('Account', [])
-
-                if accounts:
-                    # Specify the CSV file path
-                    csv_file_path = 'accounts_data.csv'
-
-                    # Specify the order of columns
-                    columns = [
-                        'Name', 'SubAccount', 'FullyQualifiedName', 'AccountType', 'AccountSubType', 'Id',
-                        'Classification'
-                    ]
-
-                    # Write the data to the CSV file
-                    with open(csv_file_path, 'w', newline='', encoding='utf-8') as csv_file:
-                        csv_writer = csv.writer(csv_file)
-
-                        # Write the header row
-                        csv_writer.writerow(columns)
-
-                        # Write each account as a row in the CSV file
-                        for account in accounts:
-
-                            # Write the values in the specified order
-                            row_values = [
-                                account.get('Name', ''), account.get('SubAccount', ''),
-                                account.get('FullyQualifiedName', ''), account.get('AccountType', ''),
-                                account.get('AccountSubType', ''), account.get('Id', ''),
-                                account.get('Classification', ''),
-                            ]
-                            csv_writer.writerow(row_values)
-
-                    print(f"Data exported to CSV file: {csv_file_path}")
-                else:
-                    print("No accounts data in the response.")
-            else:
-                print("Unexpected JSON format in the response.")
-
-            return data
-        except json.JSONDecodeError as json_err:
-            print(f"Error decoding JSON response: {json_err}")
-            print("Response Content:", response.content.decode('utf-8'))
-            return {'error': {'code': 500, 'message': 'Error decoding JSON response'}}
+        # Specify the export file path
+        export_file_path = export_path(export_name, export_format)
+
+        # Per-page timing is collected here by the query engine
+        page_timings = []
+        account_count = 0
+        # The few fields the account index needs are kept from every account, for the account cache
+        index_accounts = []
+
+        # Write the data to the export file
+        with make_sink(export_format, export_name, account_columns, account_to_row, 'accounts') as sink:
+            # Write each account to the export file as its page arrives
+            # Only the fields behind the export columns are fetched, which keeps the pages small
+            for account in query_entities(base_url, realm_id, access_token, 'Account', minorversion,
+                                          max_results=max_results, page_timings=page_timings,
+                                          fields=export_fields(export_format, account_columns)):
+                sink.write(account)
+                index_accounts.append({field: account.get(field) for field in account_index_fields})
+                account_count += 1
+
+        entities_exported.inc(account_count, entity='Account')
+        account_cache.put(realm_id, index_accounts)
+
+        if account_count:
+            print(f"Data exported to file: {export_file_path}")
+        else:
+            print("No accounts data in the response.")
+
+        return {'count': account_count, 'export_path': export_file_path, 'pages': page_timings}
 
     except requests.exceptions.HTTPError as http_err:
-        return {'error': {'code': response.status_code, 'message': str(http_err)}}
+        return {'error': {'code': http_err.response.status_code, 'message': str(http_err)}}
+    except json.JSONDecodeError as json_err:
+        print(f"Error decoding JSON response: {json_err}")
+        return {'error': {'code': 500, 'message': 'Error decoding JSON response'}}
     except Exception as err:
         return {'error': {'code': 500, 'message': str(err)}}
 
 
+# Function to bring the accounts export up to date with only the accounts changed since the last run
+# Falls back to a full export when ChangeDataCapture cannot be used
+# The watermark is kept per realm, so every realm merges into its own CSV file, {realm_id}_accounts_data.csv
+def sync_accounts(realm_id, access_token, max_results=max_page_size):
+    export_name = f'{realm_id}_{accounts_export_name}'
+
+    try:
+        result = incremental_sync(base_url, realm_id, access_token, 'Account', minorversion,
+                                  export_path(export_name, 'csv'), account_columns, account_to_row,
+                                  lambda: make_api_request(realm_id, access_token, max_results=max_results,
+                                                           export_name=export_name))
+
+        # A full export has already refreshed the account cache, a merge leaves every account in the CSV file
+        if result.get('mode') == 'incremental':
+            with open(result['csv_file_path'], newline='', encoding='utf-8') as csvfile:
+                account_cache.put(realm_id, csv.DictReader(csvfile))
+
+        return result
+    except requests.exceptions.HTTPError as http_err:
+        return {'error': {'code': http_err.response.status_code, 'message': str(http_err)}}
+    except Exception as err:
+        return {'error': {'code': 500, 'message': str(err)}}
 
 
 if __name__ == '__main__':
+    # Automatically open the web browser, only when run as a script so the module can be imported
+    webbrowser.open(app_url)
+
     print('Starting the application...')
     print(f'Open this URL in your web browser: {app_url}')
     app.run(debug=False)
@@ -1,14 +1,33 @@
 # UpdateItems.py
 
+import os
 import requests
 import webbrowser
+import html
 import secrets
 import json
 import csv
 import time
+import math
+import threading
 from datetime import datetime, timezone, timedelta
 from urllib.parse import urlencode, urljoin
-from flask import Flask, request, redirect, session
+from flask import Flask, Response, request, redirect, session, send_file
+from qbo_http import get_session, pool_stats
+from token_manager import TokenManager, TokenError
+from token_store import FileTokenStore
+from qbo_query import query_page, query_pages, query_entities, max_page_size
+from qbo_batch import batch_update, max_batch_size, is_stale_object_error
+from qbo_executor import run_concurrently
+from entity_mirror import EntityMirror
+from item_diff import build_sparse_update
+from account_cache import (AccountCache, AccountFetchError, account_index_fields, item_account_refs,
+                           resolve_item_account_refs)
+from item_validation import validate_item_row, write_rejection_report
+from export_sinks import make_sink, export_path, export_fields
+from qbo_metrics import render_metrics, metrics_content_type, entities_exported, entities_updated, upstream_retries
+from qbo_rate_limit import get_realm_limiter, default_requests_per_minute, default_max_concurrent
+from job_queue import JobQueue, job_events
 
 app = Flask(__name__)
 app.secret_key = '[Your_Own_Secret_Key]'  # This is just your own password to store your access tokens
@@ -43,31 +62,12 @@ authorization_request_url = urljoin(authorization_url, '?' + urlencode(authoriza
 # App URL
 app_url = 'http://127.0.0.1:5000'
 
-# Automatically open the web browser
-webbrowser.open(app_url)
 
+# Where the tokens are kept. Use SQLiteTokenStore('tokens.db') when several processes or realms share tokens
+token_store = FileTokenStore('tokens.json')
 
-# Store tokens in a file
-def store_tokens(access_token, refresh_token):
-    with open('tokens.json', 'w') as f:
-        tokens_data = {'access_token': access_token, 'refresh_token': refresh_token}
-        json.dump(tokens_data, f)
-
-
-# Retrieve stored tokens from a file
-def get_stored_tokens():
-    try:
-        with open('tokens.json', 'r') as f:
-            tokens_data = json.load(f)
-            return tokens_data.get('access_token'), tokens_data.get('refresh_token')
-    except FileNotFoundError:
-        return None, None
-
-
-# Update the stored access token in the file
-def update_stored_access_token(new_access_token):
-    access_token, refresh_token = get_stored_tokens()
-    store_tokens(new_access_token, refresh_token)
+# Tokens are cached in memory with their expiry time and saved in the token store
+token_manager = TokenManager(client_id, client_secret, redirect_uri, token_endpoint, store=token_store)
 
 
 # Open Authorization Request URL
@@ -88,33 +88,18 @@ def callback():
     session['realm_id'] = realm_id
 
     # Exchange the authorization code for an access token
-    token_params = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'code': auth_code,
-        'redirect_uri': redirect_uri,
-        'grant_type': 'authorization_code',
-    }
-
-    response = requests.post(token_endpoint, data=token_params)
-
-    if response.status_code == 200:
-        # Successfully obtained access token
-        access_token = response.json().get('access_token')
-        refresh_token = response.json().get('refresh_token')
-
-        # Print the values to the command line
-        # print(f'Authorization Code: {auth_code}, Realm ID: {realm_id}, Access Token: {access_token}, Refresh Token: {refresh_token}')
-
-        # Store tokens in a secure manner (e.g., a database)
-        store_tokens(access_token, refresh_token)
+    try:
+        access_token = token_manager.exchange_code(auth_code, realm_id)
+    except TokenError as err:
+        # Handle the error case
+        print(f"Error: {err}")
+        return f"Error: {err}"
 
-        return redirect(f'{app_url}/refresh?realm_id={realm_id}')
+    # Print the values to the command line
+    # print(f'Authorization Code: {auth_code}, Realm ID: {realm_id}, Access Token: {access_token}')
 
-    else:
-        # Handle the error case
-        print(f"Error: {response.text}")
-        return f"Error: {response.text}"
+    # The new access token is good for an hour, so there is no need to refresh it right away
+    return redirect(f'{app_url}/get_and_update_items?access_token={access_token}&realm_id={realm_id}')
 
 
 # Token refresh route
@@ -123,38 +108,37 @@ def refresh_token():
     # Retrieve Realm ID to Pass to API Call
     realm_id = request.args.get('realm_id')
 
-    # Retrieve stored tokens (access token and refresh token) from a secure storage
-    stored_access_token, stored_refresh_token = get_stored_tokens()
+    # Get the cached access token, it is only refreshed when it is about to expire
+    try:
+        new_access_token = token_manager.get_access_token()
+    except TokenError as err:
+        # Handle the error case
+        print(f"Error refreshing token: {err}")
+        return f"Error refreshing token: {err}"
 
-    # Request a new access token using the refresh token
-    token_params = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'refresh_token': stored_refresh_token,
-        'grant_type': 'refresh_token',
-    }
+    return redirect(f'{app_url}/get_and_update_items?access_token={new_access_token}&realm_id={realm_id}')
 
-    response = requests.post(token_endpoint, data=token_params)
 
-    if response.status_code == 200:
-        # Successfully obtained a new access token
-        new_access_token = response.json().get('access_token')
+# Route for checking that connections are being reused
+@app.route('/pool_stats')
+def show_pool_stats():
+    return pool_stats()
 
-        # Update the stored access token
-        update_stored_access_token(new_access_token)
-
-        return redirect(f'{app_url}/get_and_update_items?access_token={new_access_token}&realm_id={realm_id}')
-
-    else:
-        # Handle the error case
-        print(f"Error refreshing token: {response.text}")
-        return f"Error refreshing token: {response.text}"
+# Route for Prometheus to scrape latency, status code, entity and byte counters
+@app.route('/metrics')
+def show_metrics():
+    return render_metrics(), 200, {'Content-Type': metrics_content_type}
 
 
 ##############################################################################################
 # Get Items Starts Here
 
 # New Flask route for performing the API request
+# The response is streamed while the items arrive, so the first bytes go out after the first QBO page whatever
+# the size of the catalog. output picks what is streamed:
+#   html    the items of every page as they are exported, then a summary with the download link (default)
+#   ndjson  every item as one line of JSON, nothing is exported
+#   page    a single page as JSON, page=N picks it and next links to the following one
 @app.route('/get_items')
 def get_items():
     # Get realm_id and access_token from the query parameters or session
@@ -164,145 +148,289 @@ def get_items():
     if not realm_id or not access_token:
         return 'Realm ID or Access Token not provided in the request parameters.', 400
 
-    # Call the API function with the obtained tokens
-    api_response = make_items_api_request(realm_id, access_token)
+    # Page size for the query, QBO allows at most 1000 per page
+    max_results = request.args.get('max_results', default=max_page_size, type=int)
+    if not 1 <= max_results <= max_page_size:
+        return f'max_results must be between 1 and {max_page_size}.', 400
 
-    if api_response and 'error' in api_response:
-        return f"Error in API call: {api_response['error']['code']}, {api_response['error']['message']}", 500
+    output = request.args.get('output', 'html')
 
-    else:
-        # Display the API response data
-        return f'''
-                   <h1>Get Items API Response</h1>
+    if output == 'page':
+        return get_items_page(realm_id, access_token, request.args.get('page', default=1, type=int), max_results)
+
+    if output == 'ndjson':
+        return Response(stream_items_ndjson(realm_id, access_token, max_results), mimetype='application/x-ndjson')
+
+    if output != 'html':
+        return f"Unknown output '{output}', choose one of html, ndjson or page.", 400
+
+    # Export format, one of csv, csv.gz, ndjson, ndjson.gz or sqlite
+    export_format = request.args.get('format', 'csv')
+    try:
+        export_path(f'{realm_id}_items_data', export_format)
+    except ValueError as err:
+        return str(err), 400
+
+    return Response(stream_items_html(realm_id, access_token, max_results, export_format), mimetype='text/html')
+
+
+# Generator of the HTML page of /get_items, one block per page of items as it is exported
+def stream_items_html(realm_id, access_token, max_results, export_format):
+    yield '<h1>Get Items API Response</h1>\n'
+
+    export_stats = {}
+    try:
+        for page_number, page in enumerate(export_item_pages(realm_id, access_token, export_stats,
+                                                             max_results=max_results, export_format=export_format),
+                                           start=1):
+            items_text = '\n'.join(json.dumps(item, separators=(',', ':')) for item in page)
+            yield f'<h2>Page {page_number}: {len(page)} items</h2>\n<pre>{html.escape(items_text)}</pre>\n'
+    except Exception as err:
+        error = api_error(err)['error']
+        yield f"<p>Error in API call: {error['code']}, {html.escape(error['message'])}</p>\n"
+        return
+
+    download_url = f"{urljoin(app_url, '/download_items')}?realm_id={realm_id}&format={export_format}"
+    yield f'''
                    <br />
-                   <a href="{urljoin(app_url, '/download_items')}?realm_id={realm_id}">Download Items Data</a>
+                   <a href="{download_url}">Download Items Data</a>
                    <br />
-                   <pre>{json.dumps(api_response, indent=2)}</pre>
+                   <pre>{json.dumps(export_stats, indent=2)}</pre>
+               '''
 
 
-               '''
+# Generator of the /get_items NDJSON stream, one item per line as every page arrives
+# Items are sent as QBO returns them, and a failure after the stream started is sent as a last {"error": ...} line
+def stream_items_ndjson(realm_id, access_token, max_results):
+    try:
+        for page in query_pages(base_url, realm_id, access_token, 'Item', minorversion, max_results=max_results):
+            yield ''.join(json.dumps(item, separators=(',', ':')) + '\n' for item in page)
+    except Exception as err:
+        yield json.dumps(api_error(err)) + '\n'
+
+
+# Function to answer /get_items?output=page with one page of items as JSON
+def get_items_page(realm_id, access_token, page_number, max_results):
+    if page_number < 1:
+        return 'page must be 1 or more.', 400
+
+    try:
+        page = query_page(base_url, realm_id, access_token, 'Item', minorversion, page_number,
+                          max_results=max_results)
+    except Exception as err:
+        api_response = api_error(err)
+        return f"Error in API call: {api_response['error']['code']}, {api_response['error']['message']}", 500
+
+    # A full page may be followed by another one
+    next_url = None
+    if len(page) == max_results:
+        next_url = (f"{urljoin(app_url, '/get_items')}?realm_id={realm_id}&access_token={access_token}"
+                    f"&output=page&page={page_number + 1}&max_results={max_results}")
+
+    return {'page': page_number, 'max_results': max_results, 'count': len(page), 'items': page, 'next': next_url}
+
+
+# Specify the order of columns in the items export
+item_columns = [
+    'FullyQualifiedName', 'domain', 'Id', 'Name', 'TrackQtyOnHand', 'Type',
+    'PurchaseCost', 'QtyOnHand', 'IncomeAccountRef_name', 'IncomeAccountRef_value',
+    'AssetAccountRef_name', 'AssetAccountRef_value', 'Taxable',
+    'MetaData_CreateTime', 'MetaData_LastUpdatedTime', 'sparse', 'Active',
+    'SyncToken', 'InvStartDate', 'UnitPrice', 'ExpenseAccountRef_name',
+    'ExpenseAccountRef_value', 'PurchaseDesc', 'Description',
+]
+
+
+# Function to turn an item into a CSV row in the order of item_columns
+def item_to_row(item):
+    # Handle nested fields
+    asset_account_ref = item.get('AssetAccountRef', {})
+    income_account_ref = item.get('IncomeAccountRef', {})
+    expense_account_ref = item.get('ExpenseAccountRef', {})
+
+    # Write the values in the same order as the columns, 'Description' may be missing
+    return [
+        str(item.get('FullyQualifiedName', '')),
+        str(item.get('domain', '')),
+        str(item.get('Id', '')),
+        str(item.get('Name', '')),
+        str(item.get('TrackQtyOnHand', '')),
+        str(item.get('Type', '')),
+        str(item.get('PurchaseCost', '')),
+        str(item.get('QtyOnHand', '')),
+        str(income_account_ref.get('name', '')),
+        str(income_account_ref.get('value', '')),
+        str(asset_account_ref.get('name', '')),
+        str(asset_account_ref.get('value', '')),
+        str(item.get('Taxable', '')),
+        str(item.get('MetaData', {}).get('CreateTime', '')),
+        str(item.get('MetaData', {}).get('LastUpdatedTime', '')),
+        str(item.get('sparse', '')),
+        str(item.get('Active', '')),
+        str(item.get('SyncToken', '')),
+        str(item.get('InvStartDate', '')),
+        str(item.get('UnitPrice', '')),
+        str(expense_account_ref.get('name', '')),
+        str(expense_account_ref.get('value', '')),
+        str(item.get('PurchaseDesc', '')),
+        str(item.get('Description', '')),
+    ]
+
+
+# Function to turn an exception raised by an API call into an error dict
+def api_error(err):
+    if isinstance(err, requests.exceptions.HTTPError):
+        return {'error': {'code': err.response.status_code, 'message': str(err)}}
+    if isinstance(err, json.JSONDecodeError):
+        print(f"Error decoding JSON response: {err}")
+        return {'error': {'code': 500, 'message': 'Error decoding JSON response'}}
+    return {'error': {'code': 500, 'message': str(err)}}
+
+
+# Generator that exports the items page by page, yielding each page once it is in the export file and the
+# entity mirror, so callers can pass the pages on as they arrive
+# export_stats is filled in with the item count, mirrored changes, export path and page timings as it goes
+# export_format picks the sink: csv, csv.gz, ndjson, ndjson.gz or sqlite
+def export_item_pages(realm_id, access_token, export_stats, max_results=max_page_size, export_format='csv'):
+    # Specify the export file path
+    export_name = f'{realm_id}_items_data'
+    export_stats.update({'count': 0, 'changed': 0, 'export_path': export_path(export_name, export_format),
+                         'pages': []})
+
+    # Write the data to the export file
+    with make_sink(export_format, export_name, item_columns, item_to_row, 'items') as sink:
+        # Write each page to the export file as it arrives
+        # Only the fields behind the export columns are fetched, which still covers every field the
+        # update diff compares
+        for page in query_pages(base_url, realm_id, access_token, 'Item', minorversion,
+                                max_results=max_results, page_timings=export_stats['pages'],
+                                fields=export_fields(export_format, item_columns)):
+            # Only items whose SyncToken or LastUpdatedTime changed are written to the mirror
+            export_stats['changed'] += get_entity_mirror().upsert_many(realm_id, 'Item', page)
+
+            sink.write_many(page)
+            export_stats['count'] += len(page)
+            yield page
+
+    entities_exported.inc(export_stats['count'], entity='Item')
+
+    if export_stats['count']:
+        print(f"Data exported to file: {export_stats['export_path']} "
+              f"({export_stats['changed']} items changed since the last fetch)")
+    else:
+        print("No items data in the response.")
 
 
 # Function to make the Get Items API call
-def make_items_api_request(realm_id, access_token):
+# Items are streamed page by page straight into the export file, so memory stays flat for large catalogs
+# Every page is also saved in the local entity mirror, which is where the SyncTokens come from
+# export_format picks the sink: csv, csv.gz, ndjson, ndjson.gz or sqlite
+def make_items_api_request(realm_id, access_token, max_results=max_page_size, export_format='csv'):
     try:
-        # Set the headers for the request
-        query = "select * from Item"
+        export_stats = {}
+        for _ in export_item_pages(realm_id, access_token, export_stats, max_results=max_results,
+                                   export_format=export_format):
+            pass
 
-        # Construct the complete URL for the API call
-        api_url = f"{base_url}{realm_id}/query?query={query}&minorversion={minorversion}"
+        return export_stats
 
-        # Set the headers for the request
-        api_headers = {
-            'Accept': 'application/json',  # Specify that you want JSON responses
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {access_token}'
-        }
+    except Exception as err:
+        return api_error(err)
 
-        # Make the GET request
-        response = requests.get(api_url, headers=api_headers)
-        response.raise_for_status()  # Raise an HTTPError for bad responses (4xx and 5xx)
 
-        # Check if the response content is empty
-        if not response.content:
-            return {'error': {'code': 500, 'message': 'Empty response content'}}
+# Number of Ids in each IN (...) query when fetching the items whose SyncToken changed
+refetch_chunk_size = 100
 
-        try:
-            # Attempt to parse the response as JSON
-            data = response.json()
-            print("API Response:", data)
-
-            # Check if the 'QueryResponse' key is present in the JSON data
-            if 'QueryResponse' in data:
-                items = data['QueryResponse'].get('Item', [])
-
-                if items:
-                    # Specify the CSV file path
-                    csv_file_path = f'{realm_id}_items_data.csv'
-
-                    # Specify the order of columns
-                    columns = [
-                        'FullyQualifiedName', 'domain', 'Id', 'Name', 'TrackQtyOnHand', 'Type',
-                        'PurchaseCost', 'QtyOnHand', 'IncomeAccountRef_name', 'IncomeAccountRef_value',
-                        'AssetAccountRef_name', 'AssetAccountRef_value', 'Taxable',
-                        'MetaData_CreateTime', 'MetaData_LastUpdatedTime', 'sparse', 'Active',
-                        'SyncToken', 'InvStartDate', 'UnitPrice', 'ExpenseAccountRef_name',
-                        'ExpenseAccountRef_value', 'PurchaseDesc', 'Description',
-                    ]
-
-                    # Write the data to the CSV file
-                    with open(csv_file_path, 'w', newline='', encoding='utf-8') as csv_file:
-                        csv_writer = csv.writer(csv_file)
-
-                        # Write the header row
-                        csv_writer.writerow(columns)
-
-                        # Write each item as a row in the CSV file
-                        for item in items:
-                            # Get the Id and SyncToken from the item
-                            item_id = str(item.get('Id', ''))
-                            sync_token = int(item.get('SyncToken', 0))
-
-                            # Update the last_sync_tokens dictionary
-                            last_sync_tokens[item_id] = sync_token
-
-                            # Handle the case where 'Description' is missing
-                            item['Description'] = item.get('Description', '')
-
-                            # Handle nested fields
-                            asset_account_ref = item.get('AssetAccountRef', {})
-                            income_account_ref = item.get('IncomeAccountRef', {})
-                            expense_account_ref = item.get('ExpenseAccountRef', {})
-
-                            # Write the values in the specified order
-                            row_values = [
-                                str(item.get('FullyQualifiedName', '')),
-                                str(item.get('domain', '')),
-                                str(item.get('Id', '')),
-                                str(item.get('Name', '')),
-                                str(item.get('TrackQtyOnHand', '')),
-                                str(item.get('Type', '')),
-                                str(item.get('PurchaseCost', '')),
-                                str(item.get('QtyOnHand', '')),
-                                str(income_account_ref.get('name', '')),
-                                str(income_account_ref.get('value', '')),
-                                str(asset_account_ref.get('name', '')),
-                                str(asset_account_ref.get('value', '')),
-                                str(item.get('Taxable', '')),
-                                str(item.get('MetaData', {}).get('CreateTime', '')),
-                                str(item.get('Active', '')),
-                                str(item.get('InvStartDate', '')),
-                                str(item.get('UnitPrice', '')),
-                                str(expense_account_ref.get('name', '')),
-                                str(expense_account_ref.get('value', '')),
-                                str(item.get('PurchaseDesc', '')),
-                                str(item.get('Description', '')),
-                            ]
-                            csv_writer.writerow(row_values)
-
-                    # Save the last_sync_tokens to the file after processing
-                    with open(last_sync_tokens_file, 'w') as file:
-                        json.dump(last_sync_tokens, file)
-
-                    print(f"Data exported to CSV file: {csv_file_path}")
-
-                else:
-                    print("No items data in the response.")
-            else:
-                print("Unexpected JSON format in the response.")
-
-            return data
-        except json.JSONDecodeError as json_err:
-            print(f"Error decoding JSON response: {json_err}")
-            print("Response Content:", response.content.decode('utf-8'))
-            return {'error': {'code': 500, 'message': 'Error decoding JSON response'}}
+
+# Function to bring the SyncTokens in the entity mirror up to date without exporting the whole catalog
+# Only Id and SyncToken are fetched for every item, then the full item is fetched again just for the items
+# that are new or whose SyncToken changed since they were mirrored, so the diff never compares against a
+# stale copy
+def refresh_item_sync_tokens(realm_id, access_token, max_results=max_page_size):
+    try:
+        started = time.perf_counter()
+        page_timings = []
+        item_count = 0
+        stale_ids = []
+
+        for page in query_pages(base_url, realm_id, access_token, 'Item', minorversion, max_results=max_results,
+                                page_timings=page_timings, fields=['Id', 'SyncToken']):
+            known = get_entity_mirror().get_sync_tokens(realm_id, 'Item', [item['Id'] for item in page])
+            stale_ids.extend(
+                str(item['Id']) for item in page
+                if known.get(str(item['Id'])) != int(item.get('SyncToken', 0))
+            )
+            item_count += len(page)
+
+        refetch_items(realm_id, access_token, stale_ids)
+
+        seconds = time.perf_counter() - started
+        print(f"Checked the SyncTokens of {item_count} items in {seconds:.2f}s, "
+              f"{len(stale_ids)} items fetched again")
+
+        return {'count': item_count, 'changed': len(stale_ids), 'seconds': seconds, 'pages': page_timings}
 
     except requests.exceptions.HTTPError as http_err:
-        return {'error': {'code': response.status_code, 'message': str(http_err)}}
+        return {'error': {'code': http_err.response.status_code, 'message': str(http_err)}}
+    except json.JSONDecodeError as json_err:
+        print(f"Error decoding JSON response: {json_err}")
+        return {'error': {'code': 500, 'message': 'Error decoding JSON response'}}
     except Exception as err:
         return {'error': {'code': 500, 'message': str(err)}}
 
 
+# Function to fetch some items again in full and save them in the entity mirror, refetch_chunk_size Ids per query
+def refetch_items(realm_id, access_token, item_ids):
+    for start in range(0, len(item_ids), refetch_chunk_size):
+        chunk = item_ids[start:start + refetch_chunk_size]
+        for page in query_pages(base_url, realm_id, access_token, 'Item', minorversion,
+                                fields=export_fields('csv', item_columns), where=[('Id', 'in', chunk)]):
+            get_entity_mirror().upsert_many(realm_id, 'Item', page)
+
+
+# Function to bring the mirrored copies of the items of one CSV chunk up to date before they are diffed
+# A single Id/SyncToken query covers every mirrored Id of the chunk, and only the items whose SyncToken moved
+# are fetched again, so the cost follows the number of CSV rows and not the size of the catalog
+# Returns the Ids that are mirrored but were not returned, their mirrored copy cannot be trusted
+def refresh_mirrored_items(realm_id, access_token, item_ids):
+    known = get_entity_mirror().get_sync_tokens(realm_id, 'Item', item_ids)
+    if not known:
+        return set()
+
+    current = {}
+    for page in query_pages(base_url, realm_id, access_token, 'Item', minorversion, fields=['Id', 'SyncToken'],
+                            where=[('Id', 'in', list(known))]):
+        current.update((str(item['Id']), int(item.get('SyncToken', 0))) for item in page)
+
+    stale_ids = [item_id for item_id, sync_token in current.items() if known[item_id] != sync_token]
+    refetch_items(realm_id, access_token, stale_ids)
+    if stale_ids:
+        print(f"{len(stale_ids)} items changed since they were mirrored, fetched them again")
+
+    return known.keys() - current.keys()
+
+
+# Function to fill the entity mirror with every item of the realm, with the same paged query as an export but
+# without writing an export file
+def fill_item_mirror(realm_id, access_token, max_results=max_page_size):
+    try:
+        started = time.perf_counter()
+        item_count = 0
+
+        for page in query_pages(base_url, realm_id, access_token, 'Item', minorversion, max_results=max_results,
+                                fields=export_fields('csv', item_columns)):
+            get_entity_mirror().upsert_many(realm_id, 'Item', page)
+            item_count += len(page)
+
+        seconds = time.perf_counter() - started
+        print(f"Mirrored {item_count} items in {seconds:.2f}s")
+
+        return {'count': item_count, 'seconds': seconds}
+
+    except Exception as err:
+        return api_error(err)
+
+
 @app.route('/download_items')
 def download_items():
     # Get realm_id from the query parameters or session
@@ -311,11 +439,14 @@ def download_items():
     if not realm_id:
         return 'Realm ID not provided in the request parameters.', 400
 
-    # Specify the CSV file path based on realm_id
-    csv_file_path = f'{realm_id}_items_data.csv'
+    # Specify the export file path based on realm_id and the export format
+    try:
+        export_file_path = export_path(f'{realm_id}_items_data', request.args.get('format', 'csv'))
+    except ValueError as err:
+        return str(err), 400
 
     # Download the file
-    return send_file(csv_file_path, as_attachment=True)
+    return send_file(export_file_path, as_attachment=True)
 
 
 # Get Items ends here
@@ -326,33 +457,409 @@ def download_items():
 # Assuming you have a CSV file named 'items.csv' with headers matching the JSON response
 csv_file_path = 'items.csv'
 
-# Initialize a dictionary to store the last used SyncToken for each item
-last_sync_tokens = {}
+# Local SQLite copy of the items, holding the last known SyncToken of every item in every realm
+# It is opened on first use, so importing this module does not touch the disk
+entity_mirror_path = 'qbo_mirror.db'
+entity_mirror = None
+entity_mirror_lock = threading.Lock()
+
+
+# Function to get the entity mirror, opening it the first time it is needed
+def get_entity_mirror():
+    global entity_mirror
+    if entity_mirror is None:
+        with entity_mirror_lock:
+            if entity_mirror is None:
+                entity_mirror = EntityMirror(entity_mirror_path)
+    return entity_mirror
+
+# Number of CSV rows read and diffed together
+csv_chunk_size = 500
+
 
-# Path to the file where the last_sync_tokens will be saved
-last_sync_tokens_file = 'last_sync_tokens.json'
+# Function to fetch every account of a realm for the account cache
+def fetch_accounts(realm_id, access_token):
+    return query_entities(base_url, realm_id, access_token, 'Account', minorversion, fields=account_index_fields)
 
-# Load last_sync_tokens from the file if it exists
-try:
-    with open(last_sync_tokens_file, 'r') as file:
-        last_sync_tokens = json.load(file)
-except FileNotFoundError:
-    pass
 
-# Function to read item data from CSV
-def read_item_data_from_csv(csv_file):
+# Accounts of every realm indexed by Id, Name and FullyQualifiedName, so CSV rows can give account names
+# The chart of accounts is fetched once an hour at most, and an accounts export from GetAccounts counts as a fetch
+account_cache = AccountCache(fetch_accounts, ttl_seconds=3600, get_mirror=get_entity_mirror)
+
+
+# Function to get the file the rows of a run that fail validation are listed in, next to the CSV file
+# Every realm and CSV file gets its own report, so runs going at the same time do not overwrite each other's
+def rejection_report_path(realm_id, csv_file):
+    csv_dir, csv_name = os.path.split(csv_file)
+    return os.path.join(csv_dir, f"{realm_id}_{os.path.splitext(csv_name)[0]}_rejections.csv")
+
+
+# Function to read item data from CSV in chunks of (row_number, row) pairs
+# Only one chunk is in memory at a time, and rows before start_row are skipped so a run can be resumed
+# Row numbers match the CSV file, the header is row 1
+def read_item_data_from_csv(csv_file, start_row=2, chunk_size=csv_chunk_size):
     with open(csv_file, newline='', encoding='utf-8') as csvfile:
         reader = csv.DictReader(csvfile)
-        return list(reader)
 
+        chunk = []
+        for row_number, csv_item in enumerate(reader, start=2):
+            if row_number < start_row:
+                continue
 
-# Function to update an item
-@app.route('/update_items')
-def update_item():
-    # Retrieve parameters from the request
-    access_token = request.args.get('access_token')
-    realm_id = request.args.get('realm_id')
+            chunk.append((row_number, csv_item))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+
+# Function to count the CSV rows a run starting at start_row will read, for the progress of a background job
+def count_csv_rows(csv_file, start_row=2):
+    with open(csv_file, newline='', encoding='utf-8') as csvfile:
+        row_count = sum(1 for _ in csv.DictReader(csvfile))
+    return max(0, row_count - (start_row - 2))
+
+
+# Rows of an update run that are finished, so an interrupted run can be resumed without leaving a row out
+# A row is finished once it is skipped, rejected or its update has a result. Rows already read but still waiting
+# for a full batch or a free worker are not, they go in in_flight until their result is recorded
+class RowProgress:
+    def __init__(self, start_row=2):
+        self.last_read = start_row - 1
+        self.in_flight = set()
+        self.lock = threading.Lock()
+
+    # Function to record that a row was read, sent=True when its update still has to go out
+    def read(self, row_number, sent=False):
+        with self.lock:
+            if sent:
+                self.in_flight.add(row_number)
+            self.last_read = row_number
+
+    # Function to record the result of a row that was sent
+    def finish(self, row_number):
+        with self.lock:
+            self.in_flight.discard(row_number)
+
+    # Function to get the highest row that every row before it is finished too, the run resumes after it
+    def last_finished(self):
+        with self.lock:
+            if self.in_flight:
+                return min(self.in_flight) - 1
+            return self.last_read
+
+
+# Columns of the CSV copied as they are into the update body of an item that is not in the entity mirror
+full_update_fields = ['FullyQualifiedName', 'domain', 'Name', 'TrackQtyOnHand', 'Type', 'PurchaseCost', 'QtyOnHand',
+                      'Taxable', 'Active', 'InvStartDate', 'UnitPrice', 'PurchaseDesc', 'Description']
+
+
+# Function to build the update request body for one CSV row
+# When the server copy of the item is known, only the changed fields are sent and None is returned
+# if nothing changed
+def build_item_update_body(realm_id, csv_item, known_item=None):
+    item_id_to_update = csv_item['Id']
+
+    if known_item is not None and known_item['data']:
+        return build_sparse_update(csv_item, known_item['data'])
+
+    # Get the last known SyncToken for the item, falling back to the one in the CSV if the item was never mirrored
+    # A stale token is not fatal, the update is sent again with the current one
+    new_sync_token = get_entity_mirror().get_sync_token(realm_id, 'Item', item_id_to_update,
+                                                        default=csv_item.get('SyncToken') or 0)
+
+    # Replace the original line with the following code
+    current_datetime = datetime.now(timezone(timedelta(hours=-8)))  # Adjust the timezone offset as needed
+    formatted_last_updated_time = current_datetime.strftime("%Y-%m-%dT%H:%M:%S%z")
+
+    # Manually insert the colon in the timezone offset
+    formatted_last_updated_time = f"{formatted_last_updated_time[:-2]}:{formatted_last_updated_time[-2:]}"
+
+    # Include SyncToken from CSV in the json_response
+    # True/False values must be all lower case
+    # Only the columns the CSV has are sent, so a CSV with just Id and UnitPrice still makes a valid sparse update
+    json_response = {
+        "Id": csv_item['Id'],
+        "sparse": 'true',
+        "SyncToken": new_sync_token,
+        "MetaData": {
+            "LastUpdatedTime": formatted_last_updated_time
+        },
+    }
+    for field in full_update_fields:
+        if csv_item.get(field) is not None:
+            json_response[field] = csv_item[field]
+    for prefix in item_account_refs:
+        if csv_item.get(f'{prefix}_value') is not None:
+            json_response[prefix] = {"value": csv_item[f'{prefix}_value']}
+    if csv_item.get('MetaData_CreateTime') is not None:
+        json_response['MetaData']['CreateTime'] = csv_item['MetaData_CreateTime']
+
+    return json_response
+
+
+# Function to turn chunks of CSV rows into (row_number, update body, CSV row) triples, skipping rows that match the
+# server. The CSV row comes with the body so a stale update can be built again against the current item
+# The server copies of a whole chunk are looked up in the entity mirror with one query
+# Account names in rows without account Ids are resolved through the account cache, then every row is validated
+# locally. Rows that do not resolve or validate are not sent and are added to diff_stats['rejected'] instead
+# Before a chunk is diffed, the SyncTokens of its mirrored items are checked against QBO, see refresh_mirrored_items
+# diff_stats counts the rows that were sent and skipped, diff_stats['rows'] is the RowProgress of the run and
+# diff_stats['last_row'] the last finished row when the chunk was read
+# If on_chunk is given, it is called with diff_stats after every chunk
+def item_updates_from_csv(realm_id, item_chunks, diff_stats, use_diff=True, access_token=None, on_chunk=None):
+    # The accounts are fetched at most once per run, if that fails every row that needs them is rejected with
+    # the reason instead of the whole run stopping
+    account_fetch_errors = []
+
+    def get_account_index():
+        if account_fetch_errors:
+            raise account_fetch_errors[0]
+        try:
+            return account_cache.get(realm_id, access_token)
+        except Exception as err:
+            print(f"Error fetching the accounts of realm {realm_id}: {err}")
+            account_fetch_errors.append(AccountFetchError(f"accounts could not be fetched: {err}"))
+            raise account_fetch_errors[0]
+
+    # An item may only be updated once per run, a second update would fail with a stale SyncToken
+    seen_ids = set()
+
+    for chunk in item_chunks:
+        known_items = {}
+        if use_diff:
+            chunk_ids = [str(csv_item.get('Id') or '').strip() for _, csv_item in chunk]
+
+            # A copy that could not be checked is not used, those rows are sent whole and a stale SyncToken is
+            # retried like for an item that was never mirrored
+            try:
+                unchecked_ids = refresh_mirrored_items(realm_id, access_token,
+                                                       [item_id for item_id in chunk_ids if item_id])
+            except Exception as err:
+                print(f"Error checking the mirrored items of CSV rows {chunk[0][0]}-{chunk[-1][0]}: {err}")
+                unchecked_ids = set(chunk_ids)
+
+            known_items = get_entity_mirror().get_many(realm_id, 'Item', set(chunk_ids) - unchecked_ids)
+
+        for row_number, csv_item in chunk:
+            item_id = str(csv_item.get('Id') or '').strip()
+            known_item = known_items.get(item_id)
+
+            try:
+                csv_item, errors = resolve_item_account_refs(csv_item, get_account_index)
+                errors += validate_item_row(csv_item, known_item, get_account_index)
+            except AccountFetchError as err:
+                errors = [str(err)]
+
+            if item_id in seen_ids:
+                errors.append(f"Id: item {item_id} already updated by an earlier row")
+            seen_ids.add(item_id)
+
+            if errors:
+                diff_stats['rejected'].append({'row': row_number, 'Id': item_id, 'status': 'error',
+                                               'error': '; '.join(errors)})
+                diff_stats['rows'].read(row_number)
+                continue
+
+            json_response = build_item_update_body(realm_id, csv_item, known_item)
+
+            if json_response is None:
+                diff_stats['unchanged'] += 1
+                diff_stats['rows'].read(row_number)
+                continue
+
+            diff_stats['changed'] += 1
+            diff_stats['rows'].read(row_number, sent=True)
+            yield row_number, json_response, csv_item
+
+        diff_stats['last_row'] = diff_stats['rows'].last_finished()
+        print(f"Read CSV rows {chunk[0][0]}-{chunk[-1][0]}")
+        if on_chunk is not None:
+            on_chunk(diff_stats)
+
+
+# Function to add the results of an update run to the /metrics counters
+def count_item_updates(results, failures):
+    entities_updated.inc(sum(1 for result in results if result['status'] == 'ok'), entity='Item', status='ok')
+    entities_updated.inc(len(failures), entity='Item', status='error')
+
+
+# Function to update items in groups through the QBO /batch endpoint
+# Every batch request counts against the realm's shared rate limit
+# If on_result is given, it is called with the result of every row as soon as its batch is done
+def batch_update_items(realm_id, headers, item_updates, batch_size=max_batch_size,
+                       requests_per_minute=default_requests_per_minute, on_result=None):
+    limiter = get_realm_limiter(realm_id, requests_per_minute)
+
+    # The CSV rows of the updates still in flight, a stale update is built again from its row
+    csv_rows = {}
+
+    def rows():
+        for row_number, json_response, csv_item in item_updates:
+            csv_rows[row_number] = csv_item
+            yield row_number, json_response
+
+    def finish_row(result):
+        csv_rows.pop(result['row'], None)
+        if on_result is not None:
+            on_result(result)
+
+    # Every updated item comes back with its new SyncToken, which goes straight into the entity mirror
+    def save_updated_item(result, item):
+        if item:
+            get_entity_mirror().upsert(realm_id, 'Item', item)
+
+    # A row sent with a stale SyncToken is read again and sent on its own, the read and the resend each take
+    # their own request from the realm's rate budget
+    def retry_stale_row(result, body, errors):
+        if is_stale_object_error(errors):
+            with limiter.slot():
+                retried = retry_stale_update(realm_id, headers, result['row'], csv_rows[result['row']], body['Id'],
+                                             limiter=limiter)
+            result.clear()
+            result.update(retried)
+
+    results = batch_update(base_url, realm_id, headers, 'Item', rows(), minorversion, batch_size=batch_size,
+                           limiter=limiter, on_success=save_updated_item, on_error=retry_stale_row,
+                           on_result=finish_row)
+
+    failures = [result for result in results if result['status'] == 'error']
+    for failure in failures:
+        print(f"Error updating item with ID {failure['Id']} (CSV row {failure['row']}): {failure['error']}")
+
+    count_item_updates(results, failures)
+    updated = sum(1 for result in results if result['status'] == 'ok')
+    print(f"Batch update finished: {updated} updated, {len(failures)} failed")
+
+    return results, failures
+
+
+# Function to read the current copy of one item from QBO, or None if it cannot be read
+def read_item(realm_id, headers, item_id):
+    url = urljoin(base_url, f"{realm_id}/item/{item_id}?minorversion={minorversion}")
+
+    response = get_session().get(url, headers=headers)
+    if response.status_code != 200:
+        print(f"Error reading item with ID {item_id}: {response.text}")
+        return None
+
+    return response.json().get('Item')
+
+
+# Function to send an update again after QBO rejected it with a Stale Object Error (5010)
+# Only this one item is read again and goes into the entity mirror, then the update is built again from the CSV
+# row against the current copy, so changes made elsewhere in the meantime are not overwritten. A run never needs
+# the whole catalog fetched first
+# If the current copy already matches the CSV row, nothing is sent and the row is reported as unchanged
+# The read and the resend are two more calls, so with a limiter each of them takes a request from the realm's
+# budget, the caller is expected to hold one of the limiter's slots
+def retry_stale_update(realm_id, headers, row_number, csv_item, item_id, limiter=None):
+    upstream_retries.inc(call='update', reason='stale_object')
+
+    if limiter is not None:
+        limiter.spend()
+    current_item = read_item(realm_id, headers, item_id)
+    if current_item is None:
+        return {'row': row_number, 'Id': item_id, 'status': 'error',
+                'error': f'Stale SyncToken, and item {item_id} could not be read again'}
+
+    get_entity_mirror().upsert(realm_id, 'Item', current_item)
+
+    json_response = build_sparse_update(csv_item, current_item)
+    if json_response is None:
+        print(f"Item with ID {item_id} changed since it was mirrored and already matches CSV row {row_number}")
+        return {'row': row_number, 'Id': item_id, 'status': 'unchanged'}
 
+    print(f"Item with ID {item_id} changed since it was mirrored, sending the update again with SyncToken "
+          f"{current_item['SyncToken']}")
+
+    if limiter is not None:
+        limiter.spend()
+    return update_single_item(realm_id, headers, row_number, json_response)
+
+
+# Function to send the update for a single CSV row
+# The updated item QBO returns is saved in the entity mirror, so the next update of it already has its SyncToken
+# When the CSV row is given, a Stale Object Error is retried once against the item's current copy
+# limiter is passed on to the retry, see retry_stale_update
+# Returns a result dict in the same shape as the batch results
+def update_single_item(realm_id, headers, row_number, json_response, csv_item=None, limiter=None):
+    item_id_to_update = json_response['Id']
+
+    update_item_endpoint = f"{realm_id}/item/?minorversion={minorversion}"
+
+    url = urljoin(base_url, update_item_endpoint)
+
+    # Print URL
+    print(f"{url}")
+
+    # Print the full request body
+    print(f"Request Body for Item ID {item_id_to_update}: {json.dumps(json_response, indent=2)}")
+
+    # Make the POST request for updating the item
+    response = get_session().post(url, headers=headers, data=json.dumps(json_response))
+
+    if response.status_code == 200:
+        # Successfully updated the item
+        updated_item = response.json().get('Item')
+        print(f"Item with ID {item_id_to_update} updated successfully: {updated_item}")
+        if updated_item:
+            get_entity_mirror().upsert(realm_id, 'Item', updated_item)
+        return {'row': row_number, 'Id': item_id_to_update, 'status': 'ok'}
+    else:
+        try:
+            errors = response.json().get('Fault', {}).get('Error', [])
+        except ValueError:
+            errors = []
+        if csv_item is not None and is_stale_object_error(errors):
+            return retry_stale_update(realm_id, headers, row_number, csv_item, item_id_to_update, limiter=limiter)
+
+        # Handle the error case
+        print(f"Error updating item with ID {item_id_to_update}: {response.text}")
+        return {'row': row_number, 'Id': item_id_to_update, 'status': 'error', 'error': response.text}
+
+
+# Function to update items one request per row on a thread pool, throttled per realm
+# If on_result is given, it is called with the result of every row as soon as it is known, from the worker thread
+def concurrent_update_items(realm_id, headers, item_updates, workers=1,
+                            requests_per_minute=default_requests_per_minute, on_result=None):
+    # Every task runs holding a slot of this limiter, see run_concurrently
+    limiter = get_realm_limiter(realm_id, requests_per_minute)
+
+    def task(job):
+        row_number, json_response, csv_item = job
+        try:
+            result = update_single_item(realm_id, headers, row_number, json_response, csv_item=csv_item,
+                                        limiter=limiter)
+        except Exception as err:
+            print(f"Error updating item with ID {json_response.get('Id')}: {err}")
+            result = {'row': row_number, 'Id': json_response.get('Id'), 'status': 'error', 'error': str(err)}
+
+        if on_result is not None:
+            on_result(result)
+        return result
+
+    results, stats = run_concurrently(task, item_updates, realm_id,
+                                      max_workers=workers, requests_per_minute=requests_per_minute)
+
+    failures = sorted((result for result in results if result['status'] == 'error'), key=lambda result: result['row'])
+    count_item_updates(results, failures)
+
+    return results, failures, stats
+
+
+# Function to run the updates in a CSV file against one realm
+# Returns a summary dict with the counts, the failed rows and the last finished CSV row, see RowProgress
+# Set refresh_accounts to fetch the chart of accounts again instead of using the cached copy
+# With validate_only the whole file is checked and diffed, but nothing is sent
+# With fill_mirror an entity mirror that has no items for the realm yet is filled first, so the rows are diffed
+# on_result and on_chunk report progress while the run goes, see batch_update_items and item_updates_from_csv
+# on_chunk is called once more when the run is done, with the final last_row
+def run_item_updates(realm_id, access_token, csv_file=csv_file_path, use_batch=False, batch_size=max_batch_size,
+                     workers=1, requests_per_minute=default_requests_per_minute, use_diff=True, start_row=2,
+                     refresh_accounts=False, validate_only=False, fill_mirror=False, on_result=None, on_chunk=None):
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'text/plain',
@@ -361,90 +868,200 @@ def update_item():
 
     }
 
-    # Read item data from CSV
-    item_data_from_csv = read_item_data_from_csv(csv_file_path)
-
-    for csv_item in item_data_from_csv:
-        item_id_to_update = csv_item['Id']
-
-        # Get the last used SyncToken for the item, default to 0 if not found
-        last_sync_token = last_sync_tokens.get(item_id_to_update, 0)
-
-        # Increment the SyncToken for the item
-        new_sync_token = last_sync_token
-
-        # Update the last used SyncToken for the item
-        last_sync_tokens[item_id_to_update] = new_sync_token
-
-        # Replace the original line with the following code
-        current_datetime = datetime.now(timezone(timedelta(hours=-8)))  # Adjust the timezone offset as needed
-        formatted_last_updated_time = current_datetime.strftime("%Y-%m-%dT%H:%M:%S%z")
-
-        # Manually insert the colon in the timezone offset
-        formatted_last_updated_time = f"{formatted_last_updated_time[:-2]}:{formatted_last_updated_time[-2:]}"
-
-        # Include SyncToken from CSV in the json_response
-        # True/False values must be all lower case
-        json_response = {
-            "FullyQualifiedName": csv_item['FullyQualifiedName'],
-            "domain": csv_item['domain'],
-            "Id": csv_item['Id'],
-            "Name": csv_item['Name'],
-            "TrackQtyOnHand": csv_item['TrackQtyOnHand'],
-            "Type": csv_item['Type'],
-            "PurchaseCost": csv_item['PurchaseCost'],
-            "QtyOnHand": csv_item['QtyOnHand'],
-            "IncomeAccountRef": {
-                "value": csv_item['IncomeAccountRef_value']
-            },
-            "AssetAccountRef": {
-                "value": csv_item['AssetAccountRef_value']
-            },
-            "Taxable": csv_item['Taxable'],
-            "MetaData": {
-                "CreateTime": csv_item['MetaData_CreateTime'],
-                "LastUpdatedTime": formatted_last_updated_time
-            },
-            "sparse": 'true',
-            "Active": csv_item['Active'],
-            "SyncToken": new_sync_token,
-            "InvStartDate": csv_item['InvStartDate'],
-            "UnitPrice": csv_item['UnitPrice'],
-            "ExpenseAccountRef": {
-                "value": csv_item['ExpenseAccountRef_value'],
-            },
-            "PurchaseDesc": csv_item['PurchaseDesc'],
-            "Description": csv_item['Description']
-        }
-
-        update_item_endpoint = f"{realm_id}/item/?minorversion={minorversion}"
-
-        url = urljoin(base_url, update_item_endpoint)
-
-        # Print URL
-        print(f"{url}")
-
-        # Print the full request body
-        print(f"Request Body for Item ID {item_id_to_update}: {json.dumps(json_response, indent=2)}")
-
-        # Make the POST request for updating the item
-        response = requests.post(url, headers=headers, data=json.dumps(json_response))
-
-        if response.status_code == 200:
-            # Successfully updated the item
-            print(f"Item with ID {item_id_to_update} updated successfully: {response.json()}")
-        else:
-            # Handle the error case
-            print(f"Error updating item with ID {item_id_to_update}: {response.text}")
-
-    # You can add more logic or redirect as needed
+    started = time.perf_counter()
+
+    if refresh_accounts:
+        account_cache.invalidate(realm_id)
+
+    # Without a filled mirror every row is sent whole, and a stale SyncToken costs a read of that item
+    if fill_mirror and get_entity_mirror().count(realm_id, 'Item') == 0:
+        api_response = fill_item_mirror(realm_id, access_token)
+        if 'error' in api_response:
+            return api_response
+
+    # Read item data from CSV one chunk at a time, the first updates go out as soon as the first chunk is read
+    item_chunks = read_item_data_from_csv(csv_file, start_row=start_row)
+
+    diff_stats = {'changed': 0, 'unchanged': 0, 'last_row': start_row - 1, 'rejected': [],
+                  'rows': RowProgress(start_row)}
+
+    def finish_row(result):
+        diff_stats['rows'].finish(result['row'])
+        if on_result is not None:
+            on_result(result)
+
+    item_updates = item_updates_from_csv(realm_id, item_chunks, diff_stats, use_diff=use_diff,
+                                         access_token=access_token, on_chunk=on_chunk)
+
+    if validate_only:
+        results, failures = [], []
+        calls_avoided = 0
+        for _ in item_updates:
+            pass
+        print(f"Validated CSV: {diff_stats['changed']} rows to send, {diff_stats['unchanged']} unchanged, "
+              f"{len(diff_stats['rejected'])} rejected")
+    elif use_batch:
+        results, failures = batch_update_items(realm_id, headers, item_updates, batch_size=batch_size,
+                                               requests_per_minute=requests_per_minute, on_result=finish_row)
+
+        # Calls avoided is the difference in batch requests between sending every row and sending changed rows
+        total_rows = diff_stats['changed'] + diff_stats['unchanged']
+        calls_avoided = math.ceil(total_rows / batch_size) - math.ceil(diff_stats['changed'] / batch_size)
+        print(f"Skipped {diff_stats['unchanged']} unchanged rows, {calls_avoided} batch requests avoided")
+    else:
+        results, failures, _ = concurrent_update_items(realm_id, headers, item_updates, workers=workers,
+                                                       requests_per_minute=requests_per_minute, on_result=finish_row)
+
+        calls_avoided = diff_stats['unchanged']
+        print(f"Skipped {diff_stats['unchanged']} unchanged rows, {calls_avoided} API calls avoided")
+
+    seconds = time.perf_counter() - started
+    updated = sum(1 for result in results if result['status'] == 'ok')
+
+    diff_stats['last_row'] = diff_stats['rows'].last_finished()
+    if on_chunk is not None:
+        on_chunk(diff_stats)
+
+    # Rows whose stale update was read again and found to match the CSV already
+    unchanged = diff_stats['unchanged'] + sum(1 for result in results if result['status'] == 'unchanged')
+
+    # Rejected rows were never sent, they are reported with the failed updates and written to the rejection report
+    # A report left by an earlier run of the same file is removed when nothing was rejected this time
+    failures = sorted(failures + diff_stats['rejected'], key=lambda result: result['row'])
+    report_path = rejection_report_path(realm_id, csv_file)
+    if diff_stats['rejected']:
+        write_rejection_report(report_path, diff_stats['rejected'])
+        print(f"{len(diff_stats['rejected'])} rows rejected before sending, see {report_path}")
+    elif os.path.exists(report_path):
+        os.remove(report_path)
+
+    return {
+        'updated': updated,
+        'failed': len(failures),
+        'rejected': len(diff_stats['rejected']),
+        'to_send': diff_stats['changed'],
+        'unchanged': unchanged,
+        'calls_avoided': calls_avoided,
+        'last_row': diff_stats['last_row'],
+        'seconds': seconds,
+        'per_second': len(results) / seconds if seconds > 0 else 0.0,
+        'failures': failures,
+        'rejection_report': report_path if diff_stats['rejected'] else None,
+    }
+
+
+# Update runs go to a small pool of background workers, so the routes answer at once instead of holding a
+# request thread for the whole run
+update_jobs = JobQueue(max_jobs=2)
+
+
+# Function to read the update options of a run from the request parameters
+def update_options_from_request():
+    return {
+        # Send the updates through the /batch endpoint when batch=true
+        'use_batch': request.args.get('batch', 'false').lower() == 'true',
+        'batch_size': request.args.get('batch_size', default=max_batch_size, type=int),
+
+        # Number of parallel update requests and the per-realm request budget
+        'workers': request.args.get('workers', default=1, type=int),
+        'requests_per_minute': request.args.get('rate', default=default_requests_per_minute, type=int),
+
+        # Skip rows that match the last known server copy and only send changed fields, unless diff=false
+        'use_diff': request.args.get('diff', 'true').lower() == 'true',
+
+        # CSV row to start from, to resume an interrupted run (the header is row 1)
+        'start_row': max(request.args.get('start_row', default=2, type=int), 2),
+
+        # Account names in the CSV are resolved from a cached chart of accounts, refresh_accounts=true fetches it
+        # again
+        'refresh_accounts': request.args.get('refresh_accounts', 'false').lower() == 'true',
+
+        # With validate_only=true the CSV is only checked, nothing is sent
+        'validate_only': request.args.get('validate_only', 'false').lower() == 'true',
+    }
+
+
+# Allowed range of the numeric update options, as (option, request parameter, lowest, highest)
+update_option_limits = (
+    ('batch_size', 'batch_size', 1, max_batch_size),
+    ('workers', 'workers', 1, default_max_concurrent),
+    ('requests_per_minute', 'rate', 1, default_requests_per_minute),
+)
+
+
+# Function to check the numeric update options before a job is queued, returns an error message or None
+# The rate matters beyond the job itself, it reconfigures the limiter every run against the realm shares
+def invalid_update_options(options):
+    for option, parameter, lowest, highest in update_option_limits:
+        if not lowest <= options[option] <= highest:
+            return f'{parameter} must be between {lowest} and {highest}, got {options[option]}.'
+    return None
+
+
+# Function to queue an update run of the CSV file as a background job
+# fill_mirror is passed on to run_item_updates
+def start_update_job(kind, realm_id, access_token, options, fill_mirror=False):
+    def run(job):
+        # Counted on the worker, so a large file does not hold up the request that queued the job
+        job.set_total_rows(count_csv_rows(csv_file_path, options['start_row']))
+
+        return run_item_updates(
+            realm_id, access_token, csv_file=csv_file_path, fill_mirror=fill_mirror, on_result=job.record_result,
+            on_chunk=lambda stats: job.set_skipped(stats['unchanged'], stats['rejected'], stats['last_row']),
+            **options
+        )
+
+    return update_jobs.submit(kind, realm_id, run)
+
+
+# Function to answer a request that queued a job, with JSON for API clients and a live progress page otherwise
+def job_started_response(job):
+    status_url = urljoin(app_url, f'/update_jobs/{job.id}')
+    events_url = urljoin(app_url, f'/update_jobs/{job.id}/events')
+
+    if request.accept_mimetypes.best == 'application/json':
+        return {'job_id': job.id, 'status_url': status_url, 'events_url': events_url}, 202
+
     return f'''
-                          <h1>Item Updated Successfully</h1>
+                          <h1>Item Update Queued</h1>
+                          <p>Job {job.id}: updates from {csv_file_path} for realm {job.realm_id}</p>
+                          <p><a href="{status_url}">Job status</a> | <a href="{events_url}">Event stream</a></p>
                           <br />
-                          <pre>{json.dumps(json_response, indent=2)}</pre>
+                          <pre id="progress">Waiting for the job to start...</pre>
+                          <script>
+                              const events = new EventSource("{events_url}");
+                              const show = (event) => {{
+                                  const status = JSON.parse(event.data);
+                                  document.getElementById("progress").textContent = JSON.stringify(status, null, 2);
+                              }};
+                              events.addEventListener("progress", show);
+                              events.addEventListener("done", (event) => {{ show(event); events.close(); }});
+                          </script>
+                      ''', 202
+
+
+# Function to update an item
+@app.route('/update_items')
+def update_item():
+    # Retrieve parameters from the request
+    access_token = request.args.get('access_token')
+    realm_id = request.args.get('realm_id')
 
+    if not realm_id or not access_token:
+        return 'Realm ID or Access Token not provided in the request parameters.', 400
+
+    options = update_options_from_request()
+    error = invalid_update_options(options)
+    if error:
+        return error, 400
+    kind = 'validate_items' if options['validate_only'] else 'update_items'
 
-                      '''
+    # The rows are only counted once the job runs, so a missing file is checked here to answer 400 instead of 202
+    if not os.path.exists(csv_file_path):
+        return f'CSV file {csv_file_path} not found.', 400
+
+    job = start_update_job(kind, realm_id, access_token, options)
+    return job_started_response(job)
 
 # New route for getting and updating items
 @app.route('/get_and_update_items')
@@ -456,43 +1073,50 @@ def get_and_update_items():
     if not realm_id or not access_token:
         return 'Realm ID or Access Token not provided in the request parameters.', 400
 
-    # Call the API function with the obtained tokens to get items for updating last_sync_tokens
-    api_response = make_items_api_request(realm_id, access_token)
+    # Updates are diffed against the entity mirror, whose copies are checked chunk by chunk as the CSV is read, so
+    # the job only fetches every item the first time a realm is updated, to fill the mirror
+    options = update_options_from_request()
+    error = invalid_update_options(options)
+    if error:
+        return error, 400
 
-    if api_response and 'error' in api_response:
-        return f"Error in API call: {api_response['error']['code']}, {api_response['error']['message']}", 500
+    if not os.path.exists(csv_file_path):
+        return f'CSV file {csv_file_path} not found.', 400
 
-    # Update last_sync_tokens based on the obtained items data
-    update_last_sync_tokens(api_response)
+    job = start_update_job('get_and_update_items', realm_id, access_token, options, fill_mirror=True)
+    return job_started_response(job)
 
-    # Call the function to update items using data from the CSV file
-    update_response = update_item()
 
-    # You can customize the response based on the results of the API calls
-    return f'''
-        <h1>Update Items</h1>
-        <br />
-        <pre>{update_response}</pre>
-    '''
+# Route listing the update jobs, newest first
+@app.route('/update_jobs')
+def list_update_jobs():
+    return {'jobs': update_jobs.statuses()}
 
-# Function to update last_sync_tokens based on the obtained items data
-def update_last_sync_tokens(api_response):
-    try:
-        items = api_response.get('QueryResponse', {}).get('Item', [])
 
-        for item in items:
-            item_id = str(item.get('Id', ''))
-            sync_token = int(item.get('SyncToken', 0))
-            last_sync_tokens[item_id] = sync_token
+# Route reporting the progress, throughput, ETA and per-row errors of one update job
+@app.route('/update_jobs/<job_id>')
+def show_update_job(job_id):
+    job = update_jobs.get(job_id)
+    if job is None:
+        return 'Unknown job id.', 404
+
+    return job.snapshot(errors_from=request.args.get('errors_from', default=0, type=int))
 
-        # Save the updated last_sync_tokens to the file after processing
-        with open(last_sync_tokens_file, 'w') as file:
-            json.dump(last_sync_tokens, file)
 
-        print("last_sync_tokens updated successfully.")
-    except Exception as e:
-        print(f"Error updating last_sync_tokens: {str(e)}")
+# Route streaming the progress of one update job as Server-Sent Events until it is done
+@app.route('/update_jobs/<job_id>/events')
+def stream_update_job(job_id):
+    job = update_jobs.get(job_id)
+    if job is None:
+        return 'Unknown job id.', 404
+
+    # X-Accel-Buffering stops nginx from holding the events back
+    return Response(job_events(job), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 if __name__ == '__main__':
+    # Automatically open the web browser, only when run as a script so the module can be imported
+    webbrowser.open(app_url)
+
     print('Starting the application...')
     app.run(debug=False)
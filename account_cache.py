@@ -0,0 +1,177 @@
+# account_cache.py
+
+import threading
+import time
+
+# The chart of accounts rarely changes, so a fetched copy is reused for this long
+default_ttl_seconds = 3600
+
+# Account references an item can carry, each one is a _name and a _value column in the items CSV
+item_account_refs = ('IncomeAccountRef', 'AssetAccountRef', 'ExpenseAccountRef')
+
+# The only Account fields an AccountIndex uses, so fetches can select just these
+account_index_fields = ('Id', 'Name', 'FullyQualifiedName')
+
+# Marks a Name shared by several accounts, which can only be told apart by FullyQualifiedName
+ambiguous = object()
+
+
+# Raised when the accounts of a realm cannot be fetched, so the rows that need them can be rejected with the reason
+class AccountFetchError(Exception):
+    pass
+
+
+# Function to normalise a name for lookups, names are matched without regard to case or surrounding spaces
+def name_key(name):
+    return str(name).strip().casefold()
+
+
+# The accounts of one realm indexed by Id, Name and FullyQualifiedName, so a reference resolves in O(1)
+# fetched_at is a Unix time, so an index kept in the entity mirror can be aged by another process
+class AccountIndex:
+    def __init__(self, accounts, fetched_at=None):
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+        self.by_id = {}
+        self.by_name = {}
+        self.by_full_name = {}
+
+        for account in accounts:
+            self.by_id[str(account['Id'])] = account
+            if account.get('FullyQualifiedName'):
+                self.by_full_name[name_key(account['FullyQualifiedName'])] = account
+            if account.get('Name'):
+                key = name_key(account['Name'])
+                self.by_name[key] = ambiguous if key in self.by_name else account
+
+    def __len__(self):
+        return len(self.by_id)
+
+    # Function to find an account by Id, FullyQualifiedName or Name, in that order
+    # Returns (account, None) or (None, error message)
+    def resolve(self, reference):
+        reference = str(reference).strip()
+        if not reference:
+            return None, 'Empty account reference'
+
+        if reference in self.by_id:
+            return self.by_id[reference], None
+
+        key = name_key(reference)
+        if key in self.by_full_name:
+            return self.by_full_name[key], None
+
+        account = self.by_name.get(key)
+        if account is ambiguous:
+            return None, f"Account name '{reference}' matches several accounts, use the FullyQualifiedName"
+        if account is None:
+            return None, f"Unknown account '{reference}'"
+        return account, None
+
+
+# Per-realm cache of AccountIndex objects that are fetched again once they are older than ttl_seconds
+# fetch_accounts(realm_id, access_token) returns an iterable of every Account entity of the realm
+# get_mirror returns the EntityMirror the accounts are kept in, so a fetched index outlives the process and is
+# shared with the other scripts, e.g. an accounts export fills it for the item updates. Without it the indexes
+# only live in memory
+class AccountCache:
+    def __init__(self, fetch_accounts, ttl_seconds=default_ttl_seconds, get_mirror=None):
+        self.fetch_accounts = fetch_accounts
+        self.ttl_seconds = ttl_seconds
+        self.get_mirror = get_mirror
+        self.indexes = {}
+        self.lock = threading.Lock()
+        # One lock per realm, so threads wanting the same realm share a single fetch
+        self.realm_locks = {}
+
+    # Function to check whether a cached index can still be used
+    def fresh(self, index):
+        return index is not None and time.time() - index.fetched_at < self.ttl_seconds
+
+    # Function to get the account index of a realm, fetching the accounts if the cached copy is missing or stale
+    def get(self, realm_id, access_token):
+        index = self.indexes.get(realm_id)
+        if self.fresh(index):
+            return index
+
+        with self.lock:
+            realm_lock = self.realm_locks.setdefault(realm_id, threading.Lock())
+
+        with realm_lock:
+            # Another thread may have fetched the accounts while we were waiting
+            index = self.indexes.get(realm_id)
+            if self.fresh(index):
+                return index
+
+            # Another process may have fetched them not long ago
+            index = self.load(realm_id)
+            if self.fresh(index):
+                self.indexes[realm_id] = index
+                return index
+
+            started = time.perf_counter()
+            index = self.put(realm_id, self.fetch_accounts(realm_id, access_token))
+            print(f"Cached {len(index)} accounts for realm {realm_id} in {time.perf_counter() - started:.2f}s")
+
+            return index
+
+    # Function to read the index of a realm kept in the entity mirror, or None if there is none
+    def load(self, realm_id):
+        if self.get_mirror is None:
+            return None
+
+        mirror = self.get_mirror()
+        fetched_at = mirror.get_fetched_at(realm_id, 'Account')
+        if fetched_at is None:
+            return None
+        return AccountIndex(mirror.get_all(realm_id, 'Account'), fetched_at)
+
+    # Function to store every account of a realm, fetched here or elsewhere, e.g. by an accounts export
+    # Only the fields the index uses are kept
+    def put(self, realm_id, accounts):
+        accounts = [
+            {field: account[field] for field in account_index_fields if field in account}
+            for account in accounts
+        ]
+        index = AccountIndex(accounts)
+
+        if self.get_mirror is not None:
+            self.get_mirror().replace_all(realm_id, 'Account', accounts, fetched_at=index.fetched_at)
+        self.indexes[realm_id] = index
+        return index
+
+    # Function to drop the cached accounts of a realm, or of every realm
+    def invalidate(self, realm_id=None):
+        if realm_id is None:
+            self.indexes.clear()
+        else:
+            self.indexes.pop(realm_id, None)
+
+        if self.get_mirror is not None:
+            self.get_mirror().forget_fetch('Account', realm_id)
+
+
+# Function to fill in the account Ids of a CSV item row from the account names it gives
+# A reference is resolved when its _value column is empty and its _name column is not, and _name may be
+# the account's Name, FullyQualifiedName or Id
+# get_index is only called when a row actually needs resolving, so rows that carry Ids never fetch the accounts
+# Returns the row with the Ids filled in, and a list of error messages for names that could not be resolved
+def resolve_item_account_refs(csv_item, get_index):
+    resolved = None
+    errors = []
+
+    for prefix in item_account_refs:
+        value = (csv_item.get(f'{prefix}_value') or '').strip()
+        name = (csv_item.get(f'{prefix}_name') or '').strip()
+        if value or not name:
+            continue
+
+        account, error = get_index().resolve(name)
+        if error:
+            errors.append(f'{prefix}: {error}')
+            continue
+
+        if resolved is None:
+            resolved = dict(csv_item)
+        resolved[f'{prefix}_value'] = str(account['Id'])
+
+    return (resolved if resolved is not None else csv_item), errors
@@ -0,0 +1,287 @@
+# benchmark.py
+
+import argparse
+import csv
+import json
+import math
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# End-to-end throughput benchmark of the export and update flows against mock_qbo_server.py
+#
+#     python benchmark.py --catalog-size 20000 --latency 0.05 --workers 8
+#
+# The mock server runs in its own process, so peak RSS is the memory of the client code alone
+# Every scenario reports its own peak RSS on Linux, see reset_peak_rss
+# Results are printed and written to benchmark_results.json
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Realm used for every run, the mock generates its catalog on first use
+benchmark_realm_id = '9130350000000000'
+
+# Latency of every upstream call of the running scenario, as (call, seconds)
+call_latencies = []
+
+
+# Function to record the latency of every upstream call, added to the shared session as a response hook
+def record_latency(response, **kwargs):
+    from qbo_metrics import classify_request
+    call_latencies.append((classify_request(response.request), response.elapsed.total_seconds()))
+    return response
+
+
+# Function to get a percentile of a list of numbers, using the nearest rank
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+# Function to get the peak resident memory of this process in MB, since the last reset_peak_rss where it works
+# Linux keeps the peak as VmHWM in /proc/self/status, elsewhere ru_maxrss is the peak of the whole process,
+# in bytes on macOS
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+# Function to start the peak resident memory of a scenario from the memory in use now, and return that
+# Writing 5 to /proc/self/clear_refs resets VmHWM on Linux. Where that cannot be done the peak stays the one
+# of the whole process, so a scenario's growth only shows when it goes above every earlier scenario
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+# Function to start the mock server and wait until it accepts connections
+def start_mock_server(args):
+    command = [
+        sys.executable, os.path.join(script_dir, 'mock_qbo_server.py'), '--port', str(args.port),
+        '--catalog-size', str(args.catalog_size), '--latency', str(args.latency), '--jitter', str(args.jitter),
+        '--requests-per-minute', str(args.server_rate_limit), '--throttle-ratio', str(args.throttle_ratio),
+    ]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', args.port), timeout=0.5):
+                return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError('The mock server exited, is the port already in use?')
+            time.sleep(0.1)
+
+    server.terminate()
+    raise RuntimeError('The mock server did not start within 30 seconds')
+
+
+# Function to write an update CSV from an export, changing the UnitPrice of the first count items
+def write_update_csv(export_csv, update_csv, count, run_number):
+    with open(export_csv, newline='', encoding='utf-8') as source, \
+            open(update_csv, 'w', newline='', encoding='utf-8') as target:
+        reader = csv.DictReader(source)
+        writer = csv.DictWriter(target, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        for number, row in enumerate(reader):
+            if number >= count:
+                break
+            row['UnitPrice'] = f'{float(row["UnitPrice"] or 0) + run_number:.2f}'
+            writer.writerow(row)
+
+
+# Function to get the upstream byte counters, as payload and as sent over the wire
+def byte_totals():
+    from qbo_metrics import (upstream_bytes_sent, upstream_bytes_received, upstream_wire_bytes_sent,
+                             upstream_wire_bytes_received)
+    return {
+        'bytes_sent': upstream_bytes_sent.total(),
+        'wire_bytes_sent': upstream_wire_bytes_sent.total(),
+        'bytes_received': upstream_bytes_received.total(),
+        'wire_bytes_received': upstream_wire_bytes_received.total(),
+    }
+
+
+# Function to run one scenario and collect its numbers
+# run returns the number of items the scenario handled
+def run_scenario(name, run):
+    call_latencies.clear()
+    bytes_before = byte_totals()
+    rss_before = reset_peak_rss()
+
+    started = time.perf_counter()
+    items = run()
+    seconds = time.perf_counter() - started
+    bytes_after = byte_totals()
+
+    latencies = [latency for _, latency in call_latencies]
+    result = {
+        'scenario': name,
+        'items': items,
+        'seconds': seconds,
+        'items_per_second': items / seconds if seconds > 0 else 0.0,
+        'calls': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    # Memory the scenario itself added on top of what earlier scenarios left in use
+    result['rss_growth_mb'] = max(0.0, result['peak_rss_mb'] - rss_before)
+    for counter, total in bytes_after.items():
+        result[counter] = total - bytes_before[counter]
+
+    print(f"{name}: {items} items in {seconds:.2f}s ({result['items_per_second']:.1f} items/s), "
+          f"{result['calls']} calls, p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms, "
+          f"{result['wire_bytes_received'] / 1e6:.2f} MB received ({result['bytes_received'] / 1e6:.2f} MB decoded), "
+          f"{result['wire_bytes_sent'] / 1e6:.2f} MB sent ({result['bytes_sent'] / 1e6:.2f} MB before compression)")
+    return result
+
+
+# Function to run every scenario against a running mock server
+def run_benchmarks(args):
+    # The scripts are pointed at the mock by replacing their module level settings
+    import GetItems
+    import GetAccounts
+    import UpdateItems
+    from qbo_http import configure_session
+    from token_manager import TokenManager
+    from token_store import FileTokenStore
+
+    base_url = f'http://127.0.0.1:{args.port}/v3/company/'
+    token_endpoint = f'http://127.0.0.1:{args.port}/oauth2/v1/tokens/bearer'
+    for module in (GetItems, GetAccounts, UpdateItems):
+        module.base_url = base_url
+        module.token_endpoint = token_endpoint
+
+    session = configure_session(pool_maxsize=max(10, args.workers), compress_min_bytes=args.compress_min_bytes)
+    session.hooks['response'].append(record_latency)
+
+    realm_id = benchmark_realm_id
+    UpdateItems.entity_mirror_path = os.path.join(os.getcwd(), 'qbo_mirror.db')
+
+    store = FileTokenStore(os.path.join(os.getcwd(), 'tokens.json'))
+    store.save(realm_id, {'refresh_token': 'benchmark-refresh-token'})
+    token_manager = TokenManager('benchmark', 'benchmark', 'http://localhost:5000/callback', token_endpoint,
+                                 store=store, realm_id=realm_id)
+
+    # Function to refresh the token refresh_count times
+    def refresh_tokens():
+        for _ in range(args.refresh_count):
+            token_manager.refresh_access_token()
+        return args.refresh_count
+
+    results = [run_scenario('token_refresh', refresh_tokens)]
+    access_token = token_manager.get_access_token()
+
+    # Function to run an export and return its count, failing loudly on an error dict
+    def counted(response):
+        if 'error' in response:
+            raise RuntimeError(f"{response['error']['code']}: {response['error']['message']}")
+        return response.get('count', 0)
+
+    for export_format in args.formats:
+        results.append(run_scenario(
+            f'export_items_{export_format}',
+            lambda: counted(GetItems.make_api_request(realm_id, access_token, export_format=export_format))
+        ))
+
+    results.append(run_scenario(
+        'export_accounts', lambda: counted(GetAccounts.make_api_request(realm_id, access_token))
+    ))
+    results.append(run_scenario(
+        'export_items_to_mirror', lambda: counted(UpdateItems.make_items_api_request(realm_id, access_token))
+    ))
+
+    update_count = min(args.update_count, args.catalog_size)
+    export_csv = f'{realm_id}_items_data.csv'
+    update_modes = [
+        ('update_items_batch', {'use_batch': True}),
+        (f'update_items_{args.workers}_workers', {'workers': args.workers}),
+    ]
+
+    for run_number, (name, options) in enumerate(update_modes, start=1):
+        # Fetch first so the mirror has the current SyncTokens, like /get_and_update_items
+        counted(UpdateItems.make_items_api_request(realm_id, access_token))
+        write_update_csv(export_csv, 'items.csv', update_count, run_number)
+
+        def update(options=options):
+            summary = UpdateItems.run_item_updates(realm_id, access_token, csv_file='items.csv',
+                                                   requests_per_minute=args.client_rate, **options)
+            counted(summary)
+            if summary['failed']:
+                print(f"{summary['failed']} updates failed, first: {summary['failures'][0]['error']}")
+            return summary['updated']
+
+        results.append(run_scenario(name, update))
+
+    return results
+
+
+# Function to print the results as a table
+def print_results(results):
+    print()
+    print(f"{'Scenario':<28} {'Items':>8} {'Seconds':>9} {'Items/s':>10} {'Calls':>7} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'Peak RSS MB':>12} {'RSS +MB':>8} {'MB in':>8} {'MB out':>8}")
+    for result in results:
+        print(f"{result['scenario']:<28} {result['items']:>8} {result['seconds']:>9.2f} "
+              f"{result['items_per_second']:>10.1f} {result['calls']:>7} {result['p50_ms']:>8.1f} "
+              f"{result['p99_ms']:>8.1f} {result['peak_rss_mb']:>12.1f} {result['rss_growth_mb']:>8.1f} "
+              f"{result['wire_bytes_received'] / 1e6:>8.2f} {result['wire_bytes_sent'] / 1e6:>8.2f}")
+
+
+# Function to read the benchmark settings from the command line
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the export and update flows against the mock QBO server.')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--catalog-size', type=int, default=5000, help='items in the mock realm')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the mock adds to every response')
+    parser.add_argument('--jitter', type=float, default=0.01, help='random extra seconds, up to this')
+    parser.add_argument('--server-rate-limit', type=int, default=0,
+                        help='per-realm requests per minute before the mock answers 429, 0 switches it off')
+    parser.add_argument('--throttle-ratio', type=float, default=0.0, help='fraction of requests answered with 429')
+    parser.add_argument('--client-rate', type=int, default=6000, help='requests per minute the client allows itself')
+    parser.add_argument('--workers', type=int, default=8, help='parallel update requests')
+    parser.add_argument('--update-count', type=int, default=1000, help='items changed in every update scenario')
+    parser.add_argument('--refresh-count', type=int, default=20, help='token refreshes to time')
+    parser.add_argument('--compress-min-bytes', type=int, help='gzip update and batch bodies of at least this size')
+    parser.add_argument('--formats', nargs='+', default=['csv', 'ndjson.gz'], help='export formats to time')
+    parser.add_argument('--output', default=os.path.join(script_dir, 'benchmark_results.json'))
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    server = start_mock_server(args)
+    try:
+        # Every file the flows write goes to a scratch directory
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            results = run_benchmarks(args)
+            os.chdir(script_dir)
+    finally:
+        server.terminate()
+        server.wait()
+
+    print_results(results)
+    with open(args.output, 'w') as f:
+        json.dump({'settings': vars(args), 'results': results}, f, indent=2)
@@ -0,0 +1,224 @@
+# entity_mirror.py
+
+import json
+import sqlite3
+import threading
+import time
+
+
+# Local copy of QBO entities in SQLite, keyed by (realm_id, entity, Id)
+# Keeps the SyncToken, LastUpdatedTime and raw JSON of every entity we have seen, so looking up
+# the SyncToken of one item is a single primary key lookup instead of loading a JSON file
+class EntityMirror:
+    def __init__(self, path='qbo_mirror.db'):
+        self.path = path
+        # sqlite3 connections cannot be shared between threads, so each thread gets its own
+        self.local = threading.local()
+
+        self.connection().execute('''
+            CREATE TABLE IF NOT EXISTS entities (
+                realm_id TEXT NOT NULL,
+                entity TEXT NOT NULL,
+                id TEXT NOT NULL,
+                sync_token INTEGER NOT NULL,
+                last_updated_time TEXT,
+                data TEXT,
+                PRIMARY KEY (realm_id, entity, id)
+            ) WITHOUT ROWID
+        ''')
+        # When the whole list of an entity type was last fetched for a realm, for entities that are kept as a set
+        self.connection().execute('''
+            CREATE TABLE IF NOT EXISTS fetches (
+                realm_id TEXT NOT NULL,
+                entity TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (realm_id, entity)
+            ) WITHOUT ROWID
+        ''')
+
+    # Function to get this thread's connection to the database
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    # Function to get the stored copy of one entity, or None if we have never seen it
+    def get(self, realm_id, entity, entity_id):
+        row = self.connection().execute(
+            'SELECT sync_token, last_updated_time, data FROM entities WHERE realm_id = ? AND entity = ? AND id = ?',
+            (str(realm_id), entity, str(entity_id))
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            'SyncToken': row[0],
+            'LastUpdatedTime': row[1],
+            'data': json.loads(row[2]) if row[2] else None,
+        }
+
+    # Function to get the stored copies of many entities with a single query
+    # Returns a dict from Id to the same dict get() returns, entities we have never seen are left out
+    def get_many(self, realm_id, entity, entity_ids):
+        entity_ids = [str(entity_id) for entity_id in entity_ids]
+        if not entity_ids:
+            return {}
+
+        placeholders = ','.join('?' * len(entity_ids))
+        rows = self.connection().execute(
+            f'SELECT id, sync_token, last_updated_time, data FROM entities '
+            f'WHERE realm_id = ? AND entity = ? AND id IN ({placeholders})',
+            [str(realm_id), entity] + entity_ids
+        ).fetchall()
+
+        return {
+            row[0]: {
+                'SyncToken': row[1],
+                'LastUpdatedTime': row[2],
+                'data': json.loads(row[3]) if row[3] else None,
+            }
+            for row in rows
+        }
+
+    # Function to get the last known SyncToken of one entity
+    def get_sync_token(self, realm_id, entity, entity_id, default=0):
+        row = self.connection().execute(
+            'SELECT sync_token FROM entities WHERE realm_id = ? AND entity = ? AND id = ?',
+            (str(realm_id), entity, str(entity_id))
+        ).fetchone()
+
+        return row[0] if row is not None else default
+
+    # Function to get the last known SyncTokens of many entities with a single query, without parsing their JSON
+    # Returns a dict from Id to SyncToken, entities we have never seen are left out
+    def get_sync_tokens(self, realm_id, entity, entity_ids):
+        entity_ids = [str(entity_id) for entity_id in entity_ids]
+        if not entity_ids:
+            return {}
+
+        placeholders = ','.join('?' * len(entity_ids))
+        rows = self.connection().execute(
+            f'SELECT id, sync_token FROM entities WHERE realm_id = ? AND entity = ? AND id IN ({placeholders})',
+            [str(realm_id), entity] + entity_ids
+        ).fetchall()
+
+        return dict(rows)
+
+    # Function to get every stored entity of one type in a realm, as returned by QBO
+    def get_all(self, realm_id, entity):
+        rows = self.connection().execute(
+            'SELECT data FROM entities WHERE realm_id = ? AND entity = ? AND data IS NOT NULL',
+            (str(realm_id), entity)
+        ).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    # Function to count the stored entities of one type in a realm
+    def count(self, realm_id, entity):
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM entities WHERE realm_id = ? AND entity = ?',
+            (str(realm_id), entity)
+        ).fetchone()[0]
+
+    # Function to insert or update entities as returned by QBO
+    # Rows whose SyncToken and LastUpdatedTime have not changed are left alone
+    # Returns the number of rows actually written
+    def upsert_many(self, realm_id, entity, entities):
+        rows = [
+            (
+                str(realm_id), entity, str(item['Id']), int(item.get('SyncToken', 0)),
+                item.get('MetaData', {}).get('LastUpdatedTime'), json.dumps(item),
+            )
+            for item in entities
+        ]
+        if not rows:
+            return 0
+
+        conn = self.connection()
+        changes_before = conn.total_changes
+
+        conn.execute('BEGIN')
+        try:
+            conn.executemany(
+                '''
+                INSERT INTO entities (realm_id, entity, id, sync_token, last_updated_time, data)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(realm_id, entity, id) DO UPDATE SET
+                    sync_token = excluded.sync_token,
+                    last_updated_time = excluded.last_updated_time,
+                    data = excluded.data
+                WHERE entities.sync_token != excluded.sync_token
+                    OR entities.last_updated_time IS NOT excluded.last_updated_time
+                ''',
+                rows
+            )
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+        return conn.total_changes - changes_before
+
+    # Function to insert or update a single entity
+    def upsert(self, realm_id, entity, item):
+        return self.upsert_many(realm_id, entity, [item])
+
+    # Function to remove entities that were deleted in QBO
+    def delete_many(self, realm_id, entity, entity_ids):
+        conn = self.connection()
+        conn.executemany(
+            'DELETE FROM entities WHERE realm_id = ? AND entity = ? AND id = ?',
+            [(str(realm_id), entity, str(entity_id)) for entity_id in entity_ids]
+        )
+
+    # Function to replace every stored entity of one type in a realm with a complete list just fetched from QBO
+    # The time of the fetch is kept with them, see get_fetched_at
+    def replace_all(self, realm_id, entity, entities, fetched_at=None):
+        rows = [
+            (
+                str(realm_id), entity, str(item['Id']), int(item.get('SyncToken', 0)),
+                item.get('MetaData', {}).get('LastUpdatedTime'), json.dumps(item),
+            )
+            for item in entities
+        ]
+
+        conn = self.connection()
+        conn.execute('BEGIN')
+        try:
+            conn.execute('DELETE FROM entities WHERE realm_id = ? AND entity = ?', (str(realm_id), entity))
+            conn.executemany(
+                'INSERT INTO entities (realm_id, entity, id, sync_token, last_updated_time, data) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO fetches (realm_id, entity, fetched_at) VALUES (?, ?, ?)',
+                (str(realm_id), entity, fetched_at if fetched_at is not None else time.time())
+            )
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    # Function to get when the stored list of an entity type was last replaced for a realm, as a Unix time
+    # Returns None if it never was, or the list was marked as out of date
+    def get_fetched_at(self, realm_id, entity):
+        row = self.connection().execute(
+            'SELECT fetched_at FROM fetches WHERE realm_id = ? AND entity = ?',
+            (str(realm_id), entity)
+        ).fetchone()
+
+        return row[0] if row is not None else None
+
+    # Function to mark the stored list of an entity type as out of date, for one realm or for every realm
+    def forget_fetch(self, entity, realm_id=None):
+        if realm_id is None:
+            self.connection().execute('DELETE FROM fetches WHERE entity = ?', (entity,))
+        else:
+            self.connection().execute('DELETE FROM fetches WHERE realm_id = ? AND entity = ?',
+                                      (str(realm_id), entity))
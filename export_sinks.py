@@ -0,0 +1,168 @@
+# export_sinks.py
+
+import csv
+import gzip
+import json
+import sqlite3
+
+# Export formats that can be chosen for a run, and the file extension each one uses
+export_formats = {
+    'csv': '.csv',
+    'csv.gz': '.csv.gz',
+    'ndjson': '.ndjson',
+    'ndjson.gz': '.ndjson.gz',
+    'sqlite': '.db',
+}
+
+
+# Function to open a text file for writing, gzip compressed when compress is set
+def open_text(path, compress):
+    if compress:
+        return gzip.open(path, 'wt', newline='', encoding='utf-8', compresslevel=6)
+    return open(path, 'w', newline='', encoding='utf-8')
+
+
+# Writes entities as CSV rows, optionally gzip compressed while streaming
+class CSVSink:
+    def __init__(self, path, columns, entity_to_row, compress=False):
+        self.path = path
+        self.columns = columns
+        self.entity_to_row = entity_to_row
+        self.compress = compress
+        self.count = 0
+
+    def __enter__(self):
+        self.file = open_text(self.path, self.compress)
+        self.writer = csv.writer(self.file)
+
+        # Write the header row
+        self.writer.writerow(self.columns)
+        return self
+
+    def write(self, entity):
+        self.writer.writerow(self.entity_to_row(entity))
+        self.count += 1
+
+    def write_many(self, entities):
+        for entity in entities:
+            self.write(entity)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        return False
+
+
+# Writes every entity as one line of JSON exactly as QBO returned it, optionally gzip compressed
+class NDJSONSink:
+    def __init__(self, path, compress=False):
+        self.path = path
+        self.compress = compress
+        self.count = 0
+
+    def __enter__(self):
+        self.file = open_text(self.path, self.compress)
+        return self
+
+    def write(self, entity):
+        self.file.write(json.dumps(entity, separators=(',', ':')))
+        self.file.write('\n')
+        self.count += 1
+
+    def write_many(self, entities):
+        for entity in entities:
+            self.write(entity)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        return False
+
+
+# Writes entities into a SQLite table with one column per export column
+# Rows are inserted with executemany in batches and the table is replaced in a single transaction
+class SQLiteSink:
+    def __init__(self, path, table, columns, entity_to_row, batch_size=1000):
+        self.path = path
+        self.table = table
+        self.columns = columns
+        self.entity_to_row = entity_to_row
+        self.batch_size = batch_size
+        self.count = 0
+        self.pending = []
+
+    def __enter__(self):
+        self.conn = sqlite3.connect(self.path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('BEGIN')
+
+        column_list = ', '.join(f'"{column}" TEXT' for column in self.columns)
+        self.conn.execute(f'DROP TABLE IF EXISTS "{self.table}"')
+        self.conn.execute(f'CREATE TABLE "{self.table}" ({column_list})')
+
+        placeholders = ', '.join('?' * len(self.columns))
+        self.insert_sql = f'INSERT INTO "{self.table}" VALUES ({placeholders})'
+        return self
+
+    def flush(self):
+        if self.pending:
+            self.conn.executemany(self.insert_sql, self.pending)
+            self.pending = []
+
+    def write(self, entity):
+        self.pending.append([None if value is None else str(value) for value in self.entity_to_row(entity)])
+        self.count += 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, entities):
+        for entity in entities:
+            self.write(entity)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+                self.conn.execute('COMMIT')
+            else:
+                self.conn.execute('ROLLBACK')
+        finally:
+            self.conn.close()
+        return False
+
+
+# Function to get the file an export will be written to
+def export_path(base_name, export_format):
+    if export_format not in export_formats:
+        raise ValueError(f"Unknown export format '{export_format}', choose one of {', '.join(export_formats)}")
+    return base_name + export_formats[export_format]
+
+
+# Function to get the QBO fields behind a list of export columns, for a projected query
+# Nested values are flattened into columns like MetaData_LastUpdatedTime, which need their top level field,
+# and domain and sparse are added by QBO to every entity so they cannot be selected
+def fields_for_columns(columns):
+    fields = []
+    for column in columns:
+        field = column.split('_')[0]
+        if field not in ('domain', 'sparse') and field not in fields:
+            fields.append(field)
+    return fields
+
+
+# Function to get the fields an export should select, or None to select every field
+# NDJSON exports keep each entity exactly as QBO returns it, the other formats only write their columns
+def export_fields(export_format, columns):
+    if export_format in ('ndjson', 'ndjson.gz'):
+        return None
+    return fields_for_columns(columns)
+
+
+# Function to create the sink for an export format
+# base_name is the export file name without extension, e.g. 'items_data'
+def make_sink(export_format, base_name, columns, entity_to_row, table):
+    path = export_path(base_name, export_format)
+
+    if export_format in ('csv', 'csv.gz'):
+        return CSVSink(path, columns, entity_to_row, compress=export_format.endswith('.gz'))
+    if export_format in ('ndjson', 'ndjson.gz'):
+        return NDJSONSink(path, compress=export_format.endswith('.gz'))
+    return SQLiteSink(path, table, columns, entity_to_row)
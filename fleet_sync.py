@@ -0,0 +1,197 @@
+# fleet_sync.py
+
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from qbo_http import configure_session
+from qbo_rate_limit import default_requests_per_minute, default_max_concurrent
+from qbo_batch import max_batch_size
+from token_manager import TokenManager
+from token_store import FileTokenStore, SQLiteTokenStore
+import GetAccounts
+import UpdateItems
+
+# List of realms to sync, e.g.
+# [
+#     {"realm_id": "1234", "pipelines": ["items", "accounts", "update_items"], "update_csv": "1234_items.csv",
+#      "tokens_db": "tokens.db"},
+#     {"realm_id": "5678", "pipelines": ["items"], "requests_per_minute": 250, "max_concurrent": 5,
+#      "tokens": "tokens_5678.json"}
+# ]
+# Every entry can also set export_format, batch, client_id and client_secret, and where its tokens are, see
+# get_token_store
+realms_file = 'realms.json'
+
+# Consolidated results of the last run
+summary_file = 'fleet_summary.json'
+
+# Number of realms synced at the same time, every realm keeps its own rate and concurrency limits
+max_parallel_realms = 10
+
+# Pipelines run for a realm that does not list its own, in this order
+default_pipelines = ['items', 'accounts']
+
+# Tokens file of a realm that does not name its own, the file the Flask apps save to when logging in
+# It only holds the company that logged in last, give every realm its own file or database for a fleet
+default_tokens_file = 'tokens.json'
+
+# Token stores by path, opened on first use and shared by every realm that names the same one
+token_stores = {}
+token_stores_lock = threading.Lock()
+
+
+# Function to get the token store of a realm
+# A realm names a SQLite database with tokens_db, e.g. the one qbo_cli --tokens-db writes, or a tokens file with
+# tokens, whose path may contain {realm_id}. Without either it reads default_tokens_file
+def get_token_store(realm):
+    if 'tokens_db' in realm:
+        key = ('tokens_db', realm['tokens_db'])
+    else:
+        key = ('tokens', realm.get('tokens', default_tokens_file))
+
+    with token_stores_lock:
+        store = token_stores.get(key)
+        if store is None:
+            store = SQLiteTokenStore(key[1]) if key[0] == 'tokens_db' else FileTokenStore(key[1])
+            token_stores[key] = store
+        return store
+
+
+# Function to read the realm list
+def load_realms(path=realms_file):
+    with open(path, 'r') as f:
+        realms = json.load(f)
+
+    for realm in realms:
+        if 'realm_id' not in realm:
+            raise ValueError(f'Every realm in {path} needs a realm_id')
+        unknown = set(realm.get('pipelines', default_pipelines)) - set(pipelines)
+        if unknown:
+            raise ValueError(f"Realm {realm['realm_id']} lists unknown pipelines: {', '.join(sorted(unknown))}")
+        if 'update_items' in realm.get('pipelines', default_pipelines) and 'update_csv' not in realm:
+            raise ValueError(f"Realm {realm['realm_id']} runs update_items but has no update_csv")
+
+    return realms
+
+
+# Function to export the items of a realm to {realm_id}_items_data, refreshing the entity mirror on the way
+def export_items(realm, access_token):
+    return UpdateItems.make_items_api_request(realm['realm_id'], access_token,
+                                              export_format=realm.get('export_format', 'csv'))
+
+
+# Function to export the accounts of a realm to {realm_id}_accounts_data
+def export_accounts(realm, access_token):
+    return GetAccounts.make_api_request(realm['realm_id'], access_token,
+                                        export_format=realm.get('export_format', 'csv'),
+                                        export_name=f"{realm['realm_id']}_accounts_data")
+
+
+# Function to send the item updates in the realm's CSV file
+def update_items(realm, access_token):
+    summary = UpdateItems.run_item_updates(
+        realm['realm_id'], access_token, csv_file=realm['update_csv'],
+        use_batch=realm.get('batch', True), batch_size=max_batch_size,
+        workers=realm.get('max_concurrent', default_max_concurrent),
+        requests_per_minute=realm.get('requests_per_minute', default_requests_per_minute),
+    )
+    if 'error' not in summary and summary['failed']:
+        summary['error'] = {'code': 500, 'message': f"{summary['failed']} item updates failed"}
+    return summary
+
+
+# Pipelines that can be listed for a realm
+pipelines = {
+    'items': export_items,
+    'accounts': export_accounts,
+    'update_items': update_items,
+}
+
+
+# Function to run every pipeline of one realm in order and time each of them
+# A failing pipeline is recorded and the realm moves on to the next one
+def sync_realm(realm):
+    realm_id = realm['realm_id']
+    started = time.perf_counter()
+    result = {'realm_id': realm_id, 'status': 'ok', 'pipelines': {}}
+
+    token_manager = TokenManager(realm.get('client_id', UpdateItems.client_id),
+                                 realm.get('client_secret', UpdateItems.client_secret),
+                                 UpdateItems.redirect_uri, UpdateItems.token_endpoint,
+                                 store=get_token_store(realm), realm_id=realm_id)
+
+    for name in realm.get('pipelines', default_pipelines):
+        pipeline_started = time.perf_counter()
+        try:
+            # Tokens are cached, this only calls the token endpoint when the access token is about to expire
+            access_token = token_manager.get_access_token()
+            outcome = pipelines[name](realm, access_token)
+        except Exception as err:
+            outcome = {'error': {'code': 500, 'message': str(err)}}
+
+        outcome = {key: value for key, value in outcome.items() if key not in ('pages', 'failures')}
+        outcome['seconds'] = time.perf_counter() - pipeline_started
+        result['pipelines'][name] = outcome
+
+        if 'error' in outcome:
+            result['status'] = 'error'
+            print(f"Realm {realm_id}: {name} failed: {outcome['error']['message']}")
+
+    result['seconds'] = time.perf_counter() - started
+    print(f"Realm {realm_id} finished in {result['seconds']:.2f}s ({result['status']})")
+
+    return result
+
+
+# Function to sync every realm, up to max_parallel realms at a time
+# The consolidated summary is printed, written to summary_path and returned
+def sync_fleet(realms, max_parallel=max_parallel_realms, summary_path=summary_file):
+    # All realms talk to the same host, so the connection pool has to fit every realm's requests in flight
+    configure_session(pool_maxsize=max_parallel * max(
+        realm.get('max_concurrent', default_max_concurrent) for realm in realms
+    ))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        results = list(executor.map(sync_realm, realms))
+    wall_seconds = time.perf_counter() - started
+
+    realm_seconds = sum(result['seconds'] for result in results)
+    summary = {
+        'realms': results,
+        'ok': sum(1 for result in results if result['status'] == 'ok'),
+        'failed': sum(1 for result in results if result['status'] != 'ok'),
+        'wall_seconds': wall_seconds,
+        'slowest_realm_seconds': max((result['seconds'] for result in results), default=0.0),
+        'sum_realm_seconds': realm_seconds,
+    }
+
+    print_summary(summary)
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    return summary
+
+
+# Function to print one line per realm and pipeline, then the totals
+def print_summary(summary):
+    print(f"{'Realm':<20} {'Pipeline':<14} {'Seconds':>9}  Result")
+    for result in summary['realms']:
+        for name, outcome in result['pipelines'].items():
+            if 'error' in outcome:
+                detail = f"error: {outcome['error']['message']}"
+            elif 'updated' in outcome:
+                detail = f"{outcome['updated']} updated, {outcome['unchanged']} unchanged"
+            else:
+                detail = f"{outcome.get('count', 0)} exported to {outcome.get('export_path', '')}"
+            print(f"{result['realm_id']:<20} {name:<14} {outcome['seconds']:>9.2f}  {detail}")
+
+    print(f"{summary['ok']} realms ok, {summary['failed']} failed in {summary['wall_seconds']:.2f}s "
+          f"(slowest realm {summary['slowest_realm_seconds']:.2f}s, "
+          f"{summary['sum_realm_seconds']:.2f}s if run one after another)")
+
+
+if __name__ == '__main__':
+    sync_fleet(load_realms(sys.argv[1] if len(sys.argv) > 1 else realms_file))
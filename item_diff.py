@@ -0,0 +1,114 @@
+# item_diff.py
+
+# CSV columns that can be sent in an item update, and where each one lives in the Item entity
+# FullyQualifiedName, domain, MetaData, sparse and the account names are read-only or derived, so they
+# are never compared or sent, and Id/SyncToken are always sent
+updatable_item_fields = {
+    'Name': ('Name',),
+    'TrackQtyOnHand': ('TrackQtyOnHand',),
+    'Type': ('Type',),
+    'PurchaseCost': ('PurchaseCost',),
+    'QtyOnHand': ('QtyOnHand',),
+    'IncomeAccountRef_value': ('IncomeAccountRef', 'value'),
+    'AssetAccountRef_value': ('AssetAccountRef', 'value'),
+    'Taxable': ('Taxable',),
+    'Active': ('Active',),
+    'InvStartDate': ('InvStartDate',),
+    'UnitPrice': ('UnitPrice',),
+    'ExpenseAccountRef_value': ('ExpenseAccountRef', 'value'),
+    'PurchaseDesc': ('PurchaseDesc',),
+    'Description': ('Description',),
+}
+
+boolean_item_fields = {'TrackQtyOnHand', 'Taxable', 'Active'}
+numeric_item_fields = {'PurchaseCost', 'QtyOnHand', 'UnitPrice'}
+
+# An empty cell means "leave as is", except for these free text fields where it clears the text
+clearable_item_fields = {'Description', 'PurchaseDesc'}
+
+
+# Function to read a (possibly nested) field from an entity, returns None if it is missing
+def get_field(entity, path):
+    value = entity
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+# Function to convert a CSV value into the JSON type QBO uses for the field
+# Empty cells become None (or '' for clearable fields), values that cannot be converted are passed through
+def csv_value_to_json(column, value):
+    if value is None or value == '':
+        return '' if column in clearable_item_fields else None
+
+    if column in boolean_item_fields:
+        lowered = value.strip().lower()
+        if lowered in ('true', 'false'):
+            return lowered == 'true'
+        return value
+
+    if column in numeric_item_fields:
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+        return int(number) if number.is_integer() else number
+
+    return value
+
+
+# Function to compare a CSV value with the value stored on the server
+def values_match(column, csv_value, server_value):
+    csv_json = csv_value_to_json(column, csv_value)
+
+    # Nothing to send for this field
+    if csv_json is None:
+        return True
+
+    if column in numeric_item_fields:
+        try:
+            return float(csv_json) == float(server_value)
+        except (TypeError, ValueError):
+            return False
+
+    if column in boolean_item_fields:
+        return str(csv_json).lower() == str(server_value).lower()
+
+    return str(csv_json) == ('' if server_value is None else str(server_value))
+
+
+# Function to list the CSV columns whose value differs from the server copy of the item
+# Columns that are not in the CSV at all are ignored
+def diff_item(csv_item, server_item):
+    return [
+        column for column, path in updatable_item_fields.items()
+        if column in csv_item and not values_match(column, csv_item[column], get_field(server_item, path))
+    ]
+
+
+# Function to build a sparse update holding only the changed fields plus Id and SyncToken
+# Returns None when nothing changed, so the row does not need to be sent at all
+def build_sparse_update(csv_item, server_item):
+    changed_columns = diff_item(csv_item, server_item)
+    if not changed_columns:
+        return None
+
+    body = {
+        'Id': str(server_item['Id']),
+        'SyncToken': str(server_item.get('SyncToken', 0)),
+        'sparse': True,
+    }
+
+    for column in changed_columns:
+        path = updatable_item_fields[column]
+        value = csv_value_to_json(column, csv_item[column])
+
+        # Walk down to the nested object the field belongs to, e.g. IncomeAccountRef
+        target = body
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
+
+    return body
@@ -0,0 +1,95 @@
+# item_validation.py
+
+import csv
+import math
+import re
+from item_diff import boolean_item_fields, numeric_item_fields, get_field
+from account_cache import item_account_refs
+
+# Item types QBO accepts
+valid_item_types = {'Inventory', 'NonInventory', 'Service', 'Category', 'Group'}
+
+# Longest text QBO accepts in each free text field
+max_text_lengths = {
+    'Name': 100,
+    'Description': 4000,
+    'PurchaseDesc': 1000,
+}
+
+date_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+# Function to check one CSV item row locally, before anything is sent to QBO
+# known_item is the entity mirror copy of the item, or None if the item has never been fetched
+# get_account_index is only called for account Ids that differ from the known item, so unchanged references
+# never need the chart of accounts
+# Returns a list of error messages, empty when the row is valid
+def validate_item_row(csv_item, known_item=None, get_account_index=None):
+    errors = []
+
+    item_id = (csv_item.get('Id') or '').strip()
+    if not item_id:
+        errors.append('Id: missing')
+    elif not item_id.isdigit():
+        errors.append(f"Id: '{item_id}' is not a QBO Id")
+
+    for column in boolean_item_fields:
+        value = (csv_item.get(column) or '').strip()
+        if value and value.lower() not in ('true', 'false'):
+            errors.append(f"{column}: '{value}' is not true or false")
+
+    for column in numeric_item_fields:
+        value = (csv_item.get(column) or '').strip()
+        if not value:
+            continue
+        try:
+            number = float(value)
+        except ValueError:
+            errors.append(f"{column}: '{value}' is not a number")
+            continue
+        if not math.isfinite(number):
+            errors.append(f"{column}: '{value}' is not a number")
+        elif number < 0 and column != 'QtyOnHand':
+            errors.append(f"{column}: {value} is negative")
+
+    item_type = (csv_item.get('Type') or '').strip()
+    if item_type and item_type not in valid_item_types:
+        errors.append(f"Type: '{item_type}' is not one of {', '.join(sorted(valid_item_types))}")
+
+    for column, max_length in max_text_lengths.items():
+        value = csv_item.get(column) or ''
+        if len(value) > max_length:
+            errors.append(f"{column}: longer than {max_length} characters")
+
+    # The colon separates parent and child in FullyQualifiedName, so QBO rejects it in a Name
+    if ':' in (csv_item.get('Name') or ''):
+        errors.append('Name: must not contain a colon')
+
+    start_date = (csv_item.get('InvStartDate') or '').strip()
+    if start_date and not date_pattern.match(start_date):
+        errors.append(f"InvStartDate: '{start_date}' is not a YYYY-MM-DD date")
+
+    for prefix in item_account_refs:
+        value = (csv_item.get(f'{prefix}_value') or '').strip()
+        if not value:
+            continue
+
+        # A reference that matches the server copy is known to be valid
+        if known_item is not None and known_item.get('data'):
+            if str(get_field(known_item['data'], (prefix, 'value'))) == value:
+                continue
+
+        if get_account_index is not None and value not in get_account_index().by_id:
+            errors.append(f"{prefix}_value: unknown account Id '{value}'")
+
+    return errors
+
+
+# Function to write the rejected rows to a CSV report
+# rejected is a list of result dicts with row, Id and error, as collected while reading the update CSV
+def write_rejection_report(path, rejected):
+    with open(path, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['row', 'Id', 'errors'])
+        for rejection in rejected:
+            writer.writerow([rejection['row'], rejection['Id'], rejection['error']])
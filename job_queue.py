@@ -0,0 +1,246 @@
+# job_queue.py
+
+import json
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Long runs that would otherwise hold an HTTP request thread for minutes run as jobs on a small worker pool
+# A route submits a job, returns its id at once, and the job's progress is read from a status endpoint or
+# streamed as Server-Sent Events
+
+# Jobs running at the same time, more are queued
+default_max_jobs = 2
+
+# Finished jobs kept for the status endpoint, the oldest are dropped first
+max_finished_jobs = 100
+
+# Shortest time between two progress events of one job, so a fast run does not flood the stream
+event_interval = 0.5
+
+# Seconds without progress after which the event stream sends a comment to keep proxies from closing it
+keep_alive_interval = 15
+
+
+# One background run of row updates, with live progress counters
+# run(job) does the work, reports every row with record_result, and returns the run's summary dict
+# total_rows may be left out and set by the run with set_total_rows when counting takes a while
+class Job:
+    def __init__(self, kind, realm_id, run, total_rows=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.realm_id = realm_id
+        self.run = run
+        self.total_rows = total_rows
+
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        self.updated = 0
+        self.failed = 0
+        # Rows that needed no call, set by the run through set_skipped as it reads the CSV
+        self.unchanged = 0
+        self.rejected = 0
+        # Rows that were sent, found stale and then already matched the current copy
+        self.unchanged_on_retry = 0
+        self.last_row = None
+        self.errors = []
+        self.summary = None
+        self.error = None
+
+        # Every change bumps version and wakes up the event streams waiting on changed
+        self.version = 0
+        self.changed = threading.Condition()
+
+    # Function to mark a change and wake up the event streams
+    def touch(self):
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+
+    # Function to record the result dict of one row, as soon as it is known
+    def record_result(self, result):
+        with self.changed:
+            if result['status'] == 'ok':
+                self.updated += 1
+            elif result['status'] == 'unchanged':
+                self.unchanged_on_retry += 1
+            else:
+                self.failed += 1
+                self.errors.append(result)
+            self.version += 1
+            self.changed.notify_all()
+
+    # Function to set the number of rows the job will go through, once the run has counted them
+    def set_total_rows(self, total_rows):
+        with self.changed:
+            self.total_rows = total_rows
+            self.version += 1
+            self.changed.notify_all()
+
+    # Function to record the rows read so far that were skipped or rejected without a call
+    # rejected is the list of rejected row results, new ones are added to the errors
+    # last_row is the highest row that every row up to is finished, a resumed run starts after it
+    def set_skipped(self, unchanged, rejected, last_row):
+        with self.changed:
+            self.unchanged = unchanged
+            self.errors.extend(rejected[self.rejected:])
+            self.rejected = len(rejected)
+            self.last_row = last_row
+            self.version += 1
+            self.changed.notify_all()
+
+    # Function to wait until the job changes after the given version, or the timeout passes
+    # Returns the current version
+    def wait_for_change(self, version, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout=timeout)
+            return self.version
+
+    # Function to get the status of the job as a dict
+    # Errors are left out unless include_errors is set, and only those after errors_from are included
+    def snapshot(self, include_errors=True, errors_from=0):
+        with self.changed:
+            unchanged = self.unchanged + self.unchanged_on_retry
+            done = self.updated + self.failed + unchanged + self.rejected
+            end = self.finished_at or time.time()
+            elapsed = end - self.started_at if self.started_at else 0.0
+            per_second = done / elapsed if elapsed > 0 else 0.0
+
+            eta_seconds = None
+            if self.status == 'running' and self.total_rows is not None and per_second > 0:
+                eta_seconds = max(0, self.total_rows - done) / per_second
+
+            status = {
+                'job_id': self.id,
+                'kind': self.kind,
+                'realm_id': self.realm_id,
+                'status': self.status,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'total_rows': self.total_rows,
+                'rows_done': done,
+                'updated': self.updated,
+                'failed': self.failed,
+                'unchanged': unchanged,
+                'rejected': self.rejected,
+                'last_row': self.last_row,
+                'progress': done / self.total_rows if self.total_rows else None,
+                'elapsed_seconds': elapsed,
+                'per_second': per_second,
+                'eta_seconds': eta_seconds,
+                'error_count': len(self.errors),
+                'summary': self.summary,
+                'error': self.error,
+            }
+            if include_errors:
+                status['errors'] = sorted(self.errors[errors_from:], key=lambda result: result['row'])
+
+            return status
+
+    # Function to run the job on a worker thread
+    def execute(self):
+        with self.changed:
+            self.status = 'running'
+            self.started_at = time.time()
+        self.touch()
+
+        try:
+            summary = self.run(self)
+        except Exception as err:
+            traceback.print_exc()
+            with self.changed:
+                self.status = 'failed'
+                self.error = str(err)
+                self.finished_at = time.time()
+        else:
+            with self.changed:
+                # A run may also fail the way the scripts do, by returning an error dict
+                if isinstance(summary, dict) and 'error' in summary:
+                    self.status = 'failed'
+                    self.error = f"{summary['error']['code']}: {summary['error']['message']}"
+                else:
+                    self.status = 'finished'
+                    self.summary = summary
+                self.finished_at = time.time()
+        self.touch()
+
+    # Function to check whether the job has stopped, for good or bad
+    def done(self):
+        return self.status in ('finished', 'failed')
+
+
+# Worker pool that runs jobs in the order they are submitted and remembers them by id
+class JobQueue:
+    def __init__(self, max_jobs=default_max_jobs):
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.pool = None
+
+    # Function to queue a job, the worker threads are started on first use
+    def submit(self, kind, realm_id, run, total_rows=None):
+        job = Job(kind, realm_id, run, total_rows=total_rows)
+
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.max_jobs, thread_name_prefix='job')
+            self.jobs[job.id] = job
+            self.forget_old_jobs()
+            self.pool.submit(job.execute)
+
+        print(f"Queued {kind} job {job.id} for realm {realm_id}")
+        return job
+
+    # Function to drop the oldest finished jobs beyond max_finished_jobs, call with the lock held
+    def forget_old_jobs(self):
+        finished = [job for job in self.jobs.values() if job.done()]
+        for job in sorted(finished, key=lambda job: job.finished_at)[:max(0, len(finished) - max_finished_jobs)]:
+            del self.jobs[job.id]
+
+    # Function to get a job by id, or None if it is unknown or was forgotten
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    # Function to list the status of every job, newest first, without their errors
+    def statuses(self):
+        with self.lock:
+            jobs = sorted(self.jobs.values(), key=lambda job: job.created_at, reverse=True)
+        return [job.snapshot(include_errors=False) for job in jobs]
+
+
+# Generator of Server-Sent Events with the progress of a job, ending once the job is done
+# Every progress event carries the job status with only the errors added since the previous event, and the last
+# one is sent as a 'done' event
+def job_events(job):
+    version = -1
+    errors_sent = 0
+    last_sent = 0.0
+
+    while True:
+        new_version = job.wait_for_change(version, keep_alive_interval)
+        if new_version == version:
+            yield ': keep-alive\n\n'
+            continue
+        version = new_version
+
+        # Changes that arrive while we wait here are folded into this event
+        wait = event_interval - (time.monotonic() - last_sent)
+        if wait > 0 and not job.done():
+            time.sleep(wait)
+            version = job.version
+
+        status = job.snapshot(errors_from=errors_sent)
+        errors_sent += len(status['errors'])
+        last_sent = time.monotonic()
+
+        event = 'done' if status['status'] in ('finished', 'failed') else 'progress'
+        yield f"event: {event}\ndata: {json.dumps(status)}\n\n"
+
+        if event == 'done':
+            return
@@ -0,0 +1,441 @@
+# mock_qbo_server.py
+
+import argparse
+import gzip
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from flask import Flask, request, g
+
+# Local stand-in for the QBO accounting API and the Intuit OAuth token endpoint, for benchmarks and offline runs
+# Point the scripts at it with
+#     base_url = "http://127.0.0.1:5001/v3/company/"
+#     token_endpoint = "http://127.0.0.1:5001/oauth2/v1/tokens/bearer"
+#
+# It emulates paginated /query, /item reads and updates with SyncToken conflicts, /batch, /cdc, the token
+# endpoint, 429 throttling and gzip content encoding. Every realm gets its own generated catalog on first use
+
+app = Flask(__name__)
+
+# Settings, changed from the command line
+settings = {
+    'catalog_size': 10000,        # Items in every realm
+    'account_count': 100,         # Accounts in every realm
+    'latency': 0.0,               # Seconds added to every response
+    'jitter': 0.0,                # Random extra seconds, up to this much
+    'requests_per_minute': 0,     # Per-realm throttle like QBO's, 0 switches it off
+    'throttle_ratio': 0.0,        # Fraction of requests answered with 429 at random
+    'retry_after': 1,             # Retry-After seconds sent with every 429
+    'gzip_responses': True,       # Compress response bodies for clients that send Accept-Encoding: gzip
+    'gzip_requests': True,        # Accept gzip request bodies, otherwise they are refused with 415
+}
+
+# Responses smaller than this are not worth compressing
+gzip_min_bytes = 1024
+
+# QBO never returns more than 1000 entities per query page
+max_page_size = 1000
+
+# Generated data of every realm, and the lock that guards it
+realms = {}
+realms_lock = threading.Lock()
+
+# Per-realm request times for the throttle
+request_times = {}
+
+
+# Function to format a timestamp the way QBO does
+def qbo_time(moment=None):
+    moment = moment or datetime.now(timezone.utc)
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S-00:00')
+
+
+# Function to generate the accounts and items of a new realm
+def generate_realm(realm_id):
+    created = qbo_time()
+
+    accounts = {}
+    for number in range(1, settings['account_count'] + 1):
+        account_type = ('Income', 'Cost of Goods Sold', 'Other Current Asset')[number % 3]
+        accounts[str(number)] = {
+            'Name': f'Account {number}', 'SubAccount': False, 'FullyQualifiedName': f'Account {number}',
+            'Active': True, 'Classification': 'Revenue', 'AccountType': account_type,
+            'AccountSubType': 'SalesOfProductIncome', 'CurrentBalance': 0, 'CurrentBalanceWithSubAccounts': 0,
+            'CurrencyRef': {'value': 'USD', 'name': 'United States Dollar'}, 'domain': 'QBO', 'sparse': False,
+            'Id': str(number), 'SyncToken': '0', 'MetaData': {'CreateTime': created, 'LastUpdatedTime': created},
+        }
+
+    items = {}
+    for number in range(1, settings['catalog_size'] + 1):
+        items[str(number)] = {
+            'FullyQualifiedName': f'Item {number}', 'domain': 'QBO', 'Id': str(number), 'Name': f'Item {number}',
+            'TrackQtyOnHand': True, 'Type': 'Inventory', 'PurchaseCost': round(number % 97 + 0.5, 2),
+            'QtyOnHand': number % 50,
+            'IncomeAccountRef': {'value': '1', 'name': 'Account 1'},
+            'AssetAccountRef': {'value': '3', 'name': 'Account 3'},
+            'ExpenseAccountRef': {'value': '2', 'name': 'Account 2'},
+            'Taxable': False, 'MetaData': {'CreateTime': created, 'LastUpdatedTime': created}, 'sparse': False,
+            'Active': True, 'SyncToken': '0', 'InvStartDate': '2024-01-01', 'UnitPrice': round(number % 89 + 1.25, 2),
+            'PurchaseDesc': f'Purchase description {number}', 'Description': f'Description {number}',
+        }
+
+    return {'Item': items, 'Account': accounts, 'Deleted': {'Item': {}, 'Account': {}}, 'lock': threading.Lock()}
+
+
+# Function to get the data of a realm, generating it on first use
+def get_realm(realm_id):
+    with realms_lock:
+        realm = realms.get(realm_id)
+        if realm is None:
+            realm = generate_realm(realm_id)
+            realms[realm_id] = realm
+        return realm
+
+
+# Function to build a QBO style fault response
+def fault(status, code, message, detail='', fault_type='ValidationFault'):
+    body = {
+        'Fault': {'Error': [{'Message': message, 'Detail': detail, 'code': str(code)}], 'type': fault_type},
+        'time': qbo_time(),
+    }
+    return app.response_class(json.dumps(body), status=status, mimetype='application/json')
+
+
+# Function to check whether this request should be throttled, like QBO does per realm
+def throttled(realm_id):
+    if settings['throttle_ratio'] and random.random() < settings['throttle_ratio']:
+        return True
+
+    limit = settings['requests_per_minute']
+    if not limit:
+        return False
+
+    now = time.monotonic()
+    with realms_lock:
+        times = request_times.setdefault(realm_id, [])
+        while times and times[0] <= now - 60:
+            times.pop(0)
+        if len(times) >= limit:
+            return True
+        times.append(now)
+    return False
+
+
+@app.before_request
+def before_request():
+    g.intuit_tid = str(uuid.uuid4())
+
+    delay = settings['latency'] + random.uniform(0, settings['jitter'])
+    if delay:
+        time.sleep(delay)
+
+    if request.headers.get('Content-Encoding') == 'gzip':
+        if not settings['gzip_requests']:
+            return fault(415, 415, 'Unsupported Media Type', 'Compressed request bodies are not accepted')
+        # Replace the cached body, so get_json and get_data see the decompressed JSON
+        request._cached_data = gzip.decompress(request.get_data())
+
+    realm_match = re.match(r'/v3/company/([^/]+)/', request.path)
+    if realm_match and throttled(realm_match.group(1)):
+        response = fault(429, 3001, 'message=ThrottleExceeded', 'The request limit was reached.', 'SERVICE')
+        response.headers['Retry-After'] = str(settings['retry_after'])
+        return response
+
+
+@app.after_request
+def after_request(response):
+    response.headers['intuit_tid'] = g.get('intuit_tid', '')
+
+    if (settings['gzip_responses'] and 'gzip' in request.headers.get('Accept-Encoding', '')
+            and not response.direct_passthrough and 'Content-Encoding' not in response.headers):
+        data = response.get_data()
+        if len(data) >= gzip_min_bytes:
+            response.set_data(gzip.compress(data, compresslevel=6))
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+
+    return response
+
+
+# Function to read a dotted field like MetaData.LastUpdatedTime from an entity
+def field_value(entity, field):
+    value = entity
+    for part in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+# Function to compare an entity value against a literal from a WHERE clause
+def compare(value, operator, literal):
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    elif value is None:
+        value = ''
+
+    if operator == 'in':
+        return str(value) in literal
+
+    if isinstance(value, (int, float)):
+        try:
+            literal = float(literal)
+        except ValueError:
+            value = str(value)
+    else:
+        value = str(value)
+
+    if operator == '=':
+        return value == literal
+    if operator == '!=':
+        return value != literal
+    if operator == '>':
+        return value > literal
+    if operator == '>=':
+        return value >= literal
+    if operator == '<':
+        return value < literal
+    if operator == '<=':
+        return value <= literal
+    if operator == 'like':
+        pattern = '^' + re.escape(str(literal)).replace('%', '.*') + '$'
+        return re.match(pattern, value, re.IGNORECASE) is not None
+    return False
+
+
+condition_pattern = re.compile(
+    r"\s*([\w.]+)\s*(=|!=|>=|<=|>|<|\bin\b|\blike\b)\s*(\([^)]*\)|'(?:[^'\\]|\\.)*'|[\w.:-]+)\s*", re.IGNORECASE
+)
+
+
+# Function to parse a WHERE clause of conditions joined by AND into (field, operator, literal) tuples
+def parse_where(where):
+    conditions = []
+    for part in re.split(r'\s+and\s+', where.strip(), flags=re.IGNORECASE):
+        match = condition_pattern.fullmatch(part)
+        if not match:
+            raise ValueError(f'Unsupported condition: {part}')
+        field, operator, literal = match.groups()
+        operator = operator.lower()
+        if operator == 'in':
+            literal = [value.strip().strip("'") for value in literal.strip('()').split(',')]
+        else:
+            literal = literal.strip("'").replace("\\'", "'")
+        conditions.append((field, operator, literal))
+    return conditions
+
+
+query_pattern = re.compile(
+    r'select\s+(?P<fields>.+?)\s+from\s+(?P<entity>\w+)'
+    r'(?:\s+where\s+(?P<where>.+?))?'
+    r'(?:\s+orderby\s+(?P<orderby>[\w.]+(?:\s+(?:asc|desc))?))?'
+    r'(?:\s+startposition\s+(?P<start>\d+))?'
+    r'(?:\s+maxresults\s+(?P<max>\d+))?\s*$',
+    re.IGNORECASE | re.DOTALL
+)
+
+
+@app.route('/v3/company/<realm_id>/query', methods=['GET', 'POST'])
+def query(realm_id):
+    text = request.args.get('query') or request.get_data(as_text=True)
+    match = query_pattern.match(text or '')
+    if not match:
+        return fault(400, 4000, 'Error parsing query', text or '', 'QueryParserError')
+
+    entity = match.group('entity').capitalize()
+    realm = get_realm(realm_id)
+    if entity not in ('Item', 'Account'):
+        return fault(400, 4001, 'Invalid query', f'Unsupported entity {entity}', 'QueryParserError')
+
+    try:
+        conditions = parse_where(match.group('where')) if match.group('where') else []
+    except ValueError as err:
+        return fault(400, 4000, 'Error parsing query', str(err), 'QueryParserError')
+
+    start = int(match.group('start') or 1)
+    max_results = min(int(match.group('max') or 100), max_page_size)
+
+    with realm['lock']:
+        entities = [
+            entity_data for entity_data in realm[entity].values()
+            if all(compare(field_value(entity_data, field), operator, literal)
+                   for field, operator, literal in conditions)
+        ]
+
+    if match.group('orderby'):
+        field, _, direction = match.group('orderby').partition(' ')
+        entities.sort(key=lambda entity_data: str(field_value(entity_data, field) or ''),
+                      reverse=direction.strip().lower() == 'desc')
+    else:
+        entities.sort(key=lambda entity_data: int(entity_data['Id']))
+
+    page = entities[start - 1:start - 1 + max_results]
+
+    # A field list returns only those fields, Id and SyncToken are always included like QBO does
+    fields = [field.strip() for field in match.group('fields').split(',')]
+    if fields != ['*'] and fields[0].lower() != 'count(*)':
+        keep = set(fields) | {'Id', 'SyncToken', 'domain', 'sparse'}
+        page = [{key: value for key, value in entity_data.items() if key in keep} for entity_data in page]
+        for entity_data in page:
+            entity_data['sparse'] = True
+
+    query_response = {'startPosition': start, 'maxResults': len(page)}
+    if fields[0].lower() == 'count(*)':
+        query_response = {'totalCount': len(entities)}
+    elif page:
+        query_response[entity] = page
+
+    return {'QueryResponse': query_response, 'time': qbo_time()}
+
+
+# Function to apply an update body to an entity, returns (entity, None) or (None, fault dict)
+def apply_update(realm, entity, body):
+    entity_id = str(body.get('Id', ''))
+
+    with realm['lock']:
+        current = realm[entity].get(entity_id)
+        if current is None:
+            return None, {'code': '610', 'Message': 'Object Not Found',
+                          'Detail': f'Object Not Found : {entity} {entity_id} does not exist'}
+
+        if str(body.get('SyncToken')) != current['SyncToken']:
+            return None, {'code': '5010', 'Message': 'Stale Object Error',
+                          'Detail': f"Stale Object Error : You and another user were working on this at the same "
+                                    f"time. The other user finished first, so your work was not saved."}
+
+        sparse = str(body.get('sparse', '')).lower() == 'true'
+        updated = dict(current) if sparse else {'Id': entity_id, 'domain': 'QBO', 'MetaData': current['MetaData']}
+        for key, value in body.items():
+            if key in ('Id', 'SyncToken', 'sparse', 'MetaData', 'domain'):
+                continue
+            updated[key] = value
+
+        updated['SyncToken'] = str(int(current['SyncToken']) + 1)
+        updated['MetaData'] = dict(current['MetaData'], LastUpdatedTime=qbo_time())
+        updated['sparse'] = False
+        realm[entity][entity_id] = updated
+
+        return updated, None
+
+
+@app.route('/v3/company/<realm_id>/item', methods=['POST'])
+@app.route('/v3/company/<realm_id>/item/', methods=['POST'])
+def update_item(realm_id):
+    body = request.get_json(force=True, silent=True)
+    if not isinstance(body, dict):
+        return fault(400, 2500, 'Invalid Request', 'Request body is not valid JSON')
+
+    item, error = apply_update(get_realm(realm_id), 'Item', body)
+    if error:
+        return fault(400, error['code'], error['Message'], error['Detail'])
+
+    return {'Item': item, 'time': qbo_time()}
+
+
+@app.route('/v3/company/<realm_id>/item/<item_id>', methods=['GET'])
+def read_item(realm_id, item_id):
+    realm = get_realm(realm_id)
+    with realm['lock']:
+        item = realm['Item'].get(item_id)
+    if item is None:
+        return fault(400, 610, 'Object Not Found', f'Item {item_id} not found')
+    return {'Item': item, 'time': qbo_time()}
+
+
+@app.route('/v3/company/<realm_id>/batch', methods=['POST'])
+def batch(realm_id):
+    body = request.get_json(force=True, silent=True) or {}
+    operations = body.get('BatchItemRequest', [])
+    if len(operations) > 30:
+        return fault(400, 2000, 'Batch size exceeded', 'A batch request can hold at most 30 operations')
+
+    realm = get_realm(realm_id)
+    responses = []
+    for operation in operations:
+        entity = next((key for key in operation if key in ('Item', 'Account')), None)
+        if operation.get('operation') != 'update' or entity is None:
+            responses.append({'bId': operation.get('bId'), 'Fault': {
+                'Error': [{'Message': 'Unsupported operation', 'code': '2000'}], 'type': 'ValidationFault'}})
+            continue
+
+        updated, error = apply_update(realm, entity, operation[entity])
+        if error:
+            responses.append({'bId': operation.get('bId'), 'Fault': {'Error': [error], 'type': 'ValidationFault'}})
+        else:
+            responses.append({'bId': operation.get('bId'), entity: updated})
+
+    return {'BatchItemResponse': responses, 'time': qbo_time()}
+
+
+@app.route('/v3/company/<realm_id>/cdc', methods=['GET'])
+def cdc(realm_id):
+    changed_since = request.args.get('changedSince', '')
+    entities = [entity for entity in request.args.get('entities', '').split(',') if entity]
+    realm = get_realm(realm_id)
+
+    query_responses = []
+    with realm['lock']:
+        for entity in entities:
+            if entity not in ('Item', 'Account'):
+                continue
+            # Timestamps are compared as UTC strings, which is good enough for the mock
+            since = changed_since[:19]
+            changed = [entity_data for entity_data in realm[entity].values()
+                       if entity_data['MetaData']['LastUpdatedTime'][:19] > since]
+            changed += [{'Id': entity_id, 'status': 'Deleted', 'MetaData': {'LastUpdatedTime': deleted_at}}
+                        for entity_id, deleted_at in realm['Deleted'][entity].items() if deleted_at[:19] > since]
+            query_responses.append({entity: changed[:1000], 'startPosition': 1, 'maxResults': len(changed[:1000])})
+
+    return {'CDCResponse': [{'QueryResponse': query_responses}], 'time': qbo_time()}
+
+
+@app.route('/oauth2/v1/tokens/bearer', methods=['POST'])
+def token():
+    grant_type = request.form.get('grant_type')
+    if grant_type == 'authorization_code' and not request.form.get('code'):
+        return {'error': 'invalid_grant'}, 400
+    if grant_type == 'refresh_token' and not request.form.get('refresh_token'):
+        return {'error': 'invalid_grant'}, 400
+    if grant_type not in ('authorization_code', 'refresh_token'):
+        return {'error': 'unsupported_grant_type'}, 400
+
+    return {
+        'token_type': 'bearer',
+        'access_token': 'mock-access-' + uuid.uuid4().hex,
+        'refresh_token': request.form.get('refresh_token') or 'mock-refresh-' + uuid.uuid4().hex,
+        'expires_in': 3600,
+        'x_refresh_token_expires_in': 8726400,
+    }
+
+
+# Function to read the settings from the command line
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Local mock of the QBO API and OAuth token endpoint.')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--catalog-size', type=int, default=settings['catalog_size'], help='items per realm')
+    parser.add_argument('--account-count', type=int, default=settings['account_count'], help='accounts per realm')
+    parser.add_argument('--latency', type=float, default=settings['latency'], help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=settings['jitter'], help='random extra seconds, up to this')
+    parser.add_argument('--requests-per-minute', type=int, default=settings['requests_per_minute'],
+                        help='per-realm throttle, 0 switches it off')
+    parser.add_argument('--throttle-ratio', type=float, default=settings['throttle_ratio'],
+                        help='fraction of requests answered with 429 at random')
+    parser.add_argument('--retry-after', type=int, default=settings['retry_after'])
+    parser.add_argument('--gzip-responses', action=argparse.BooleanOptionalAction, default=settings['gzip_responses'],
+                        help='compress responses for clients that accept gzip')
+    parser.add_argument('--gzip-requests', action=argparse.BooleanOptionalAction, default=settings['gzip_requests'],
+                        help='accept gzip request bodies, refuse them with 415 otherwise')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for name in settings:
+        settings[name] = getattr(args, name)
+
+    print(f'Mock QBO server on http://127.0.0.1:{args.port} with {args.catalog_size} items per realm')
+    app.run(port=args.port, threaded=True, debug=False)
@@ -0,0 +1,285 @@
+# qbo_async.py
+
+import asyncio
+import json
+import random
+import time
+from types import SimpleNamespace
+from urllib.parse import urlencode
+import aiohttp
+from qbo_query import max_page_size, prepare_query
+from qbo_rate_limit import default_requests_per_minute, default_max_concurrent
+from qbo_retry import default_policy, throttled_statuses, transient_statuses, is_idempotent, retry_after_seconds
+from qbo_metrics import (classify_request, upstream_latency, upstream_responses, upstream_bytes_sent,
+                         upstream_bytes_received, upstream_wire_bytes_sent, upstream_wire_bytes_received,
+                         upstream_retries)
+
+# Requests in flight across every realm of one client
+default_max_in_flight = 200
+
+
+# Raised when QBO answers a call with an error status after all retries
+class QBOAsyncError(Exception):
+    def __init__(self, status, text, intuit_tid=''):
+        super().__init__(f'HTTP {status}: {text}')
+        self.status = status
+        self.text = text
+        self.intuit_tid = intuit_tid
+
+
+# Token bucket for coroutines, same behaviour as qbo_rate_limit.TokenBucket but waiting with asyncio.sleep
+class AsyncTokenBucket:
+    def __init__(self, requests_per_minute=default_requests_per_minute, capacity=None):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    # Take one token, waiting until one is available
+    # Coroutines only switch at the await, so no lock is needed around the bookkeeping
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Per-realm throttle for coroutines: a request rate plus a cap on requests in flight
+class AsyncRealmLimiter:
+    def __init__(self, requests_per_minute=default_requests_per_minute, max_concurrent=default_max_concurrent):
+        self.bucket = AsyncTokenBucket(requests_per_minute)
+        self.semaphore = asyncio.BoundedSemaphore(max_concurrent)
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        try:
+            await self.bucket.acquire()
+        except BaseException:
+            self.semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.semaphore.release()
+        return False
+
+
+# asyncio client for the QBO calls the scripts make: paged queries, item updates and token refresh
+# One client can keep max_in_flight requests going at once, spread over any number of realms, while every realm
+# stays within its own rate and concurrency limit
+#
+# Use it as an async context manager, from an async Flask view or a standalone runner:
+#
+#     async def main():
+#         async with AsyncQBOClient(base_url, minorversion) as client:
+#             async for page in client.query_pages(realm_id, access_token, 'Item'):
+#                 ...
+#
+#     asyncio.run(main())
+class AsyncQBOClient:
+    def __init__(self, base_url, minorversion, max_in_flight=default_max_in_flight,
+                 requests_per_minute=default_requests_per_minute, max_concurrent_per_realm=default_max_concurrent,
+                 retry_policy=default_policy):
+        self.base_url = base_url
+        self.minorversion = minorversion
+        self.max_in_flight = max_in_flight
+        self.requests_per_minute = requests_per_minute
+        self.max_concurrent_per_realm = max_concurrent_per_realm
+        self.retry_policy = retry_policy
+
+        self.session = None
+        self.in_flight = None
+        self.realm_limiters = {}
+        self.refresh_locks = {}
+
+    async def __aenter__(self):
+        self.in_flight = asyncio.BoundedSemaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, limit_per_host=self.max_in_flight)
+        self.session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.session.close()
+        self.session = None
+        return False
+
+    # Function to get the limiter of one realm, creating it on first use
+    def realm_limiter(self, realm_id):
+        limiter = self.realm_limiters.get(realm_id)
+        if limiter is None:
+            limiter = AsyncRealmLimiter(self.requests_per_minute, self.max_concurrent_per_realm)
+            self.realm_limiters[realm_id] = limiter
+        return limiter
+
+    # Function to send one call to QBO and return its decoded JSON
+    # Throttled and transient failures are retried under the retry policy, the same way the shared
+    # requests session does, and every attempt is recorded in /metrics
+    async def request(self, realm_id, method, path, access_token, params=None, body=None):
+        url = f"{self.base_url}{realm_id}/{path}"
+        if params:
+            url = f"{url}?{urlencode(params)}"
+
+        headers = {
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip',
+            'Authorization': f'Bearer {access_token}',
+        }
+        data = None
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+            data = json.dumps(body)
+
+        # The retry and metrics helpers only look at the method, URL and body of a request
+        request_info = SimpleNamespace(method=method, url=url, body=data)
+        call = classify_request(request_info)
+
+        started = time.monotonic()
+        attempt = 1
+
+        while True:
+            status = None
+            try:
+                # The realm's own limit is waited for first, so a throttled realm never sits on a global slot
+                # while other realms could be using it
+                async with self.realm_limiter(realm_id), self.in_flight:
+                    sent = time.monotonic()
+                    async with self.session.request(method, url, headers=headers, data=data) as response:
+                        status = response.status
+                        response_headers = response.headers
+                        text = await response.text()
+                        # aiohttp decompresses before we see the body, so the wire size comes from the header
+                        wire_size = response.content_length
+                    upstream_latency.observe(time.monotonic() - sent, call=call)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+                # A failed connect means the request never left, anything else may have reached QBO
+                if isinstance(err, aiohttp.ClientConnectorError):
+                    reason = 'connect_error'
+                elif is_idempotent(request_info):
+                    reason = 'connection_error'
+                else:
+                    raise
+                detail = str(err) or type(err).__name__
+                intuit_tid = ''
+                retry_after = None
+            else:
+                upstream_responses.inc(call=call, status=status)
+                if data:
+                    upstream_bytes_sent.inc(len(data), call=call)
+                    upstream_wire_bytes_sent.inc(len(data), call=call)
+                upstream_bytes_received.inc(len(text), call=call)
+                upstream_wire_bytes_received.inc(wire_size if wire_size is not None else len(text), call=call)
+
+                if 200 <= status < 300:
+                    return json.loads(text) if text else {}
+
+                intuit_tid = response_headers.get('intuit_tid', '')
+                if status in throttled_statuses:
+                    reason = 'throttled'
+                elif status in transient_statuses and is_idempotent(request_info):
+                    reason = 'server_error'
+                else:
+                    raise QBOAsyncError(status, text, intuit_tid)
+                detail = f'HTTP {status}'
+                retry_after = retry_after_seconds(SimpleNamespace(headers=response_headers))
+
+            delay = self.retry_policy.backoff(attempt)
+            if retry_after is not None:
+                delay = retry_after + random.uniform(0, self.retry_policy.base_delay)
+
+            elapsed = time.monotonic() - started
+            if attempt >= self.retry_policy.max_attempts or elapsed + delay > self.retry_policy.max_elapsed:
+                print(f"Giving up on {call} call after {attempt} attempts ({detail}, intuit_tid={intuit_tid})")
+                if status is None:
+                    raise QBOAsyncError(0, detail)
+                raise QBOAsyncError(status, text, intuit_tid)
+
+            print(f"Retrying {call} call in {delay:.2f}s after attempt {attempt} ({detail}, intuit_tid={intuit_tid})")
+            upstream_retries.inc(call=call, reason=reason)
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    # Function to fetch a single page of a query
+    async def query_page(self, realm_id, access_token, query, entity):
+        response = await self.request(realm_id, 'GET', 'query', access_token,
+                                      params={'query': query, 'minorversion': self.minorversion})
+
+        if 'QueryResponse' not in response:
+            raise ValueError('Unexpected JSON format in the response.')
+        return response['QueryResponse'].get(entity, [])
+
+    # Async generator that walks a query page by page using STARTPOSITION/MAXRESULTS
+    # Each page is yielded as a list, like qbo_query.query_pages
+    async def query_pages(self, realm_id, access_token, entity, query=None, max_results=max_page_size,
+                          fields=None, where=None, order_by=None):
+        query = prepare_query(entity, query, max_results, fields=fields, where=where, order_by=order_by)
+        start_position = 1
+
+        while True:
+            paged_query = f"{query} STARTPOSITION {start_position} MAXRESULTS {max_results}"
+            page = await self.query_page(realm_id, access_token, paged_query, entity)
+
+            if page:
+                yield page
+
+            # A short page means we have reached the end of the result set
+            if len(page) < max_results:
+                break
+
+            start_position += len(page)
+
+    # Async generator that yields every entity of a query one at a time
+    async def query_entities(self, realm_id, access_token, entity, query=None, max_results=max_page_size,
+                             fields=None, where=None, order_by=None):
+        async for page in self.query_pages(realm_id, access_token, entity, query=query, max_results=max_results,
+                                           fields=fields, where=where, order_by=order_by):
+            for element in page:
+                yield element
+
+    # Function to send the update for a single row
+    # Returns a result dict in the same shape as the batch results, plus the updated item on success
+    async def update_item(self, realm_id, access_token, row_number, item_body):
+        try:
+            response = await self.request(realm_id, 'POST', 'item', access_token,
+                                          params={'minorversion': self.minorversion}, body=item_body)
+        except (QBOAsyncError, aiohttp.ClientError, asyncio.TimeoutError) as err:
+            return {'row': row_number, 'Id': item_body.get('Id'), 'status': 'error', 'error': str(err)}
+
+        return {'row': row_number, 'Id': item_body.get('Id'), 'status': 'ok', 'Item': response.get('Item')}
+
+    # Function to update many items of one realm at once
+    # rows is an iterable of (row_number, item_body) pairs, it is read lazily by the workers so it can be a generator
+    # workers defaults to the realm's concurrency limit, more would only wait on the limiter
+    async def update_items(self, realm_id, access_token, rows, workers=None):
+        rows = iter(rows)
+        results = []
+
+        async def worker():
+            # Coroutines only switch at an await, so sharing the iterator is safe
+            for row_number, item_body in rows:
+                results.append(await self.update_item(realm_id, access_token, row_number, item_body))
+
+        await asyncio.gather(*(worker() for _ in range(workers or self.max_concurrent_per_realm)))
+
+        results.sort(key=lambda result: result['row'])
+        return results
+
+    # Function to get a valid access token from a TokenManager without blocking the event loop
+    # The refresh runs on a worker thread so it keeps the TokenManager's cross-process store locking, and
+    # coroutines asking for the same realm wait on a single refresh
+    async def get_access_token(self, token_manager):
+        token_manager.load()
+        if not token_manager.needs_refresh():
+            return token_manager.access_token
+
+        lock = self.refresh_locks.setdefault(id(token_manager), asyncio.Lock())
+        async with lock:
+            if not token_manager.needs_refresh():
+                return token_manager.access_token
+            return await asyncio.to_thread(token_manager.get_access_token)
@@ -0,0 +1,110 @@
+# qbo_batch.py
+
+import json
+from contextlib import nullcontext
+import requests
+from qbo_http import get_session
+from urllib.parse import urljoin
+
+# QBO accepts at most 30 operations in a single batch request
+max_batch_size = 30
+
+# Error code of a Stale Object Error, sent when the SyncToken of an update is not the current one
+stale_object_code = '5010'
+
+
+# Function to check whether the errors of a Fault include a Stale Object Error
+def is_stale_object_error(errors):
+    return any(str(error.get('code', '')) == stale_object_code for error in errors)
+
+
+# Function to split an iterable into lists of at most size elements
+def chunked(iterable, size):
+    chunk = []
+    for element in iterable:
+        chunk.append(element)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Function to send one batch request and return the BatchItemResponse list
+def send_batch(base_url, realm_id, headers, batch_item_requests, minorversion):
+    batch_endpoint = f"{realm_id}/batch?minorversion={minorversion}"
+    url = urljoin(base_url, batch_endpoint)
+
+    response = get_session().post(url, headers=headers, data=json.dumps({'BatchItemRequest': batch_item_requests}))
+    response.raise_for_status()  # Raise an HTTPError for bad responses (4xx and 5xx)
+
+    return response.json().get('BatchItemResponse', [])
+
+
+# Function to update entities through the /batch endpoint
+# rows is an iterable of (row_number, entity_body) pairs, the row number is used as the batch id
+# so every operation result can be mapped back to the CSV row it came from
+# If a limiter is given, every batch request is sent inside it
+# If on_success is given, it is called with the result and the updated entity of every successful row
+# If on_error is given, it is called with the result, the request body and the Fault errors of every failed row,
+# and may change the result in place, e.g. after sending the row again
+# If on_result is given, it is called with the final result of every row as soon as its batch is done
+# Returns one result dict per row, with 'status' set to 'ok' or 'error'
+def batch_update(base_url, realm_id, headers, entity, rows, minorversion, batch_size=max_batch_size, limiter=None,
+                 on_success=None, on_error=None, on_result=None):
+    if not 1 <= batch_size <= max_batch_size:
+        raise ValueError(f'batch_size must be between 1 and {max_batch_size}')
+
+    results = []
+
+    # Function to keep the final result of a row
+    def finish(result):
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    for chunk in chunked(rows, batch_size):
+        bodies = {str(row_number): body for row_number, body in chunk}
+        batch_item_requests = [
+            {'bId': batch_id, 'operation': 'update', entity: body}
+            for batch_id, body in bodies.items()
+        ]
+
+        try:
+            with limiter if limiter is not None else nullcontext():
+                batch_item_responses = send_batch(base_url, realm_id, headers, batch_item_requests, minorversion)
+        except requests.exceptions.RequestException as err:
+            # The whole batch failed, so every row in it failed
+            for batch_id, body in bodies.items():
+                finish({'row': int(batch_id), 'Id': body.get('Id'), 'status': 'error', 'error': str(err)})
+            continue
+
+        answered = set()
+        for batch_item_response in batch_item_responses:
+            batch_id = batch_item_response.get('bId')
+            if batch_id not in bodies:
+                continue
+            answered.add(batch_id)
+
+            result = {'row': int(batch_id), 'Id': bodies[batch_id].get('Id')}
+            if 'Fault' in batch_item_response:
+                errors = batch_item_response['Fault'].get('Error', [])
+                result['status'] = 'error'
+                result['error'] = '; '.join(
+                    f"{error.get('code', '')} {error.get('Message', '')}: {error.get('Detail', '')}" for error in errors
+                )
+                if on_error is not None:
+                    on_error(result, bodies[batch_id], errors)
+            else:
+                result['status'] = 'ok'
+                # The updated entity is handed to on_success rather than kept, so long runs stay small in memory
+                if on_success is not None:
+                    on_success(result, batch_item_response.get(entity))
+            finish(result)
+
+        # Operations QBO did not answer at all are reported as failures too
+        for batch_id in bodies.keys() - answered:
+            finish({'row': int(batch_id), 'Id': bodies[batch_id].get('Id'), 'status': 'error',
+                            'error': 'No response for batch operation'})
+
+    return results
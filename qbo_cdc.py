@@ -0,0 +1,166 @@
+# qbo_cdc.py
+
+import csv
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from qbo_http import get_session
+from token_store import atomic_write_json, locked_file
+
+# QBO only keeps change data for the last 30 days, stay an hour inside that to be safe
+cdc_window = timedelta(days=30) - timedelta(hours=1)
+
+# A CDC response holds at most 1000 entities of each type, past that we need a full pull
+max_cdc_entities = 1000
+
+# File where the last successful sync time is kept for every realm and entity
+watermarks_file = 'sync_watermarks.json'
+
+# The items and accounts scripts share the file, so updates hold this lock and a lock file next to it
+watermarks_lock = threading.Lock()
+
+
+# Function to read every stored watermark
+def load_watermarks(path=watermarks_file):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# Function to get the last sync time for one realm and entity, or None if it was never synced
+def get_watermark(realm_id, entity, path=watermarks_file):
+    watermark = load_watermarks(path).get(str(realm_id), {}).get(entity)
+    if watermark is None:
+        return None
+    return datetime.fromisoformat(watermark)
+
+
+# Function to store the sync time for one realm and entity
+# The file is read and written under the lock, so a sync running in another process does not lose its watermark
+def set_watermark(realm_id, entity, synced_at, path=watermarks_file):
+    with watermarks_lock:
+        with open(path + '.lock', 'a+') as lock_file:
+            with locked_file(lock_file):
+                watermarks = load_watermarks(path)
+                watermarks.setdefault(str(realm_id), {})[entity] = synced_at.isoformat(timespec='seconds')
+                atomic_write_json(path, watermarks)
+
+
+# Function to ask the ChangeDataCapture endpoint for everything changed since a point in time
+# Returns a dict with the list of changed (and deleted) entities for each requested entity type
+def fetch_changes(base_url, realm_id, access_token, entities, changed_since, minorversion):
+    api_url = f"{base_url}{realm_id}/cdc"
+
+    api_headers = {
+        'Accept': 'application/json',
+        'Authorization': f'Bearer {access_token}'
+    }
+
+    params = {
+        'entities': ','.join(entities),
+        'changedSince': changed_since.isoformat(timespec='seconds'),
+        'minorversion': minorversion,
+    }
+
+    response = get_session().get(api_url, headers=api_headers, params=params)
+    response.raise_for_status()  # Raise an HTTPError for bad responses (4xx and 5xx)
+
+    changes = {entity: [] for entity in entities}
+    for cdc_response in response.json().get('CDCResponse', []):
+        for query_response in cdc_response.get('QueryResponse', []):
+            for entity in entities:
+                changes[entity].extend(query_response.get(entity, []))
+
+    return changes
+
+
+# Function to merge changed and deleted entities into an existing CSV export
+# The export is streamed into a temporary file that then replaces the original, so only the
+# changed entities are held in memory
+# Returns None when the existing export has different columns and cannot be merged into
+def merge_changes_into_csv(csv_file_path, columns, entity_to_row, changed_entities):
+    deleted_ids = {str(entity['Id']) for entity in changed_entities if entity.get('status') == 'Deleted'}
+    changed = {str(entity['Id']): entity for entity in changed_entities if entity.get('status') != 'Deleted'}
+
+    id_index = columns.index('Id')
+    temp_path = csv_file_path + '.tmp'
+    updated_count = 0
+    deleted_count = 0
+
+    with open(csv_file_path, 'r', newline='', encoding='utf-8') as source_file, \
+            open(temp_path, 'w', newline='', encoding='utf-8') as merged_file:
+        reader = csv.reader(source_file)
+        if next(reader, None) != columns:
+            merged_file.close()
+            os.remove(temp_path)
+            return None
+
+        writer = csv.writer(merged_file)
+        writer.writerow(columns)
+
+        for row in reader:
+            row_id = row[id_index]
+            if row_id in deleted_ids:
+                deleted_count += 1
+            elif row_id in changed:
+                writer.writerow(entity_to_row(changed.pop(row_id)))
+                updated_count += 1
+            else:
+                writer.writerow(row)
+
+        # Whatever is left was created since the last sync
+        for entity in changed.values():
+            writer.writerow(entity_to_row(entity))
+
+    os.replace(temp_path, csv_file_path)
+
+    return {'updated': updated_count, 'created': len(changed), 'deleted': deleted_count}
+
+
+# Function to bring a CSV export up to date using ChangeDataCapture
+# full_export is called (and must return the usual result or error dict) when there is no usable
+# watermark, no existing export, or more changes than one CDC response can hold
+def incremental_sync(base_url, realm_id, access_token, entity, minorversion, csv_file_path, columns, entity_to_row,
+                     full_export, watermarks_path=watermarks_file):
+    started = time.perf_counter()
+    synced_at = datetime.now(timezone.utc)
+    watermark = get_watermark(realm_id, entity, watermarks_path)
+
+    full_pull_reason = None
+    merge_result = None
+
+    if watermark is None:
+        full_pull_reason = 'no previous sync'
+    elif synced_at - watermark > cdc_window:
+        full_pull_reason = 'last sync is older than the CDC window'
+    elif not os.path.exists(csv_file_path):
+        full_pull_reason = 'no existing export to merge into'
+    else:
+        changed_entities = fetch_changes(base_url, realm_id, access_token, [entity], watermark, minorversion)[entity]
+
+        if len(changed_entities) >= max_cdc_entities:
+            full_pull_reason = 'too many changes for a single CDC response'
+        else:
+            merge_result = merge_changes_into_csv(csv_file_path, columns, entity_to_row, changed_entities)
+            if merge_result is None:
+                full_pull_reason = 'existing export has different columns'
+
+    if full_pull_reason is not None:
+        print(f"Full {entity} pull: {full_pull_reason}")
+        result = full_export()
+        if 'error' in result:
+            return result
+        result.update({'mode': 'full', 'reason': full_pull_reason})
+    else:
+        result = dict(merge_result, mode='incremental', csv_file_path=csv_file_path)
+        print(f"Incremental {entity} sync: {merge_result['updated']} updated, {merge_result['created']} created, "
+              f"{merge_result['deleted']} deleted")
+
+    set_watermark(realm_id, entity, synced_at, watermarks_path)
+    result['seconds'] = time.perf_counter() - started
+
+    return result
@@ -0,0 +1,263 @@
+# qbo_cli.py
+
+import time
+
+# Taken before anything else is imported, so --timings can report how long the imports took
+process_started = time.perf_counter()
+
+import argparse
+import sys
+
+# These are the Credentials, same as in the Flask scripts
+client_id = "[Enter_Client_ID]"
+client_secret = "[Enter_Client_Secret]"
+redirect_uri = "http://localhost:5000/callback"
+token_endpoint = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
+
+# Headless entry point for cron and other schedulers, using the tokens saved by logging in once with a Flask script
+#
+#     python qbo_cli.py refresh-token --realm-id 1234
+#     python qbo_cli.py export-items --realm-id 1234 --format csv.gz
+#     python qbo_cli.py export-accounts --realm-id 1234 --incremental
+#     python qbo_cli.py update-items --realm-id 1234 --csv items.csv --batch
+#
+# Only argparse is imported up front, every command imports what it needs when it runs, so --help and
+# refresh-token never load Flask. Add --timings to print the import and run time of a command, or run
+# python -X importtime qbo_cli.py ... to see the cost of every module
+
+
+# Function to get a token manager for the realm on top of the stored tokens
+def get_token_manager(args):
+    from token_manager import TokenManager
+    from token_store import FileTokenStore, SQLiteTokenStore
+
+    if args.tokens_db:
+        store = SQLiteTokenStore(args.tokens_db)
+    else:
+        store = FileTokenStore(args.tokens)
+
+    return TokenManager(client_id, client_secret, redirect_uri, token_endpoint, store=store, realm_id=args.realm_id)
+
+
+# Function to get a valid access token, refreshing it if it is about to expire
+# Returns None when the stored tokens cannot be used, after printing why, so the command can exit with 1
+def get_access_token(token_manager):
+    from token_manager import TokenError
+
+    try:
+        return token_manager.get_access_token()
+    except TokenError as err:
+        print(f"Token refresh failed: {err}", file=sys.stderr)
+        return None
+
+
+# Function to print an error dict from one of the scripts and return the exit code
+def report_error(response):
+    print(f"Error in API call: {response['error']['code']}, {response['error']['message']}", file=sys.stderr)
+    return 1
+
+
+# Function to print the result of an export
+def report_export(response, entity_name):
+    if 'error' in response:
+        return report_error(response)
+
+    if response.get('mode') == 'incremental':
+        print(f"Incremental sync completed in {response['seconds']:.2f}s: {response['updated']} updated, "
+              f"{response['created']} created, {response['deleted']} deleted.")
+    else:
+        print(f"Exported {response['count']} {entity_name} to {response.get('export_path', '')}.")
+    return 0
+
+
+# Command to make sure the realm has a valid access token, refreshing it if it is about to expire
+def refresh_token(args):
+    from token_manager import TokenError
+
+    token_manager = get_token_manager(args)
+    mark_imported(args)
+
+    try:
+        if args.force:
+            token_manager.load()
+            access_token = token_manager.refresh_access_token()
+        else:
+            access_token = token_manager.get_access_token()
+    except TokenError as err:
+        print(f"Token refresh failed: {err}", file=sys.stderr)
+        return 1
+
+    if args.print_token:
+        print(access_token)
+    else:
+        expires_in = token_manager.expires_at - time.time()
+        print(f"Access token for realm {args.realm_id} is valid for another {expires_in / 60:.0f} minutes.")
+    return 0
+
+
+# Command to export every item of the realm
+def export_items(args):
+    import GetItems
+
+    token_manager = get_token_manager(args)
+    mark_imported(args)
+    access_token = get_access_token(token_manager)
+    if access_token is None:
+        return 1
+
+    if args.incremental:
+        response = GetItems.sync_items(args.realm_id, access_token, max_results=args.max_results)
+    else:
+        response = GetItems.make_api_request(args.realm_id, access_token, max_results=args.max_results,
+                                             export_format=args.format)
+    return report_export(response, 'items')
+
+
+# Command to export every account of the realm
+def export_accounts(args):
+    import GetAccounts
+
+    token_manager = get_token_manager(args)
+    mark_imported(args)
+    access_token = get_access_token(token_manager)
+    if access_token is None:
+        return 1
+
+    if args.incremental:
+        response = GetAccounts.sync_accounts(args.realm_id, access_token, max_results=args.max_results)
+    else:
+        response = GetAccounts.make_api_request(args.realm_id, access_token, max_results=args.max_results,
+                                                export_format=args.format)
+    return report_export(response, 'accounts')
+
+
+# Command to send the item updates in a CSV file
+def update_items(args):
+    import UpdateItems
+    from qbo_http import configure_session
+
+    if args.compress_min_bytes:
+        configure_session(compress_min_bytes=args.compress_min_bytes)
+
+    token_manager = get_token_manager(args)
+    mark_imported(args)
+    access_token = get_access_token(token_manager)
+    if access_token is None:
+        return 1
+
+    summary = UpdateItems.run_item_updates(
+        args.realm_id, access_token, csv_file=args.csv, use_batch=args.batch, batch_size=args.batch_size,
+        workers=args.workers, requests_per_minute=args.rate,
+        use_diff=not args.no_diff, start_row=max(args.start_row, 2), refresh_accounts=args.refresh_accounts,
+        validate_only=args.validate_only, fill_mirror=args.fetch_first,
+    )
+    if 'error' in summary:
+        return report_error(summary)
+
+    if args.validate_only:
+        print(f"{summary['to_send']} rows would be sent, {summary['unchanged']} unchanged, "
+              f"{summary['rejected']} rejected.")
+        for failure in summary['failures']:
+            print(f"Row {failure['row']} (Id {failure['Id']}): {failure['error']}", file=sys.stderr)
+        return 1 if summary['rejected'] else 0
+
+    print(f"{summary['updated']} updated, {summary['failed']} failed, {summary['unchanged']} unchanged rows skipped "
+          f"in {summary['seconds']:.2f}s. Last finished CSV row: {summary['last_row']}")
+    for failure in summary['failures']:
+        print(f"Row {failure['row']} (Id {failure['Id']}): {failure['error']}", file=sys.stderr)
+
+    return 1 if summary['failed'] else 0
+
+
+# Function to make an argparse type for whole numbers in a range, so a bad value stops at the command line
+# The limits are written out rather than imported, so --help does not load the modules that define them
+def int_between(lowest, highest):
+    def parse(value):
+        try:
+            number = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'{value!r} is not a whole number')
+        if not lowest <= number <= highest:
+            raise argparse.ArgumentTypeError(f'must be between {lowest} and {highest}, got {number}')
+        return number
+
+    return parse
+
+
+# Function to note when a command has finished importing, for --timings
+def mark_imported(args):
+    if args.imported_at is None:
+        args.imported_at = time.perf_counter()
+
+
+# Function to build the argument parser
+# Defaults are plain numbers here so building the parser does not import the modules that define them
+def build_parser():
+    parser = argparse.ArgumentParser(prog='qbo_cli.py', description='Run QBO exports and updates without a browser.')
+    parser.add_argument('--timings', action='store_true', help='print import and run time of the command')
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--realm-id', required=True, help='QBO company (realm) id')
+    common.add_argument('--tokens', default='tokens.json',
+                        help='tokens file, may contain {realm_id} (default: tokens.json)')
+    common.add_argument('--tokens-db', help='use a SQLite token store instead of the tokens file')
+
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('refresh-token', parents=[common], help='refresh the stored access token')
+    command.add_argument('--force', action='store_true', help='refresh even if the token is still valid')
+    command.add_argument('--print-token', action='store_true', help='print the access token')
+    command.set_defaults(run=refresh_token)
+
+    for name, run, entity_name in (('export-items', export_items, 'items'),
+                                   ('export-accounts', export_accounts, 'accounts')):
+        command = commands.add_parser(name, parents=[common], help=f'export every {entity_name[:-1]}')
+        command.add_argument('--format', default='csv', choices=['csv', 'csv.gz', 'ndjson', 'ndjson.gz', 'sqlite'])
+        command.add_argument('--max-results', type=int, default=1000, help='page size, at most 1000')
+        command.add_argument('--incremental', action='store_true',
+                             help=f'only fetch {entity_name} changed since the last run (CSV only)')
+        command.set_defaults(run=run)
+
+    command = commands.add_parser('update-items', parents=[common], help='send the item updates in a CSV file')
+    command.add_argument('--csv', default='items.csv', help='CSV file with the updates (default: items.csv)')
+    command.add_argument('--batch', action='store_true', help='send the updates through the /batch endpoint')
+    command.add_argument('--batch-size', type=int_between(1, 30), default=30,
+                         help='operations per batch request, at most 30')
+    command.add_argument('--workers', type=int_between(1, 10), default=1, help='parallel update requests, at most 10')
+    command.add_argument('--rate', type=int_between(1, 500), default=500,
+                         help='requests per minute for the realm, at most 500')
+    command.add_argument('--no-diff', action='store_true', help='send every row, even unchanged ones')
+    command.add_argument('--start-row', type=int, default=2, help='CSV row to resume from (the header is row 1)')
+    command.add_argument('--fetch-first', action='store_true',
+                         help='fill the entity mirror with every item first if it has none for the realm')
+    command.add_argument('--refresh-accounts', action='store_true',
+                         help='fetch the chart of accounts again to resolve account names')
+    command.add_argument('--validate-only', action='store_true',
+                         help='check the CSV and write the rejection report without sending anything')
+    command.add_argument('--compress-min-bytes', type=int,
+                         help='gzip update and batch bodies of at least this many bytes')
+    command.set_defaults(run=update_items)
+
+    return parser
+
+
+# Function to run the CLI and return the exit code
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.imported_at = None
+
+    command_started = time.perf_counter()
+    exit_code = args.run(args)
+    finished = time.perf_counter()
+
+    if args.timings:
+        imported_at = args.imported_at or command_started
+        print(f"Timings: startup {(command_started - process_started) * 1000:.1f} ms, "
+              f"command imports {(imported_at - command_started) * 1000:.1f} ms, "
+              f"run {(finished - imported_at) * 1000:.1f} ms", file=sys.stderr)
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,45 @@
+# qbo_executor.py
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from qbo_rate_limit import get_realm_limiter, default_requests_per_minute, default_max_concurrent
+
+
+# Function to run task(job) for every job on a thread pool, throttled by the realm's shared limiter
+# Only a few jobs per worker are queued at a time, so jobs can be a lazy generator of any length
+# Returns the list of task results (in completion order) and a dict with throughput statistics
+def run_concurrently(task, jobs, realm_id, max_workers=default_max_concurrent,
+                     requests_per_minute=default_requests_per_minute, max_concurrent=default_max_concurrent):
+    limiter = get_realm_limiter(realm_id, requests_per_minute, max_concurrent)
+
+    def run(job):
+        with limiter:
+            return task(job)
+
+    results = []
+    max_pending = max_workers * 2
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = set()
+
+        for job in jobs:
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                results.extend(future.result() for future in done)
+            pending.add(pool.submit(run, job))
+
+        done, _ = wait(pending)
+        results.extend(future.result() for future in done)
+
+    elapsed = time.perf_counter() - started
+    stats = {
+        'count': len(results),
+        'seconds': elapsed,
+        'per_second': len(results) / elapsed if elapsed > 0 else 0.0,
+        'workers': max_workers,
+        'requests_per_minute': requests_per_minute,
+    }
+    print(f"Processed {stats['count']} jobs in {elapsed:.2f}s ({stats['per_second']:.1f}/s, {max_workers} workers)")
+
+    return results, stats
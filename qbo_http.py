@@ -0,0 +1,185 @@
+# qbo_http.py
+
+import gzip
+import threading
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from qbo_rate_limit import default_max_concurrent
+from qbo_metrics import CallbackGauge, classify_request, record_response
+from qbo_retry import send_with_retries, default_policy
+
+# Keep as many connections per host as we allow requests in flight per realm
+default_pool_maxsize = default_max_concurrent
+
+# Every call asks for gzip responses, QBO compresses its JSON when asked, which shrinks query pages several times
+accept_encoding = 'gzip'
+
+# Update and batch bodies at least this many bytes are sent gzip compressed, None sends every body as is
+# QBO does not document compressed request bodies, so this stays off unless configure_session switches it on,
+# and a host that answers 415 Unsupported Media Type gets plain bodies from then on
+default_compress_min_bytes = None
+
+# Calls whose request bodies may be compressed, token calls are form posts to Intuit's OAuth server
+compressible_calls = ('update', 'batch')
+
+# Counters shared by every pooled connection in the process
+connection_counters = {'requests': 0, 'new_connections': 0}
+connection_counters_lock = threading.Lock()
+
+
+# Function to increment one of the connection counters
+def count(counter):
+    with connection_counters_lock:
+        connection_counters[counter] += 1
+
+
+# Connection pools that count every new TCP (+TLS) connection they open
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        count('new_connections')
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        count('new_connections')
+        return super()._new_conn()
+
+
+# Adapter that keeps connections alive in counting pools and counts every request sent
+class PooledHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        count('requests')
+        return super().send(request, **kwargs)
+
+
+# Function to gzip the body of a prepared request in place if it is large enough
+# The size before compression is kept on the request for the byte counters in /metrics
+# Returns the original body, for restore_request_body, or None if the request was left alone
+def compress_request_body(request, min_bytes):
+    if min_bytes is None or not request.body or 'Content-Encoding' in request.headers:
+        return None
+    if classify_request(request) not in compressible_calls:
+        return None
+
+    body = request.body
+    raw = body.encode('utf-8') if isinstance(body, str) else body
+    if len(raw) < min_bytes:
+        return None
+
+    request.body = gzip.compress(raw, compresslevel=6)
+    request.headers['Content-Encoding'] = 'gzip'
+    request.headers['Content-Length'] = str(len(request.body))
+    request.uncompressed_body_size = len(raw)
+    return body
+
+
+# Function to put back the body compress_request_body replaced
+def restore_request_body(request, body):
+    request.body = body
+    del request.headers['Content-Encoding']
+    request.prepare_content_length(body)
+    del request.uncompressed_body_size
+
+
+# Session that retries throttled and transient failures of every call it sends
+# Retries happen below the response hooks, so every attempt shows up in /metrics
+# Large update and batch bodies are compressed once, before the first attempt, when compress_min_bytes is set
+class RetryingSession(requests.Session):
+    def __init__(self, retry_policy=default_policy, compress_min_bytes=default_compress_min_bytes):
+        super().__init__()
+        self.retry_policy = retry_policy
+        self.compress_min_bytes = compress_min_bytes
+        self.headers['Accept-Encoding'] = accept_encoding
+        # Hosts that refused a compressed body
+        self.plain_body_hosts = set()
+
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).netloc
+        plain_body = None
+        if host not in self.plain_body_hosts:
+            plain_body = compress_request_body(request, self.compress_min_bytes)
+
+        response = send_with_retries(super().send, request, self.retry_policy, **kwargs)
+
+        if plain_body is not None and response.status_code == 415:
+            print(f"{host} does not accept compressed request bodies, sending them uncompressed from now on")
+            self.plain_body_hosts.add(host)
+            response.close()
+            restore_request_body(request, plain_body)
+            response = send_with_retries(super().send, request, self.retry_policy, **kwargs)
+
+        return response
+
+
+# The shared session, created on first use
+shared_session = None
+shared_adapter = None
+shared_session_lock = threading.Lock()
+
+
+# Function to (re)create the shared session with a pool sized for the given concurrency
+# retry_policy sets the retry budget of every call, pass qbo_retry.no_retries to switch retries off
+# compress_min_bytes switches on gzip compression of update and batch bodies of at least that many bytes
+def configure_session(pool_maxsize=default_pool_maxsize, retry_policy=default_policy,
+                      compress_min_bytes=default_compress_min_bytes):
+    global shared_session, shared_adapter
+
+    with shared_session_lock:
+        if shared_session is not None:
+            shared_session.close()
+
+        shared_adapter = PooledHTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize,
+                                           pool_block=True)
+        shared_session = RetryingSession(retry_policy, compress_min_bytes)
+        shared_session.mount('https://', shared_adapter)
+        shared_session.mount('http://', shared_adapter)
+        shared_session.hooks['response'].append(record_response)
+
+        return shared_session
+
+
+# Function to get the shared keep-alive session used for every QBO and OAuth call
+def get_session():
+    if shared_session is None:
+        return configure_session()
+    return shared_session
+
+
+# Function to report connection pool statistics
+# reused is the number of requests that did not need a new connection (no new TCP/TLS handshake)
+def pool_stats():
+    with connection_counters_lock:
+        stats = dict(connection_counters)
+
+    stats['reused'] = max(0, stats['requests'] - stats['new_connections'])
+    stats['pool_maxsize'] = shared_adapter._pool_maxsize if shared_adapter is not None else 0
+
+    # Idle connections are the ones parked in a pool waiting to be reused
+    open_pools = 0
+    idle_connections = 0
+    if shared_adapter is not None:
+        for pool_key in list(shared_adapter.poolmanager.pools.keys()):
+            pool = shared_adapter.poolmanager.pools.get(pool_key)
+            if pool is None or pool.pool is None:
+                continue
+            open_pools += 1
+            idle_connections += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+
+    stats['open_pools'] = open_pools
+    stats['idle_connections'] = idle_connections
+
+    return stats
+
+
+# Expose the pool statistics on /metrics as well
+CallbackGauge('qbo_http_pool', 'Connection pool statistics', 'stat', pool_stats)
@@ -0,0 +1,201 @@
+# qbo_metrics.py
+
+import gzip
+import threading
+from urllib.parse import urlparse
+
+# Latency buckets in seconds
+default_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Every metric registers itself here so /metrics can render them all
+registry = []
+metrics_lock = threading.Lock()
+
+
+# Function to turn a dict of labels into the Prometheus {name="value"} form
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + pairs + '}'
+
+
+# A value that only goes up, with one series per combination of labels
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple((name, labels[name]) for name in self.label_names)
+        with metrics_lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    # Function to get the sum of every series
+    def total(self):
+        with metrics_lock:
+            return sum(self.values.values())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with metrics_lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(key)} {value}')
+        return lines
+
+
+# Counts observations into cumulative buckets, with one series per combination of labels
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=default_buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple((name, labels[name]) for name in self.label_names)
+        with metrics_lock:
+            series = self.series.get(key)
+            if series is None:
+                series = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                self.series[key] = series
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with metrics_lock:
+            for key, series in sorted(self.series.items()):
+                for bound, bucket_count in zip(self.buckets, series['buckets']):
+                    lines.append(f'{self.name}_bucket{format_labels(key + (("le", bound),))} {bucket_count}')
+                lines.append(f'{self.name}_bucket{format_labels(key + (("le", "+Inf"),))} {series["count"]}')
+                lines.append(f'{self.name}_sum{format_labels(key)} {series["sum"]}')
+                lines.append(f'{self.name}_count{format_labels(key)} {series["count"]}')
+        return lines
+
+
+# Gauges read their current values from a function when /metrics is scraped
+# The function returns a dict, and every key becomes a series with the label given by label_name
+class CallbackGauge:
+    def __init__(self, name, help_text, label_name, read_values):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.read_values = read_values
+        registry.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge']
+        for key, value in sorted(self.read_values().items()):
+            lines.append(f'{self.name}{format_labels(((self.label_name, key),))} {value}')
+        return lines
+
+
+# Upstream call metrics
+upstream_latency = Histogram('qbo_upstream_latency_seconds',
+                             'Time until the response headers of an upstream call arrive', ['call'])
+upstream_responses = Counter('qbo_upstream_responses_total', 'Upstream responses by call type and status code',
+                             ['call', 'status'])
+upstream_bytes_sent = Counter('qbo_upstream_bytes_sent_total',
+                              'Request body bytes sent upstream, before compression', ['call'])
+upstream_bytes_received = Counter('qbo_upstream_bytes_received_total',
+                                  'Response body bytes received from upstream, after decompression', ['call'])
+upstream_wire_bytes_sent = Counter('qbo_upstream_wire_bytes_sent_total',
+                                   'Request body bytes put on the wire, after compression', ['call'])
+upstream_wire_bytes_received = Counter('qbo_upstream_wire_bytes_received_total',
+                                       'Response body bytes read off the wire, before decompression', ['call'])
+upstream_retries = Counter('qbo_upstream_retries_total', 'Upstream calls sent again, by call type and reason',
+                           ['call', 'reason'])
+
+# Entity metrics
+entities_exported = Counter('qbo_entities_exported_total', 'Entities written to an export', ['entity'])
+entities_updated = Counter('qbo_entities_updated_total', 'Entity updates by result', ['entity', 'status'])
+
+
+# Function to get the body of a request as text, undoing gzip request compression
+def request_body_text(request):
+    body = request.body or ''
+    if isinstance(body, bytes):
+        if body[:2] == b'\x1f\x8b':
+            body = gzip.decompress(body)
+        body = body.decode('utf-8', 'replace')
+    return body
+
+
+# Function to get how many body bytes of a response were read off the wire
+# This is less than the decoded body when the response was compressed, default is used when the
+# underlying urllib3 response cannot tell
+def wire_bytes_read(response, default=0):
+    tell = getattr(response.raw, 'tell', None)
+    if tell is None:
+        return default
+    try:
+        return tell()
+    except (OSError, ValueError):
+        return default
+
+
+# Function to work out which kind of upstream call a request is, from its URL and body
+def classify_request(request):
+    path = urlparse(request.url).path
+
+    if '/oauth2/' in path:
+        body = request_body_text(request)
+        return 'token_refresh' if 'grant_type=refresh_token' in body else 'token_exchange'
+
+    path = path.rstrip('/')
+    if path.endswith('/query'):
+        return 'query'
+    if path.endswith('/batch'):
+        return 'batch'
+    if path.endswith('/cdc'):
+        return 'cdc'
+    if path.endswith('/item'):
+        return 'update'
+    return 'other'
+
+
+# Response hook for the shared session, records latency, status code and bytes of every upstream call
+# Bytes are counted both as the payload size and as the size on the wire, so the saving of compression shows
+# Streamed responses are not read here, their body bytes are counted by whoever reads the stream
+def record_response(response, stream=False, **kwargs):
+    call = classify_request(response.request)
+
+    upstream_latency.observe(response.elapsed.total_seconds(), call=call)
+    upstream_responses.inc(call=call, status=response.status_code)
+
+    # Compressed bodies remember their size before compression, see qbo_http.compress_request_body
+    body = response.request.body
+    if body:
+        upstream_bytes_sent.inc(getattr(response.request, 'uncompressed_body_size', len(body)), call=call)
+        upstream_wire_bytes_sent.inc(len(body), call=call)
+
+    if not stream:
+        size = len(response.content)
+        upstream_bytes_received.inc(size, call=call)
+        upstream_wire_bytes_received.inc(wire_bytes_read(response, size), call=call)
+
+    return response
+
+
+# Function to render every registered metric in the Prometheus text format
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Content type Prometheus expects from a scrape
+metrics_content_type = 'text/plain; version=0.0.4; charset=utf-8'
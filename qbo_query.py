@@ -0,0 +1,187 @@
+# qbo_query.py
+
+import time
+from qbo_http import get_session, accept_encoding
+from qbo_stream import iter_query_response_entities
+from qbo_metrics import upstream_wire_bytes_received, wire_bytes_read
+
+# QBO will never return more than 1000 entities in a single query page
+max_page_size = 1000
+
+# Set to True to print every entity as it is received, this is slow for large catalogs
+debug_responses = False
+
+
+# Function to fetch a single page of a query
+# The response is streamed and its entities are yielded one at a time as they are parsed off the socket,
+# so the full payload is never held in memory
+def stream_query_page(base_url, realm_id, access_token, query, entity, minorversion):
+    # Construct the complete URL for the API call
+    api_url = f"{base_url}{realm_id}/query"
+
+    # Set the headers for the request
+    api_headers = {
+        'Accept': 'application/json',  # Specify that you want JSON responses
+        'Accept-Encoding': accept_encoding,  # Query pages are large and compress well
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {access_token}'
+    }
+
+    # Make the GET request, letting requests encode the query string
+    response = get_session().get(api_url, headers=api_headers, params={'query': query, 'minorversion': minorversion},
+                                 stream=True)
+    try:
+        response.raise_for_status()  # Raise an HTTPError for bad responses (4xx and 5xx)
+
+        for element in iter_query_response_entities(response, entity):
+            if debug_responses:
+                print("API Response:", element)
+            yield element
+    finally:
+        # The decoded bytes are counted while parsing, the bytes on the wire once the page is done
+        upstream_wire_bytes_received.inc(wire_bytes_read(response), call='query')
+        response.close()
+
+
+# Function to record and print the timing of one page
+def record_page(page_timings, entity, page_number, start_position, count, elapsed):
+    print(f"Fetched {entity} page {page_number}: {count} entities in {elapsed:.3f}s")
+    if page_timings is not None:
+        page_timings.append({
+            'page': page_number,
+            'start_position': start_position,
+            'count': count,
+            'seconds': elapsed,
+        })
+
+
+# Function to write a Python value as a QBO query literal
+# Strings are quoted with backslash escapes, and lists become the (a, b, c) form used by IN
+def query_literal(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return '(' + ', '.join(query_literal(element) for element in value) + ')'
+    return "'" + str(value).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+# Function to build a QBO query
+# fields is a list of fields to select, None selects every field. QBO then only returns those fields and
+#   marks each entity sparse, so nested fields like MetaData are selected by their top level name
+# where is either a ready made condition string, or a list of (field, operator, value) conditions joined with AND
+# order_by is a field, optionally followed by ASC or DESC
+# STARTPOSITION and MAXRESULTS are added per page by query_pages and query_entities
+def build_query(entity, fields=None, where=None, order_by=None):
+    query = f"select {', '.join(fields) if fields else '*'} from {entity}"
+
+    if where:
+        if not isinstance(where, str):
+            where = ' AND '.join(f"{field} {operator} {query_literal(value)}" for field, operator, value in where)
+        query += f" WHERE {where}"
+
+    if order_by:
+        query += f" ORDERBY {order_by}"
+
+    return query
+
+
+# Function to check the page size and build the base query
+def prepare_query(entity, query, max_results, fields=None, where=None, order_by=None):
+    if not 1 <= max_results <= max_page_size:
+        raise ValueError(f'max_results must be between 1 and {max_page_size}')
+
+    if query is None:
+        query = build_query(entity, fields=fields, where=where, order_by=order_by)
+
+    return query
+
+
+# Function to fetch one page of a query by its number, starting at 1, without walking the pages before it
+# Returns the page as a list, which is empty past the end of the result set
+def query_page(base_url, realm_id, access_token, entity, minorversion, page_number, query=None,
+               max_results=max_page_size, fields=None, where=None, order_by=None):
+    query = prepare_query(entity, query, max_results, fields=fields, where=where, order_by=order_by)
+    if page_number < 1:
+        raise ValueError('page_number must be 1 or more')
+
+    start_position = (page_number - 1) * max_results + 1
+    paged_query = f"{query} STARTPOSITION {start_position} MAXRESULTS {max_results}"
+
+    started = time.perf_counter()
+    page = list(stream_query_page(base_url, realm_id, access_token, paged_query, entity, minorversion))
+    record_page(None, entity, page_number, start_position, len(page), time.perf_counter() - started)
+
+    return page
+
+
+# Generator that walks a query page by page using STARTPOSITION/MAXRESULTS
+# Each page is yielded as a list as soon as it arrives, so callers never hold more than one page
+# If page_timings is a list, a dict with the timing of every page is appended to it
+# fields, where and order_by build the query with build_query when no query is given
+def query_pages(base_url, realm_id, access_token, entity, minorversion, query=None, max_results=max_page_size,
+                page_timings=None, fields=None, where=None, order_by=None):
+    query = prepare_query(entity, query, max_results, fields=fields, where=where, order_by=order_by)
+
+    start_position = 1
+    page_number = 1
+
+    while True:
+        paged_query = f"{query} STARTPOSITION {start_position} MAXRESULTS {max_results}"
+
+        started = time.perf_counter()
+        page = list(stream_query_page(base_url, realm_id, access_token, paged_query, entity, minorversion))
+        elapsed = time.perf_counter() - started
+
+        record_page(page_timings, entity, page_number, start_position, len(page), elapsed)
+
+        # Pages past the end of the result set have no entities at all
+        if page:
+            yield page
+
+        # A short page means we have reached the end of the result set
+        if len(page) < max_results:
+            break
+
+        start_position += len(page)
+        page_number += 1
+
+
+# Generator that yields every entity of a query one at a time, as each one is parsed off the socket
+# Memory use does not depend on the page size, and page timings only count time spent fetching and
+# parsing, not time the caller spends handling each entity
+def query_entities(base_url, realm_id, access_token, entity, minorversion, query=None, max_results=max_page_size,
+                   page_timings=None, fields=None, where=None, order_by=None):
+    query = prepare_query(entity, query, max_results, fields=fields, where=where, order_by=order_by)
+
+    start_position = 1
+    page_number = 1
+
+    while True:
+        paged_query = f"{query} STARTPOSITION {start_position} MAXRESULTS {max_results}"
+
+        page = stream_query_page(base_url, realm_id, access_token, paged_query, entity, minorversion)
+        count = 0
+        elapsed = 0.0
+
+        while True:
+            started = time.perf_counter()
+            try:
+                element = next(page)
+            except StopIteration:
+                elapsed += time.perf_counter() - started
+                break
+            elapsed += time.perf_counter() - started
+
+            count += 1
+            yield element
+
+        record_page(page_timings, entity, page_number, start_position, count, elapsed)
+
+        # A short page means we have reached the end of the result set
+        if count < max_results:
+            break
+
+        start_position += count
+        page_number += 1
@@ -0,0 +1,127 @@
+# qbo_rate_limit.py
+
+import threading
+import time
+from contextlib import contextmanager
+
+# QBO throttles each realm (company) to about 500 requests per minute and 10 concurrent requests
+default_requests_per_minute = 500
+default_max_concurrent = 10
+
+
+# Token bucket that hands out rate / 60 tokens per second, up to a burst of capacity tokens
+class TokenBucket:
+    def __init__(self, requests_per_minute=default_requests_per_minute, capacity=None):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Take one token, sleeping until one is available
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    # Function to change the rate, tokens earned so far are kept up to the new capacity
+    def set_rate(self, requests_per_minute):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            self.rate = requests_per_minute / 60.0
+            self.capacity = max(1.0, self.rate)
+            self.tokens = min(self.capacity, self.tokens)
+
+
+# Limiter for a single realm, combining the request rate with a cap on requests in flight
+# Use it as a context manager around every upstream call: with limiter: requests.post(...)
+# The in-flight count is kept by hand rather than with a semaphore, so the cap can be changed while in use
+class RealmLimiter:
+    def __init__(self, requests_per_minute=default_requests_per_minute, max_concurrent=default_max_concurrent):
+        self.requests_per_minute = requests_per_minute
+        self.max_concurrent = max_concurrent
+        self.bucket = TokenBucket(requests_per_minute)
+        self.in_flight = 0
+        self.in_flight_changed = threading.Condition()
+
+    # Function to change the rate and concurrency of the realm for every thread that shares the limiter
+    def reconfigure(self, requests_per_minute, max_concurrent):
+        if requests_per_minute != self.requests_per_minute:
+            self.bucket.set_rate(requests_per_minute)
+            self.requests_per_minute = requests_per_minute
+
+        with self.in_flight_changed:
+            self.max_concurrent = max_concurrent
+            self.in_flight_changed.notify_all()
+
+    # Function to wait for one of the realm's in-flight slots
+    def acquire_slot(self):
+        with self.in_flight_changed:
+            self.in_flight_changed.wait_for(lambda: self.in_flight < self.max_concurrent)
+            self.in_flight += 1
+
+    # Function to give back an in-flight slot
+    def release_slot(self):
+        with self.in_flight_changed:
+            self.in_flight -= 1
+            self.in_flight_changed.notify()
+
+    # Context manager holding an in-flight slot without taking from the rate budget, for a few calls in a row
+    # that each take their own request with spend()
+    @contextmanager
+    def slot(self):
+        self.acquire_slot()
+        try:
+            yield self
+        finally:
+            self.release_slot()
+
+    # Function to take one request from the realm's rate budget, for every extra call made while a slot is held
+    def spend(self):
+        self.bucket.acquire()
+
+    def __enter__(self):
+        self.acquire_slot()
+        try:
+            self.bucket.acquire()
+        except BaseException:
+            self.release_slot()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release_slot()
+        return False
+
+
+# One limiter per realm_id, shared by every thread in the process
+realm_limiters = {}
+realm_limiters_lock = threading.Lock()
+
+
+# Function to get the shared limiter for a realm, creating it on first use
+# A realm keeps the same limiter for the life of the process, so every thread shares one budget
+# If the rate or concurrency changes, the limiter is reconfigured in place and the latest settings apply to everyone
+def get_realm_limiter(realm_id, requests_per_minute=default_requests_per_minute,
+                      max_concurrent=default_max_concurrent):
+    with realm_limiters_lock:
+        limiter = realm_limiters.get(realm_id)
+        if limiter is None:
+            limiter = RealmLimiter(requests_per_minute, max_concurrent)
+            realm_limiters[realm_id] = limiter
+        elif limiter.requests_per_minute != requests_per_minute or limiter.max_concurrent != max_concurrent:
+            limiter.reconfigure(requests_per_minute, max_concurrent)
+        return limiter
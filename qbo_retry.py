@@ -0,0 +1,142 @@
+# qbo_retry.py
+
+import random
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import requests
+from qbo_metrics import classify_request, request_body_text, upstream_retries
+
+# Status codes worth another attempt
+# 429 means QBO throttled the request and did nothing with it, so any request can be sent again
+# The 5xx codes may come back after the request was applied, so only idempotent-safe requests are retried on them
+throttled_statuses = {429}
+transient_statuses = {500, 502, 503, 504}
+
+
+# How hard to retry a failed upstream call
+# max_attempts counts the first attempt, max_elapsed is the total seconds one call may spend retrying,
+# and delays grow as base_delay * 2 ** retry with full jitter, capped at max_delay
+class RetryPolicy:
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30.0, max_elapsed=120.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+
+    # Function to get the jittered backoff before the given retry (1 for the first retry)
+    def backoff(self, retry):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry - 1)))
+
+
+# Policy used by the shared session unless configure_retries is called
+default_policy = RetryPolicy()
+
+# Set max_attempts=1 to switch retries off
+no_retries = RetryPolicy(max_attempts=1)
+
+
+# Function to check whether a request can be sent twice without doing anything twice
+# Reads are always safe, and every update this app sends carries a SyncToken, so a replay of an update that
+# already went through is rejected by QBO as stale instead of being applied again
+# Token calls are never replayed, authorization codes are single use and refresh tokens may rotate
+def is_idempotent(request):
+    if request.method in ('GET', 'HEAD', 'OPTIONS'):
+        return True
+
+    call = classify_request(request)
+    if call == 'query':
+        return True
+    if call in ('update', 'batch'):
+        body = request_body_text(request)
+        return '"SyncToken"' in body and '"operation": "create"' not in body
+    return False
+
+
+# Function to read a Retry-After header, which is either a number of seconds or an HTTP date
+def retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+# Function to decide why a response should be retried, or None if it should not be
+def response_retry_reason(request, response):
+    if response.status_code in throttled_statuses:
+        return 'throttled'
+    if response.status_code in transient_statuses and is_idempotent(request):
+        return 'server_error'
+    return None
+
+
+# Function to decide why a failed send should be retried, or None if it should not be
+# A connect timeout means the request never left, anything else may have reached QBO
+def error_retry_reason(request, err):
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return 'connect_timeout'
+    if isinstance(err, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)) and is_idempotent(request):
+        return 'connection_error'
+    return None
+
+
+# Function to send a prepared request, retrying throttled and transient failures under the policy
+# send is the function that does one attempt, e.g. requests.Session.send bound to a session
+# Returns the last response, or raises the last error, once the policy's budget is spent
+def send_with_retries(send, request, policy=default_policy, **kwargs):
+    call = classify_request(request)
+    started = time.monotonic()
+    attempt = 1
+
+    while True:
+        response = None
+        try:
+            response = send(request, **kwargs)
+            reason = response_retry_reason(request, response)
+        except requests.exceptions.RequestException as err:
+            reason = error_retry_reason(request, err)
+            if reason is None:
+                raise
+            error = err
+
+        if reason is None:
+            return response
+
+        # QBO tags every response with intuit_tid, which Intuit support needs to trace a failed call
+        intuit_tid = response.headers.get('intuit_tid', '') if response is not None else ''
+        detail = f"HTTP {response.status_code}" if response is not None else str(error)
+
+        delay = policy.backoff(attempt)
+        if response is not None:
+            retry_after = retry_after_seconds(response)
+            if retry_after is not None:
+                delay = retry_after + random.uniform(0, policy.base_delay)
+
+        elapsed = time.monotonic() - started
+        if attempt >= policy.max_attempts or elapsed + delay > policy.max_elapsed:
+            print(f"Giving up on {call} call after {attempt} attempts ({detail}, intuit_tid={intuit_tid})")
+            if response is not None:
+                return response
+            raise error
+
+        print(f"Retrying {call} call in {delay:.2f}s after attempt {attempt} ({detail}, intuit_tid={intuit_tid})")
+        upstream_retries.inc(call=call, reason=reason)
+
+        # Give the connection back to the pool before waiting
+        if response is not None:
+            response.close()
+
+        time.sleep(delay)
+        attempt += 1
@@ -0,0 +1,82 @@
+# qbo_stream.py
+
+import codecs
+import json
+import re
+from qbo_metrics import upstream_bytes_received
+
+# Bytes read from the socket at a time
+stream_chunk_size = 64 * 1024
+
+json_decoder = json.JSONDecoder()
+whitespace = re.compile(r'[\s,]*')
+
+
+# Function to parse the entities of a QueryResponse one at a time, straight off a streamed response
+# Only the entity being parsed and one network chunk are held in memory, never the whole page
+# Yields each element of QueryResponse.<entity> as a dict
+def iter_query_response_entities(response, entity, chunk_size=stream_chunk_size):
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    chunks = response.iter_content(chunk_size=chunk_size)
+    array_start = re.compile(r'"' + re.escape(entity) + r'"\s*:\s*\[')
+
+    buffer = ''
+    finished = False
+
+    # Function to append the next network chunk to the buffer, returns False when the body is exhausted
+    def read_more():
+        nonlocal buffer, finished
+        if finished:
+            return False
+        for chunk in chunks:
+            upstream_bytes_received.inc(len(chunk), call='query')
+            text = decoder.decode(chunk)
+            if text:
+                buffer += text
+                return True
+        buffer += decoder.decode(b'', final=True)
+        finished = True
+        return False
+
+    # Find the start of the entity array
+    while True:
+        match = array_start.search(buffer)
+        if match:
+            position = match.end()
+            break
+        if not read_more():
+            # No entity array at all, which is normal for an empty page, but check the body is a QueryResponse
+            if not buffer:
+                raise ValueError('Empty response content')
+            if 'QueryResponse' not in json.loads(buffer):
+                raise ValueError('Unexpected JSON format in the response.')
+            return
+
+    # Decode the array elements one by one, reading more data whenever an element is incomplete
+    while True:
+        position = whitespace.match(buffer, position).end()
+
+        if position >= len(buffer):
+            if not read_more():
+                raise ValueError('Response ended inside the entity array')
+            continue
+
+        if buffer[position] == ']':
+            break
+
+        try:
+            element, end = json_decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if not read_more():
+                raise
+            continue
+
+        yield element
+
+        # Drop what has been parsed so the buffer never grows past one element and one chunk
+        buffer = buffer[end:]
+        position = 0
+
+    # Read the rest of the body so the connection goes back to the pool
+    for chunk in chunks:
+        upstream_bytes_received.inc(len(chunk), call='query')
@@ -0,0 +1,149 @@
+# token_manager.py
+
+import threading
+import time
+from qbo_http import get_session
+from token_store import FileTokenStore
+
+# Refresh the access token this many seconds before it actually expires
+refresh_margin_seconds = 300
+
+
+# Raised when the token endpoint refuses an authorization code or refresh token
+class TokenError(Exception):
+    pass
+
+
+# Keeps the OAuth tokens of one realm in memory together with their expiry times
+# The token store is only read on first use and before a refresh, and only written when the tokens change
+class TokenManager:
+    def __init__(self, client_id, client_secret, redirect_uri, token_endpoint, store=None, realm_id=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self.token_endpoint = token_endpoint
+        self.store = store if store is not None else FileTokenStore('tokens.json')
+        self.realm_id = realm_id
+
+        self.access_token = None
+        self.refresh_token = None
+        self.expires_at = 0.0
+        self.refresh_token_expires_at = 0.0
+        self.loaded = False
+
+        # Only one thread at a time may talk to the token endpoint
+        self.refresh_lock = threading.Lock()
+
+    # Function to load the stored tokens the first time they are needed, or again when force is set
+    # Tokens stored without an expiry time are treated as expired, so they get refreshed on first use
+    def load(self, force=False):
+        if self.loaded and not force:
+            return
+
+        tokens_data = self.store.load(self.realm_id)
+
+        self.access_token = tokens_data.get('access_token')
+        self.refresh_token = tokens_data.get('refresh_token')
+        self.expires_at = tokens_data.get('expires_at', 0.0)
+        self.refresh_token_expires_at = tokens_data.get('refresh_token_expires_at', 0.0)
+        self.loaded = True
+
+    # Function to write the current tokens and their expiry times to the token store
+    def save(self):
+        tokens_data = {
+            'access_token': self.access_token,
+            'refresh_token': self.refresh_token,
+            'expires_at': self.expires_at,
+            'refresh_token_expires_at': self.refresh_token_expires_at,
+        }
+        self.store.save(self.realm_id, tokens_data)
+
+    # Function to check whether the access token is missing or about to expire
+    def needs_refresh(self):
+        return not self.access_token or time.time() >= self.expires_at - refresh_margin_seconds
+
+    # Function to post to the token endpoint and record the tokens it returns
+    def request_tokens(self, token_params):
+        response = get_session().post(self.token_endpoint, data=token_params)
+
+        if response.status_code != 200:
+            raise TokenError(response.text)
+
+        token_response = response.json()
+        now = time.time()
+
+        self.access_token = token_response.get('access_token')
+        # The refresh token may rotate, keep the old one if a new one is not returned
+        self.refresh_token = token_response.get('refresh_token', self.refresh_token)
+        self.expires_at = now + int(token_response.get('expires_in', 3600))
+        if 'x_refresh_token_expires_in' in token_response:
+            self.refresh_token_expires_at = now + int(token_response['x_refresh_token_expires_in'])
+        self.loaded = True
+
+        self.save()
+
+        return self.access_token
+
+    # Function to exchange the authorization code from the callback for tokens
+    def exchange_code(self, auth_code, realm_id=None):
+        token_params = {
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'code': auth_code,
+            'redirect_uri': self.redirect_uri,
+            'grant_type': 'authorization_code',
+        }
+
+        with self.refresh_lock:
+            if realm_id is not None:
+                self.realm_id = realm_id
+            with self.store.lock(self.realm_id):
+                return self.request_tokens(token_params)
+
+    # Function to refresh the access token
+    # If stale_token is given and another thread has already replaced it, the new token is returned
+    # without calling the token endpoint again
+    def refresh_access_token(self, stale_token=None):
+        with self.refresh_lock:
+            return self.refresh_while_locked(stale_token)
+
+    # Function that does the actual refresh, the caller must hold refresh_lock
+    # The store lock keeps other processes out while the refresh token is rotated
+    def refresh_while_locked(self, stale_token=None):
+        with self.store.lock(self.realm_id):
+            # Another process may have rotated the tokens already, so start from what is stored
+            self.load(force=True)
+
+            if stale_token is not None and self.access_token != stale_token and not self.needs_refresh():
+                return self.access_token
+
+            return self.refresh_from_store()
+
+    # Function to call the token endpoint with the stored refresh token
+    def refresh_from_store(self):
+        if not self.refresh_token:
+            raise TokenError('No refresh token stored, please log in again.')
+
+        token_params = {
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'refresh_token': self.refresh_token,
+            'grant_type': 'refresh_token',
+        }
+
+        return self.request_tokens(token_params)
+
+    # Function to get a valid access token, refreshing it shortly before it expires
+    # Concurrent callers share a single refresh instead of each calling the token endpoint
+    def get_access_token(self):
+        self.load()
+
+        if not self.needs_refresh():
+            return self.access_token
+
+        with self.refresh_lock:
+            # Another thread may have refreshed while we were waiting for the lock
+            if not self.needs_refresh():
+                return self.access_token
+
+            return self.refresh_while_locked(stale_token=self.access_token)
@@ -0,0 +1,177 @@
+# token_store.py
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+# Function to hold an exclusive lock on an open file, blocking until it is free
+@contextmanager
+def locked_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                # LK_LOCK gives up after about 10 seconds, keep waiting
+                continue
+        try:
+            yield
+        finally:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# Function to replace a JSON file in a single step
+# The data goes to a temporary file in the same folder first, so readers never see a half-written file
+def atomic_write_json(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# Stores the tokens as JSON files, one file per realm when the path contains {realm_id}
+# Writes go to a temporary file that replaces the real one in a single step, so readers never
+# see a half-written file, and refreshes are serialised across processes with a lock file
+class FileTokenStore:
+    def __init__(self, path_template='tokens.json'):
+        self.path_template = path_template
+        # flock only excludes other processes, threads of this process also need a lock
+        self.thread_lock = threading.Lock()
+
+    # Function to get the tokens file for a realm
+    def path(self, realm_id):
+        return self.path_template.format(realm_id=realm_id or '')
+
+    # Function to read the stored tokens for a realm, returns an empty dict if nothing is stored
+    def load(self, realm_id=None):
+        try:
+            with open(self.path(realm_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    # Function to atomically replace the stored tokens for a realm
+    def save(self, realm_id, tokens_data):
+        atomic_write_json(self.path(realm_id), tokens_data)
+
+    # Context manager that keeps other threads and processes from rotating the realm's tokens
+    @contextmanager
+    def lock(self, realm_id=None):
+        with self.thread_lock:
+            with open(self.path(realm_id) + '.lock', 'a+') as lock_file:
+                with locked_file(lock_file):
+                    yield
+
+
+# Stores the tokens of every realm in one SQLite database, keyed by realm_id
+# WAL mode lets any number of processes read while one of them rotates tokens
+class SQLiteTokenStore:
+    def __init__(self, path='tokens.db'):
+        self.path = path
+        # sqlite3 connections cannot be shared between threads, so each thread gets its own
+        self.local = threading.local()
+
+        with self.connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS tokens (
+                    realm_id TEXT PRIMARY KEY,
+                    access_token TEXT,
+                    refresh_token TEXT,
+                    expires_at REAL,
+                    refresh_token_expires_at REAL,
+                    updated_at REAL
+                )
+            ''')
+
+    # Function to get this thread's connection to the database
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    # Function to read the stored tokens for a realm, returns an empty dict if nothing is stored
+    def load(self, realm_id=None):
+        row = self.connection().execute(
+            'SELECT access_token, refresh_token, expires_at, refresh_token_expires_at FROM tokens WHERE realm_id = ?',
+            (realm_id or '',)
+        ).fetchone()
+
+        if row is None:
+            return {}
+
+        return {
+            'access_token': row[0],
+            'refresh_token': row[1],
+            'expires_at': row[2] or 0.0,
+            'refresh_token_expires_at': row[3] or 0.0,
+        }
+
+    # Function to insert or replace the stored tokens for a realm
+    def save(self, realm_id, tokens_data):
+        self.connection().execute(
+            '''
+            INSERT INTO tokens (realm_id, access_token, refresh_token, expires_at, refresh_token_expires_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(realm_id) DO UPDATE SET
+                access_token = excluded.access_token,
+                refresh_token = excluded.refresh_token,
+                expires_at = excluded.expires_at,
+                refresh_token_expires_at = excluded.refresh_token_expires_at,
+                updated_at = excluded.updated_at
+            ''',
+            (
+                realm_id or '',
+                tokens_data.get('access_token'),
+                tokens_data.get('refresh_token'),
+                tokens_data.get('expires_at', 0.0),
+                tokens_data.get('refresh_token_expires_at', 0.0),
+                time.time(),
+            )
+        )
+
+    # Context manager that keeps other threads and processes from rotating tokens at the same time
+    # BEGIN IMMEDIATE takes the database write lock up front, everything inside commits together
+    @contextmanager
+    def lock(self, realm_id=None):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')